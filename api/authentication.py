@@ -0,0 +1,144 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from core import metrics
+
+# Cheaper JWT authentication (see REST_FRAMEWORK in settings.py).
+#
+# SimpleJWT's JWTAuthentication loads the user with a SELECT on every request. Instead:
+#   - tokens carry the claims the api needs about their user (role, hospital, staff flags)
+#   - CachedJWTAuthentication keeps a snapshot of each user in the cache for AUTH_USER_CACHE_TIMEOUT
+#     seconds, so the database is only read on a miss
+#   - with AUTH_STATELESS_CLAIMS the user is built from the token's claims alone, no cache lookup
+#     of the user and no database at all
+# Saving or deleting a user drops its snapshot (api/signals.py). When a field the token vouches for
+# changes (password, is_active, role, hospital, staff flags) the user is also marked revoked: every
+# token issued before that moment is refused, so a stateless token can't outlive a deactivation.
+# Both live in settings.AUTH_CACHE_ALIAS, a cache that must never evict them (see settings.py). Share it
+# between workers (REDIS_URL) in production or a revocation only reaches the worker that saved the user.
+
+KEY_PREFIX = 'auth'
+
+# user fields kept in the snapshot, claims hold the ones marked in CLAIMS
+SNAPSHOT_FIELDS = ('username', 'is_active', 'is_staff', 'is_superuser', 'role', 'hospital_id')
+# claim -> user field
+CLAIMS = {'username': 'username', 'role': 'role', 'hospital': 'hospital_id',
+          'is_staff': 'is_staff', 'is_superuser': 'is_superuser'}
+# a change to any of these revokes the tokens issued before it
+REVOKING_FIELDS = ('password', 'is_active', 'is_staff', 'is_superuser', 'role', 'hospital_id')
+
+
+def get_cache():
+    return caches[settings.AUTH_CACHE_ALIAS]
+
+
+def user_key(user_id):
+    return f'{KEY_PREFIX}:user:{user_id}'
+
+
+def revoked_key(user_id):
+    return f'{KEY_PREFIX}:revoked:{user_id}'
+
+
+def forget(user_id):
+    """Drop the cached snapshot of a user, the next request reloads it."""
+    get_cache().delete(user_key(user_id))
+
+
+def revoke(user_id):
+    """Refuse every token of this user issued until now. Kept as long as an access or refresh token lives."""
+    lifetime = max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME)
+    cache = get_cache()
+    cache.set(revoked_key(user_id), time.time(), timeout=int(lifetime.total_seconds()))
+    cache.delete(user_key(user_id))
+
+
+def is_revoked(token, revoked_at):
+    # iat only has whole seconds, auth_time tells a login right after the change from one right before.
+    # Tokens without it (issued before the claims were added) are refused for the whole second
+    return revoked_at is not None and token.get('auth_time', token.get('iat', 0)) < revoked_at
+
+
+def snapshot(user):
+    return {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+
+
+def build_user(user_id, fields):
+    """A User instance from a snapshot or claims, without touching the database."""
+    User = get_user_model()
+    user = User(id=user_id, **fields)
+    user._state.adding = False  # behaves like a loaded row, e.g. for foreign keys pointing at it
+    user._state.db = 'default'
+    return user
+
+
+def add_claims(token, user):
+    for claim, field in CLAIMS.items():
+        token[claim] = getattr(user, field)
+    token['auth_time'] = time.time()  # when the user logged in, copied to the access tokens of a refresh
+    return token
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """_summary_
+    Drop-in replacement of SimpleJWT's JWTAuthentication that avoids the SELECT on core.User:
+    the user comes from its cached snapshot (or, with AUTH_STATELESS_CLAIMS, from the token's
+    claims) and the database is only read on a cache miss. Tokens of a revoked user are refused.
+    """
+
+    def authenticate(self, request):
+        with metrics.timer('auth'):
+            return super().authenticate(request)
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        # tokens issued before the claims were added still go through the snapshot
+        stateless = settings.AUTH_STATELESS_CLAIMS and all(claim in validated_token for claim in CLAIMS)
+        cache = get_cache()
+        found = cache.get_many([revoked_key(user_id)] if stateless else [revoked_key(user_id), user_key(user_id)])
+        if is_revoked(validated_token, found.get(revoked_key(user_id))):
+            raise AuthenticationFailed('Token has been revoked, log in again.', code='token_revoked')
+
+        if stateless:
+            # revoke() covers deactivation, an inactive user never gets a token in the first place
+            return build_user(user_id, {field: validated_token[claim] for claim, field in CLAIMS.items()})
+
+        fields = found.get(user_key(user_id))
+        if fields is None:
+            user = super().get_user(validated_token)  # the SELECT, raises for unknown and inactive users
+            cache.set(user_key(user_id), snapshot(user), timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+            return user
+        if not fields['is_active']:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return build_user(user_id, fields)
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """POST /api/token/, the tokens carry the user's role, hospital and staff flags"""
+
+    @classmethod
+    def get_token(cls, user):
+        return add_claims(super().get_token(user), user)
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """POST /api/token/refresh/, a revoked refresh token can't hand out new access tokens (with stale claims)"""
+
+    def validate(self, attrs):
+        refresh = RefreshToken(attrs['refresh'])
+        user_id = refresh.get(api_settings.USER_ID_CLAIM)
+        if is_revoked(refresh, get_cache().get(revoked_key(user_id))):
+            raise InvalidToken('Token has been revoked, log in again.')
+        return super().validate(attrs)
@@ -0,0 +1,384 @@
+import copy
+import hashlib
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from rest_framework.exceptions import ParseError
+
+from core import sync
+from core.signals import bulk_created, bulk_updated
+
+from .renderers import loads
+
+logger = logging.getLogger(__name__)
+
+# Bulk ingestion used by the /bulk/ actions (see BulkIngestMixin in api/mixins.py).
+# Rows are validated and inserted a chunk at a time, every chunk in its own transaction, and the
+# caller gets a report saying which rows were created and which failed and why, so a 50k row
+# upload with a handful of bad rows doesn't have to be sent again in full.
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+def iter_request_rows(request):
+    """_summary_
+    Yields (row number, row) pairs from the request body. NDJSON bodies (one JSON object per
+    line) are read line by line straight from the socket so a huge upload is never held in
+    memory; a plain JSON array is parsed in one go like any other DRF request.
+    Rows that are not valid JSON are yielded as a ParseError so they end up in the report.
+    """
+    if request.content_type.startswith(NDJSON_MEDIA_TYPE):
+        row_number = 0
+        for line in request._request:  # the django request streams its body, line by line
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = loads(line)
+            except ValueError as error:
+                row = ParseError(f'Invalid JSON: {error}')
+            yield row_number, row
+            row_number += 1
+        return
+
+    data = request.data
+    if not isinstance(data, list):
+        raise ParseError('Expected a list of objects or an NDJSON body.')
+    yield from enumerate(data)
+
+
+def build_instances(model, rows):
+    """_summary_
+    Turn validated rows into unsaved model instances. Many-to-many values (e.g. User.groups)
+    can't be passed to the model constructor, they are returned separately and have to be
+    applied with set_many_to_many() once the instances have primary keys.
+    """
+    many_to_many = {field.name for field in model._meta.many_to_many}
+    instances, relations = [], []
+    for data in rows:
+        data = dict(data)
+        relations.append({name: data.pop(name) for name in many_to_many if name in data})
+        instance = model(**data)
+        pre_bulk_save(instance)
+        instances.append(instance)
+    return instances, relations
+
+
+def pre_bulk_save(instance):
+    """bulk writes skip Model.save(), models that fill in fields there (Referral.decision_date...)
+    expose the same logic as pre_bulk_save(), which returns the names of the fields it changed"""
+    hook = getattr(instance, 'pre_bulk_save', None)
+    return hook() if hook else []
+
+
+def set_many_to_many(instances, relations):
+    for instance, values in zip(instances, relations):
+        for name, related in values.items():
+            getattr(instance, name).set(related)
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BulkIngestReport:
+
+    def __init__(self):
+        self.created = 0
+        self.failed = 0
+        self.rows = []
+
+    def add_created(self, row_number, instance):
+        self.created += 1
+        self.rows.append({'row': row_number, 'status': 'created', 'id': instance.pk})
+
+    def add_failed(self, row_number, errors):
+        self.failed += 1
+        self.rows.append({'row': row_number, 'status': 'failed', 'errors': errors})
+
+    def as_dict(self):
+        self.rows.sort(key=lambda row: row['row'])
+        return {'created': self.created, 'failed': self.failed, 'rows': self.rows}
+
+
+def ingest(rows, serializer_class, context, chunk_size):
+    """
+    Validate and insert (row number, row) pairs chunk by chunk. Returns a BulkIngestReport.
+    """
+    model = serializer_class.Meta.model
+    report = BulkIngestReport()
+
+    for chunk in chunked(rows, chunk_size):
+        candidates = []
+        for row_number, row in chunk:
+            if isinstance(row, ParseError):
+                report.add_failed(row_number, {'non_field_errors': [str(row.detail)]})
+            elif not isinstance(row, dict):
+                report.add_failed(row_number, {'non_field_errors': ['Expected an object.']})
+            else:
+                candidates.append((row_number, row))
+
+        # validates the whole chunk with one lookup query per related model (see BulkListSerializer)
+        list_serializer = serializer_class(many=True, context=context)
+        results = list_serializer.validate_rows([row for _, row in candidates])
+
+        valid_numbers, valid_rows = [], []
+        for (row_number, _), (validated_data, errors) in zip(candidates, results):
+            if errors is None:
+                valid_numbers.append(row_number)
+                valid_rows.append(validated_data)
+            else:
+                report.add_failed(row_number, errors)
+
+        if valid_rows:
+            instances, relations = build_instances(model, valid_rows)
+            insert_chunk(model, list(zip(valid_numbers, instances, relations)), report)
+
+    return report
+
+
+def insert_chunk(model, numbered_instances, report):
+    instances = [instance for _, instance, _ in numbered_instances]
+    relations = [related for _, _, related in numbered_instances]
+    try:
+        with transaction.atomic():
+            sync.stamp(instances)
+            model.objects.bulk_create(instances, batch_size=len(instances))
+            set_many_to_many(instances, relations)
+            # bulk_create sends no post_save, tell the listeners (rollup, cache invalidation...) ourselves
+            bulk_created.send(sender=model, instances=instances)
+    except DatabaseError as error:
+        # something in the chunk violates a database constraint, find out which rows by
+        # inserting them one at a time, each in its own savepoint
+        logger.error("Bulk insert of %d %s failed, retrying row by row: %s", len(instances), model._meta.verbose_name_plural, error)
+        for row_number, instance, related in numbered_instances:
+            instance.pk = None
+            try:
+                with transaction.atomic():
+                    instance.save(force_insert=True)
+                    set_many_to_many([instance], [related])
+            except DatabaseError as row_error:
+                report.add_failed(row_number, {'non_field_errors': [str(row_error)]})
+            else:
+                report.add_created(row_number, instance)
+        return
+
+    for row_number, instance, _ in numbered_instances:
+        report.add_created(row_number, instance)
+
+
+class UpsertReport:
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.duplicates = 0
+        self.errors = []
+
+    def as_dict(self):
+        return {
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'duplicates': self.duplicates,
+            'failed': len(self.errors),
+            'errors': sorted(self.errors, key=lambda error: error['row']),
+        }
+
+
+def natural_key(values, key_fields):
+    return tuple(values.get(name) for name in key_fields)
+
+
+def upsert(rows, serializer_class, context, key_fields, chunk_size):
+    """_summary_
+    Insert-or-update (row number, row) pairs matched on `key_fields`, e.g. ('first_name', 'last_name', 'dob').
+    Each chunk costs one SELECT for the existing rows (filtered on every key column with IN, then
+    matched exactly in python), one bulk INSERT for the new rows and one bulk UPDATE for the rows
+    that actually changed, all in one transaction that holds the chunk's keys (lock_natural_keys).
+    Rows identical to what is stored are left alone. When the same key appears twice in one chunk
+    the last row wins and the others count as duplicates; a row missing a key value fails.
+    """
+    model = serializer_class.Meta.model
+    report = UpsertReport()
+
+    for chunk in chunked(rows, chunk_size):
+        candidates = []
+        for row_number, row in chunk:
+            if isinstance(row, ParseError):
+                report.errors.append({'row': row_number, 'errors': {'non_field_errors': [str(row.detail)]}})
+            elif not isinstance(row, dict):
+                report.errors.append({'row': row_number, 'errors': {'non_field_errors': ['Expected an object.']}})
+            else:
+                candidates.append((row_number, row))
+
+        list_serializer = serializer_class(many=True, context=context)
+        results = list_serializer.validate_rows([row for _, row in candidates])
+
+        incoming = {}
+        for (row_number, _), (validated_data, errors) in zip(candidates, results):
+            if errors is None:
+                key = natural_key(validated_data, key_fields)
+                missing = [name for name, value in zip(key_fields, key) if value is None]
+                if missing:
+                    # a row without its key can't be told apart from other rows without it
+                    errors = {name: ['A value is required to match on this field.'] for name in missing}
+            if errors is None:
+                if key in incoming:
+                    report.duplicates += 1
+                incoming[key] = validated_data
+            else:
+                report.errors.append({'row': row_number, 'errors': errors})
+        if incoming:
+            upsert_chunk(model, incoming, key_fields, report)
+
+    return report
+
+
+def lock_natural_keys(model, key_fields, keys):
+    """_summary_
+    Serialize upserts of the same natural keys: there is no unique constraint to fall back on
+    (two patients can share a name and date of birth), so without it two syncs of the same rows
+    would both find nothing and both insert. On postgres every key takes a transaction level
+    advisory lock, in a fixed order so that two overlapping chunks can't deadlock. SQLite
+    already lets only one transaction write at a time.
+    Must run inside the transaction.atomic() block that reads and writes the rows.
+    """
+    connection = transaction.get_connection()
+    if connection.vendor != 'postgresql':
+        return
+    # the two int keys form: single bigint keys mark the writers in flight of the sync feed (core/models.py)
+    lock_ids = set()
+    for key in keys:
+        digest = hashlib.blake2b(repr((model._meta.label_lower, key_fields, key)).encode(), digest_size=8).digest()
+        lock_ids.add((int.from_bytes(digest[:4], 'big', signed=True), int.from_bytes(digest[4:], 'big', signed=True)))
+    lock_ids = sorted(lock_ids)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(high, low) FROM unnest(%s::integer[], %s::integer[]) AS lock_id(high, low)',
+                       [[high for high, _ in lock_ids], [low for _, low in lock_ids]])
+
+
+def upsert_chunk(model, incoming, key_fields, report):
+    with transaction.atomic():
+        lock_natural_keys(model, key_fields, incoming)
+        lookup = Q()
+        for index, name in enumerate(key_fields):
+            lookup &= Q(**{f'{name}__in': {key[index] for key in incoming}})
+        existing = {}
+        # lowest id wins if the table already holds duplicates of a key
+        for instance in model.objects.filter(lookup).order_by('-id'):
+            existing[tuple(getattr(instance, name) for name in key_fields)] = instance
+        instances, changed, previous, changed_fields = write_upserts(model, incoming, existing, report)
+        # neither bulk_create nor bulk_update send post_save
+        if instances:
+            bulk_created.send(sender=model, instances=instances)
+        if changed:
+            bulk_updated.send(sender=model, instances=changed, previous=previous, fields=sorted(changed_fields))
+
+    report.inserted += len(instances)
+    report.updated += len(changed)
+
+
+def write_upserts(model, incoming, existing, report):
+    new_rows, changed, previous, changed_fields = [], [], [], set()
+    for key, data in incoming.items():
+        instance = existing.get(key)
+        if instance is None:
+            new_rows.append(data)
+            continue
+        fields = [name for name, value in data.items() if getattr(instance, name) != value]
+        if not fields:
+            report.unchanged += 1
+            continue
+        previous.append(copy.copy(instance))
+        for name in fields:
+            setattr(instance, name, data[name])
+        changed.append(instance)
+        changed_fields.update(fields + pre_bulk_save(instance))
+
+    instances, relations = build_instances(model, new_rows)
+    changed_fields.update(sync.stamp(instances + changed))
+    if instances:
+        model.objects.bulk_create(instances, batch_size=settings.BULK_CREATE_BATCH_SIZE)
+        set_many_to_many(instances, relations)
+    if changed:
+        model.objects.bulk_update(changed, sorted(changed_fields), batch_size=settings.BULK_CREATE_BATCH_SIZE)
+    return instances, changed, previous, changed_fields
+
+
+def bulk_partial_update(queryset, serializer_class, context, items, state_field=None, transitions=None):
+    """_summary_
+    Apply partial updates to many rows at once. `items` is a list of objects like
+    {"id": 4, "status": "Accepted"}, optionally with "expected_<state_field>" (e.g. expected_status):
+    the state the client saw when it decided, used for optimistic concurrency. If the row has moved
+    on since (another clerk already accepted it) that item fails with a conflict instead of
+    silently overwriting the other change.
+    Changes to `state_field` must be allowed by `transitions` ({current: [allowed next states]}).
+    All good items are written with one bulk UPDATE inside a transaction that has the rows locked.
+    Returns a report dict with the number of updated rows and the errors of the failed items.
+    """
+    model = queryset.model
+    expected_key = f'expected_{state_field}' if state_field else None
+    errors = []
+
+    candidates = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('id'), int) or isinstance(item.get('id'), bool):
+            errors.append({'index': index, 'id': None, 'errors': {'id': ['An integer id is required.']}})
+            continue
+        data = {name: value for name, value in item.items() if name not in ('id', expected_key)}
+        candidates.append((index, item, data))
+
+    list_serializer = serializer_class(many=True, partial=True, context=context)
+    results = list_serializer.validate_rows([data for _, _, data in candidates])
+
+    changed, previous, changed_fields = [], [], set()
+    with transaction.atomic():
+        # lock the rows so nobody changes them between our checks and the update
+        current = queryset.select_for_update().in_bulk([item['id'] for _, item, _ in candidates])
+        for (index, item, _), (validated_data, item_errors) in zip(candidates, results):
+            instance = current.get(item['id'])
+            if item_errors is None and instance is None:
+                item_errors = {'id': ['Not found.']}
+            if item_errors is None and state_field:
+                item_errors = check_transition(instance, state_field, transitions,
+                                               item.get(expected_key), validated_data.get(state_field))
+            if item_errors is not None:
+                errors.append({'index': index, 'id': item['id'], 'errors': item_errors})
+                continue
+
+            fields = [name for name, value in validated_data.items() if getattr(instance, name) != value]
+            if not fields:
+                continue
+            previous.append(copy.copy(instance))
+            for name in fields:
+                setattr(instance, name, validated_data[name])
+            changed.append(instance)
+            changed_fields.update(fields + pre_bulk_save(instance))
+
+        if changed:
+            changed_fields.update(sync.stamp(changed))
+            model.objects.bulk_update(changed, sorted(changed_fields), batch_size=settings.BULK_CREATE_BATCH_SIZE)
+            bulk_updated.send(sender=model, instances=changed, previous=previous, fields=sorted(changed_fields))
+
+    errors.sort(key=lambda error: error['index'])
+    return {'updated': len(changed), 'failed': len(errors), 'errors': errors}
+
+
+def check_transition(instance, state_field, transitions, expected, new_state):
+    current = getattr(instance, state_field)
+    if expected is not None and expected != current:
+        return {f'expected_{state_field}': [f'Conflict: {state_field} is now "{current}", not "{expected}".']}
+    if new_state is not None and new_state != current and new_state not in transitions.get(current, ()):
+        return {state_field: [f'Cannot change {state_field} from "{current}" to "{new_state}".']}
+    return None
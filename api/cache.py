@@ -0,0 +1,94 @@
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Response cache for the read-heavy endpoints (see CachedResponseMixin in api/mixins.py).
+#
+# Instead of deleting keys when something changes, every model has a "generation" number kept in
+# the cache. Cache keys include the generation of the model and of every model it points at, and
+# invalidating a model just bumps its generation, so all of its old entries are never read again
+# and simply expire. This works the same on the local-memory backend (tests, single worker) and on
+# a shared backend like redis (several workers), where one worker's invalidation is seen by all.
+# Generations start from the clock, so one the cache evicted starts again above every number it had
+# before instead of falling back to an old one whose responses may still be cached.
+# Bumps happen once the write commits (see api/signals.py): bumped before, a read running meanwhile
+# would cache the old rows under the new generation.
+
+KEY_PREFIX = 'api'
+
+
+def get_cache():
+    return caches[settings.API_CACHE_ALIAS]
+
+
+def generation_key(model):
+    return f'{KEY_PREFIX}:gen:{model._meta.label_lower}'
+
+
+def dependencies(model):
+    # a payload can embed the rows its foreign keys point at (?expand=...), so it depends on them too
+    related = [field.related_model for field in model._meta.get_fields()
+               if field.many_to_one and field.related_model is not None]
+    return [model] + [other for other in dict.fromkeys(related) if other is not model]
+
+
+def new_generation():
+    return time.time_ns()
+
+
+def invalidate(*models):
+    cache = get_cache()
+    for model in models:
+        key = generation_key(model)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # never used or evicted, a fresh generation is above any the key held before
+            cache.set(key, new_generation(), timeout=None)
+
+
+def response_key(model, action, pk, query_params):
+    cache = get_cache()
+    keys = [generation_key(dependency) for dependency in dependencies(model)]
+    generations = cache.get_many(keys)
+    missing = [key for key in keys if key not in generations]
+    if missing:
+        for key in missing:
+            cache.add(key, new_generation(), timeout=None)
+        generations.update(cache.get_many(missing))
+    version = '.'.join(str(generations.get(key, 0)) for key in keys)
+    params = '&'.join(f'{name}={value}' for name, values in sorted(query_params.lists())
+                      for value in sorted(values))
+    digest = hashlib.sha1(params.encode()).hexdigest()
+    return f'{KEY_PREFIX}:resp:{model._meta.label_lower}:{version}:{action}:{pk}:{digest}'
+
+
+class CacheStats:
+    """Per-process hit/miss counters, reported by /api/cache-stats/."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def snapshot(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else None,
+            }
+
+
+stats = CacheStats()
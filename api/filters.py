@@ -0,0 +1,131 @@
+import datetime
+
+from django_filters import rest_framework as filters
+
+from core.models import Diagnostic, Equipment, Hospital, MedicalHistory, Patient, Referral, User
+
+# Query parameters each list endpoint accepts, e.g. /api/referrals/?referred_to=3&status__in=Pending,Accepted
+# Only filters an index can answer are exposed on the big tables (api/tests.py checks the query plans),
+# free text columns are searched with /api/search/ and /api/patients/search/ instead.
+# Foreign keys are filtered by id with NumberFilter, which (unlike the default ModelChoiceFilter)
+# doesn't look the related row up first: an unknown id just matches nothing.
+
+
+class NumberInFilter(filters.BaseInFilter, filters.NumberFilter):
+    """?field__in=1,2,3"""
+
+
+class CharInFilter(filters.BaseInFilter, filters.CharFilter):
+    """?field__in=a,b,c"""
+
+
+# Hospital filters
+class HospitalFilter(filters.FilterSet):
+    id__in = NumberInFilter(field_name='id', lookup_expr='in')
+
+    class Meta:
+        model = Hospital
+        fields = {
+            'id': ['exact'],
+            'name': ['exact'],  # hospital_name_idx
+            'type': ['exact'],
+        }
+
+
+# User filters
+class UserFilter(filters.FilterSet):
+    hospital = filters.NumberFilter(field_name='hospital')
+    hospital__in = NumberInFilter(field_name='hospital', lookup_expr='in')
+
+    class Meta:
+        model = User
+        fields = {
+            'id': ['exact'],
+            'username': ['exact'],
+            'role': ['exact'],
+            'is_active': ['exact'],
+        }
+
+
+# Patient filters
+class PatientFilter(filters.FilterSet):
+    id__in = NumberInFilter(field_name='id', lookup_expr='in')
+
+    class Meta:
+        model = Patient
+        fields = {
+            'id': ['exact'],
+            # patient_natural_key_idx starts with last_name, first_name and dob only narrow it down further
+            'last_name': ['exact'],
+        }
+
+
+# Medical History filters
+class MedicalHistoryFilter(filters.FilterSet):
+    patient = filters.NumberFilter(field_name='patient')
+    patient__in = NumberInFilter(field_name='patient', lookup_expr='in')
+    ongoing = filters.BooleanFilter(method='filter_ongoing')
+
+    class Meta:
+        model = MedicalHistory
+        fields = {
+            'id': ['exact'],
+            'start_date': ['exact', 'gte', 'lte'],  # medhistory_start_idx
+            'end_date': ['exact', 'gte', 'lte'],  # medhistory_end_idx
+        }
+
+    def filter_ongoing(self, queryset, name, value):
+        if value:
+            return queryset.filter(end_date__isnull=True)  # medhistory_ongoing_idx
+        # finished treatments, written as a range because sqlite won't use an index for IS NOT NULL
+        return queryset.filter(end_date__gte=datetime.date.min)  # medhistory_end_idx
+
+
+# Diagnostic filters
+class DiagnosticFilter(filters.FilterSet):
+    patient = filters.NumberFilter(field_name='patient')
+    patient__in = NumberInFilter(field_name='patient', lookup_expr='in')
+
+    class Meta:
+        model = Diagnostic
+        fields = {
+            'id': ['exact'],
+            'date_taken': ['exact', 'gte', 'lte'],  # diagnostic_date_idx
+        }
+
+
+# Equipment filters
+class EquipmentFilter(filters.FilterSet):
+    hospital = filters.NumberFilter(field_name='hospital')
+    hospital__in = NumberInFilter(field_name='hospital', lookup_expr='in')
+    available = filters.BooleanFilter(method='filter_available')  # equipment_avail_hospital_idx
+
+    class Meta:
+        model = Equipment
+        fields = {
+            'id': ['exact'],
+            'equipment_name': ['exact'],  # equipment_name_avail_idx
+        }
+
+    def filter_available(self, queryset, name, value):
+        # available=False is compiled to WHERE NOT available, which sqlite can't answer from an index
+        return queryset.filter(available__in=[value])
+
+
+# Referral filters
+class ReferralFilter(filters.FilterSet):
+    patient = filters.NumberFilter(field_name='patient')
+    patient__in = NumberInFilter(field_name='patient', lookup_expr='in')
+    referred_from = filters.NumberFilter(field_name='referred_from')
+    referred_from__in = NumberInFilter(field_name='referred_from', lookup_expr='in')
+    referred_to = filters.NumberFilter(field_name='referred_to')
+    referred_to__in = NumberInFilter(field_name='referred_to', lookup_expr='in')
+    status__in = CharInFilter(field_name='status', lookup_expr='in')
+
+    class Meta:
+        model = Referral
+        fields = {
+            'id': ['exact'],
+            'status': ['exact'],  # referral_status_date_idx
+            'referral_date': ['exact', 'gte', 'lte'],  # referral_date_idx
+        }
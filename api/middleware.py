@@ -0,0 +1,85 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+
+from core import metrics, profiling
+
+
+class RequestMetricsMiddleware:
+    """_summary_
+    Measures every request (see core/metrics.py): SQL query count and time, authentication,
+    serialization and render time, and response size. Adds them to the response as a
+    Server-Timing header, e.g. `Server-Timing: db;dur=12.40;desc="3 queries", auth;dur=0.15, ...`,
+    and records them in the per-endpoint histograms served by /api/metrics/. The requests the
+    query profiler samples (core/profiling.py) also get their repeated and slow queries reported.
+    Works for sync and async views alike. Streamed responses are measured until their headers go out.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = settings.API_METRICS_ENABLED
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        token = metrics.current.set(self.start())
+        try:
+            response = self.finish(request, self.get_response(request))
+            self.report_profile(request, response)
+            return response
+        finally:
+            metrics.current.reset(token)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        token = metrics.current.set(self.start())
+        try:
+            response = self.finish(request, await self.get_response(request))
+            if metrics.current.get().profile is not None:
+                # the ring buffer is a blocking cache write, keep it off the event loop
+                await sync_to_async(self.report_profile)(request, response)
+            return response
+        finally:
+            metrics.current.reset(token)
+
+    def start(self):
+        request_metrics = metrics.RequestMetrics()
+        request_metrics.profile = profiling.start()
+        return request_metrics
+
+    def finish(self, request, response):
+        request_metrics = metrics.current.get()
+        endpoint, action = self.endpoint(request)
+        size = None if response.streaming else len(response.content)
+        metrics.registry.observe(endpoint, request.method, action, response.status_code, request_metrics, size)
+        if settings.API_SERVER_TIMING:
+            response['Server-Timing'] = request_metrics.server_timing()
+        return response
+
+    def report_profile(self, request, response):
+        request_metrics = metrics.current.get()
+        profile, request_metrics.profile = request_metrics.profile, None  # the buffer write isn't profiled
+        if profile is None:
+            return
+        queries, db_ms = request_metrics.queries, round(request_metrics.db_time * 1000, 3)
+        findings = profile.findings()
+        if findings:
+            endpoint, action = self.endpoint(request)
+            profiling.push({'endpoint': endpoint, 'action': action, 'method': request.method,
+                            'path': request.get_full_path()[:500], 'status': response.status_code,
+                            'queries': queries, 'db_ms': db_ms, 'findings': findings})
+
+    def endpoint(self, request):
+        """(url name, viewset action or lowercase method) of the request"""
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            # 404s are counted together, a label per unknown url would grow without end
+            return 'unmatched', ''
+        actions = getattr(match.func, 'actions', None) or {}
+        return match.view_name or match.route, actions.get(request.method.lower(), request.method.lower())
@@ -0,0 +1,392 @@
+import logging
+from functools import update_wrapper
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from core import sync
+from core.signals import bulk_created
+
+from . import bulk, cache, renderers
+
+logger = logging.getLogger(__name__)
+
+# Reusable behaviour shared by the viewsets in api/views.py
+
+
+class BatchCreateMixin:
+    """_summary_
+    A viewset is robust in that with just a few lines you have produced a controller
+    that auto maps the request's METHOD to the appropriate CRUD operation
+    But we wanted to allow batch creation of resources if the clients wanted to add multiple resources with
+    one POST request, so we had to override the create method of the viewset
+    """
+
+    def create(self, request, *args, **kwargs):
+        # Check if the request data is a list (batch insert)
+        if isinstance(request.data, list):
+            # Use many=True to serialize the list of resources
+            serializer = self.get_serializer(data=request.data, many=True)
+        else:
+            # Single object creation
+            serializer = self.get_serializer(data=request.data)
+
+        # Validate the data
+        serializer.is_valid(raise_exception=True)
+
+        # Save the data (handle single and batch creation)
+        self.perform_create(serializer)
+
+        # Return the response
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    def perform_create(self, serializer):
+        model = self.get_queryset().model
+        try:
+            if isinstance(serializer.validated_data, list):
+                instances, relations = bulk.build_instances(model, serializer.validated_data)
+                with transaction.atomic():
+                    sync.stamp(instances)
+                    model.objects.bulk_create(instances, batch_size=settings.BULK_CREATE_BATCH_SIZE)
+                    bulk.set_many_to_many(instances, relations)
+                    # bulk_create sends no post_save, tell the listeners (rollup, cache invalidation...) ourselves
+                    bulk_created.send(sender=model, instances=instances)
+                serializer.instance = instances
+            else:
+                serializer.save()
+        except Exception as e:
+            logger.error("Error during %s creation: %s", model._meta.verbose_name, e)
+            raise
+
+
+class BulkIngestMixin:
+    """_summary_
+    POST /api/<resource>/bulk/ for large imports (thousands of patients from a district system...).
+    Unlike the batch POST, which rejects the whole list if one row is bad, rows are validated
+    and inserted in chunks of ?chunk_size= rows, each chunk in its own transaction, and the
+    response reports every row as created (with its id) or failed (with its errors) so only
+    the failed rows need to be fixed and sent again.
+    Send the rows as NDJSON (Content-Type: application/x-ndjson, one object per line) to have
+    the body streamed instead of loaded in one piece.
+    """
+
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk(self, request, *args, **kwargs):
+        chunk_size = self.get_chunk_size(request)
+        report = bulk.ingest(bulk.iter_request_rows(request), self.get_serializer_class(),
+                             self.get_serializer_context(), chunk_size).as_dict()
+        response_status = status.HTTP_207_MULTI_STATUS if report['failed'] else status.HTTP_201_CREATED
+        return Response(report, status=response_status)
+
+    def get_chunk_size(self, request):
+        try:
+            chunk_size = int(request.query_params.get('chunk_size', settings.BULK_INGEST_CHUNK_SIZE))
+        except ValueError:
+            chunk_size = settings.BULK_INGEST_CHUNK_SIZE
+        return min(max(chunk_size, 1), settings.BULK_INGEST_MAX_CHUNK_SIZE)
+
+
+class UpsertMixin:
+    """_summary_
+    POST /api/<resource>/upsert/ takes a list of objects and inserts the ones that don't exist yet
+    and updates the ones that do, matching on a natural key instead of the id (see api/bulk.py).
+    The key defaults to `upsert_key_fields` and can be changed per request with
+    ?on=field1,field2 (any of `upsert_allowed_key_fields`). Answers with the number of
+    inserted, updated and unchanged rows, plus the rows that failed validation.
+    """
+    upsert_key_fields = ()
+    upsert_allowed_key_fields = ()
+
+    @action(detail=False, methods=['post'], url_path='upsert')
+    def upsert(self, request, *args, **kwargs):
+        key_fields = self.get_upsert_key_fields(request)
+        report = bulk.upsert(bulk.iter_request_rows(request), self.get_serializer_class(),
+                             self.get_serializer_context(), key_fields, settings.BULK_INGEST_CHUNK_SIZE)
+        return Response(report.as_dict())
+
+    def get_upsert_key_fields(self, request):
+        requested = request.query_params.get('on')
+        if not requested:
+            return tuple(self.upsert_key_fields)
+        key_fields = tuple(dict.fromkeys(name.strip() for name in requested.split(',') if name.strip()))
+        invalid = [name for name in key_fields if name not in self.upsert_allowed_key_fields]
+        if invalid or not key_fields:
+            raise ValidationError({'on': [f'Choose from: {", ".join(self.upsert_allowed_key_fields)}.']})
+        return key_fields
+
+
+class BulkUpdateMixin:
+    """_summary_
+    PATCH /api/<resource>/bulk-update/ applies partial updates to many rows with one UPDATE
+    (see bulk.bulk_partial_update). The body is either a list of objects with an id and the
+    fields to change, or a shorthand that applies the same change to many ids:
+    {"ids": [4, 5, 6], "status": "Accepted", "expected_status": "Pending"}
+    Viewsets set `bulk_state_field`/`bulk_state_transitions` to validate state changes.
+    """
+    bulk_state_field = None
+    bulk_state_transitions = {}
+
+    @action(detail=False, methods=['patch'], url_path='bulk-update')
+    def bulk_update(self, request, *args, **kwargs):
+        data = request.data
+        if isinstance(data, dict) and isinstance(data.get('ids'), list):
+            changes = {name: value for name, value in data.items() if name != 'ids'}
+            data = [{'id': pk, **changes} for pk in data['ids']]
+        if not isinstance(data, list):
+            raise ValidationError({'non_field_errors': ['Expected a list of objects or {"ids": [...], ...}.']})
+
+        report = bulk.bulk_partial_update(self.get_queryset(), self.get_serializer_class(),
+                                          self.get_serializer_context(), data,
+                                          self.bulk_state_field, self.bulk_state_transitions)
+        response_status = status.HTTP_207_MULTI_STATUS if report['failed'] else status.HTTP_200_OK
+        return Response(report, status=response_status)
+
+
+class CachedResponseMixin:
+    """_summary_
+    Caches the serialized payload of list and retrieve responses, one entry per model,
+    action, object and set of query parameters. Entries are invalidated whenever a row of
+    the model (or of a model it points at) is saved, deleted or bulk created, see api/cache.py.
+    Responses carry an X-Cache: HIT/MISS header.
+    """
+    cache_timeout = None  # seconds, defaults to settings.API_CACHE_TIMEOUT
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(request, 'list', None,
+                                    lambda: super(CachedResponseMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        pk = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        return self.cached_response(request, 'retrieve', pk,
+                                    lambda: super(CachedResponseMixin, self).retrieve(request, *args, **kwargs))
+
+    async def alist(self, request, *args, **kwargs):
+        return await self.acached_response(request, 'list', None,
+                                           lambda: super(CachedResponseMixin, self).alist(request, *args, **kwargs))
+
+    async def aretrieve(self, request, *args, **kwargs):
+        pk = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        return await self.acached_response(request, 'retrieve', pk,
+                                           lambda: super(CachedResponseMixin, self).aretrieve(request, *args, **kwargs))
+
+    async def acached_response(self, request, action, pk, build_response):
+        # cached_response for the async read path, build_response returns a coroutine
+        model = self.get_queryset().model
+        key = await sync_to_async(cache.response_key)(model, action, pk, request.query_params)
+        backend = cache.get_cache()
+
+        data = await backend.aget(key)
+        if data is not None:
+            cache.stats.record(hit=True)
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        cache.stats.record(hit=False)
+        response = await build_response()
+        if isinstance(response, Response) and response.status_code == status.HTTP_200_OK:
+            timeout = self.cache_timeout if self.cache_timeout is not None else settings.API_CACHE_TIMEOUT
+            await backend.aset(key, response.data, timeout=timeout)
+            response['X-Cache'] = 'MISS'
+        return response
+
+    def cached_response(self, request, action, pk, build_response, model=None):
+        # `model` is the model whose changes invalidate the entry, by default the viewset's
+        model = model or self.get_queryset().model
+        key = cache.response_key(model, action, pk, request.query_params)
+        backend = cache.get_cache()
+
+        data = backend.get(key)
+        if data is not None:
+            cache.stats.record(hit=True)
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        cache.stats.record(hit=False)
+        response = build_response()
+        # streamed and error responses are not cached
+        if isinstance(response, Response) and response.status_code == status.HTTP_200_OK:
+            timeout = self.cache_timeout if self.cache_timeout is not None else settings.API_CACHE_TIMEOUT
+            backend.set(key, response.data, timeout=timeout)
+            response['X-Cache'] = 'MISS'
+        return response
+
+
+class ExpandableQuerysetMixin:
+    """_summary_
+    Pairs with ExpandableFieldsMixin in core/serializers.py: when a client asks for
+    ?expand=patient,referred_to the related rows are joined in with select_related, so
+    a list of 10,000 expanded referrals is still a single query instead of 1 + 3 x 10,000.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, 'get_expanded_field_names'):
+            expanded = serializer_class.get_expanded_field_names(self.request)
+            if expanded:
+                queryset = queryset.select_related(*expanded)
+        return queryset
+
+
+class StreamingListMixin:
+    """_summary_
+    Opt-in streaming for list endpoints. Adding ?stream=json (a normal JSON array) or
+    ?stream=ndjson (one JSON object per line) to any list url sends the rows as they are
+    read from a server-side cursor (queryset.iterator) instead of building the whole list
+    in memory first, so worker memory stays flat however big the table gets.
+    Filters work exactly as they do on the normal list endpoint.
+    """
+    stream_query_param = 'stream'
+    stream_chunk_size = 2000  # rows fetched from the database cursor per round trip
+    stream_formats = {
+        'json': 'application/json',
+        'ndjson': 'application/x-ndjson',
+    }
+    # (opening, separator between rows, end of every row, closing) of each format
+    stream_framing = {
+        'json': ('[', ',', '', ']'),
+        'ndjson': ('', '', '\n', ''),
+    }
+
+    def list(self, request, *args, **kwargs):
+        stream_format = request.query_params.get(self.stream_query_param)
+        if stream_format not in self.stream_formats:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(
+            self.stream_rows(queryset, stream_format),
+            content_type=self.stream_formats[stream_format],
+        )
+
+    def stream_rows(self, queryset, stream_format):
+        encode, (opening, separator, row_end, closing) = self.row_encoder(), self.stream_framing[stream_format]
+        if opening:
+            yield opening
+        before = ''
+        for instance in queryset.iterator(chunk_size=self.stream_chunk_size):
+            yield before + encode(instance) + row_end
+            before = separator
+        if closing:
+            yield closing
+
+    async def alist(self, request, *args, **kwargs):
+        stream_format = request.query_params.get(self.stream_query_param)
+        if stream_format not in self.stream_formats:
+            return await super().alist(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(
+            self.astream_rows(queryset, stream_format),
+            content_type=self.stream_formats[stream_format],
+        )
+
+    async def astream_rows(self, queryset, stream_format):
+        # stream_rows for the async read path (AsyncReadMixin), rows come from queryset.aiterator()
+        encode, (opening, separator, row_end, closing) = self.row_encoder(), self.stream_framing[stream_format]
+        if opening:
+            yield opening
+        before = ''
+        async for instance in queryset.aiterator(chunk_size=self.stream_chunk_size):
+            yield before + encode(instance) + row_end
+            before = separator
+        if closing:
+            yield closing
+
+    def row_encoder(self):
+        # orjson when installed, like the normal responses (api/renderers.py)
+        serializer = self.get_serializer()
+        return lambda instance: renderers.dumps(serializer.to_representation(instance)).decode()
+
+
+class AsyncReadMixin:
+    """_summary_
+    Serves list and retrieve from coroutines when settings.API_ASYNC_READS is on and the app runs
+    under asgi.py: rows are read with the async ORM (aget, async for, aiterator) so a slow query
+    waits on the event loop instead of holding a worker. Authentication, permissions and throttling
+    still run as usual (in a thread, they may query the database), every other action is the normal
+    sync view. Goes right before viewsets.ModelViewSet, the other mixins add their own alist/aretrieve.
+    """
+    async_actions = ('list', 'retrieve')
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super().as_view(actions, **initkwargs)
+        if not settings.API_ASYNC_READS or not set(cls.async_actions) & set(actions.values()):
+            return view
+        sync_view = sync_to_async(view)
+
+        async def async_view(request, *args, **kwargs):
+            # same setup as ViewSetMixin.as_view's view()
+            if 'get' in actions and 'head' not in actions:
+                actions['head'] = actions['get']
+            if actions.get(request.method.lower()) not in cls.async_actions:
+                return await sync_view(request, *args, **kwargs)
+
+            self = cls(**initkwargs)
+            self.action_map = actions
+            for method, action in actions.items():
+                setattr(self, method, getattr(self, action))
+            self.request = request
+            self.args = args
+            self.kwargs = kwargs
+            return await self.adispatch(request, *args, **kwargs)
+
+        # keeps cls, initkwargs, actions and csrf_exempt that the router and middleware look for
+        return update_wrapper(async_view, view)
+
+    async def adispatch(self, request, *args, **kwargs):
+        # APIView.dispatch with an awaited handler
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            response = await getattr(self, f'a{self.action}')(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = None
+        if self.paginator is not None:
+            if hasattr(self.paginator, 'apaginate_queryset'):
+                page = await self.paginator.apaginate_queryset(queryset, request, view=self)
+            else:
+                page = await sync_to_async(self.paginator.paginate_queryset)(queryset, request, view=self)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        instances = [instance async for instance in queryset]
+        serializer = self.get_serializer(instances, many=True)
+        return Response(serializer.data)
+
+    async def aretrieve(self, request, *args, **kwargs):
+        instance = await self.aget_object()
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
+
+    async def aget_object(self):
+        # GenericAPIView.get_object with queryset.aget
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            instance = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except (queryset.model.DoesNotExist, TypeError, ValueError, DjangoValidationError):
+            raise Http404(f'No {queryset.model._meta.object_name} matches the given query.')
+        await sync_to_async(self.check_object_permissions)(self.request, instance)
+        return instance
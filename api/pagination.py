@@ -0,0 +1,135 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+# This module holds the pagination used by the list endpoints in api/views.py
+
+
+class KeysetPagination(BasePagination):
+    """_summary_
+    Keyset (a.k.a. seek) pagination. Instead of OFFSET, every page is fetched with a
+    WHERE clause that continues right after the last row of the previous page, e.g.
+    WHERE (referral_date, id) > ('2024-05-01', 812) ORDER BY referral_date, id LIMIT 100
+    so page 10,000 costs the same as page 1 and rows inserted while a client is paging
+    never shift or duplicate results.
+
+    The ordering comes from the viewset's `keyset_ordering` attribute and must end in a
+    unique column (the primary key) so that cursors are stable.
+
+    Pagination is opt-in: clients that send neither `cursor` nor `page_size` keep
+    getting the plain list they always got.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = api_settings.PAGE_SIZE or 100
+    max_page_size = 1000
+    default_ordering = ('id',)
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page_queryset = self.get_page_queryset(queryset, request, view)
+        if page_queryset is None:
+            return None
+        return self.set_page(list(page_queryset))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        # paginate_queryset for the async read path (AsyncReadMixin in api/mixins.py)
+        page_queryset = self.get_page_queryset(queryset, request, view)
+        if page_queryset is None:
+            return None
+        return self.set_page([row async for row in page_queryset])
+
+    def get_page_queryset(self, queryset, request, view):
+        self.request = request
+        if (self.cursor_query_param not in request.query_params
+                and self.page_size_query_param not in request.query_params):
+            return None
+
+        self.ordering = tuple(getattr(view, 'keyset_ordering', self.default_ordering))
+        self.page_size = self.get_page_size(request)
+        queryset = queryset.order_by(*self.ordering)
+
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self.build_seek_filter(position))
+
+        # fetch one extra row to know whether there is a next page without a COUNT(*)
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, rows):
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def build_seek_filter(self, position):
+        # (a, b, c) > (x, y, z)  ==  a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        seek = Q()
+        for index, field in enumerate(self.ordering):
+            clause = Q(**{f'{field}__gt': position[index]})
+            for previous, value in zip(self.ordering[:index], position[:index]):
+                clause &= Q(**{previous: value})
+            seek |= clause
+        return seek
+
+    def encode_cursor(self, instance):
+        values = [getattr(instance, field) for field in self.ordering]
+        raw = json.dumps(values, default=str, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            # convert the json values back into python values (dates etc.) through the model fields
+            return [model._meta.get_field(field).to_python(value)
+                    for field, value in zip(self.ordering, values)]
+        except (TypeError, ValueError, UnicodeDecodeError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.page_size_query_param, self.page_size)
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_first_link(self):
+        return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'first': self.get_first_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'first': {'type': 'string', 'format': 'uri'},
+                'results': schema,
+            },
+        }
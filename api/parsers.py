@@ -0,0 +1,24 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+
+from .renderers import FastJSONRenderer, loads
+
+
+class FastJSONParser(JSONParser):
+    """_summary_
+    JSONParser that decodes request bodies with orjson when it is installed (see api/renderers.py),
+    the json module otherwise. Like DRF's parser (STRICT_JSON) it refuses NaN and Infinity.
+    """
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        body = stream.read() if stream is not None else b''
+        try:
+            if encoding.lower().replace('_', '-') not in ('utf-8', 'utf8'):
+                body = body.decode(encoding)
+            return loads(body)
+        except ValueError as exc:  # also UnicodeDecodeError and orjson.JSONDecodeError
+            raise ParseError('JSON parse error - %s' % str(exc))
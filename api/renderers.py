@@ -0,0 +1,71 @@
+import json
+
+from rest_framework import renderers
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.json import strict_constant
+
+from core import metrics
+
+try:
+    import orjson  # optional, several times faster than the json module on big lists
+except ImportError:
+    orjson = None
+
+# JSON encoding for the api (see DEFAULT_RENDERER_CLASSES in settings.py). application/json responses
+# are rendered by FastJSONRenderer: orjson when it is installed, otherwise the json module exactly like
+# DRF. DRF's own renderer stays available with ?format=drfjson. The output is the same either way: compact,
+# utf-8, datetimes in UTC ending in Z, and anything orjson doesn't know natively (Decimal, timedelta,
+# lazy translations, querysets, ...) converted the way DRF's JSONEncoder does it.
+# Request bodies, streamed lists and the other places that call dumps()/loads() use orjson directly.
+
+ORJSON_OPTIONS = (orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+_encoder = JSONEncoder()
+
+
+def dumps(data):
+    """data as compact utf-8 JSON bytes, with orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=_encoder.default, option=ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            pass  # e.g. an integer above 64 bits, the json module has no such limit
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode()
+
+
+def loads(data):
+    """Parse JSON bytes or str, with orjson when it is installed. Raises ValueError on invalid JSON,
+    NaN and Infinity included (orjson never accepts them)."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data, parse_constant=strict_constant)
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """DRF's JSONRenderer, with its time counted as render in the request metrics. Only picked with
+    ?format=drfjson, FastJSONRenderer answers Accept: application/json (same bytes)."""
+    format = 'drfjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with metrics.timer('render'):
+            return self.render_json(data, accepted_media_type, renderer_context)
+
+    def render_json(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """_summary_
+    JSONRenderer that encodes with orjson when it is installed, the default for application/json and
+    ?format=json (same bytes as DRF's renderer). Falls back to DRF for what orjson can't do: pretty
+    printing (Accept: application/json; indent=4) and a missing orjson.
+    """
+    format = 'json'
+
+    def render_json(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if orjson is None or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render_json(data, accepted_media_type, renderer_context)
+        # same escaping as JSONRenderer, keeps the output a strict javascript subset
+        return dumps(data).replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
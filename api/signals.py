@@ -0,0 +1,56 @@
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from core.signals import bulk_created, bulk_updated
+
+from . import authentication, cache
+
+# Keeps the response cache (api/cache.py) in step with the database.
+# Connected when the app loads, see ApiConfig.ready()
+
+
+def is_core_model(model):
+    return model._meta.app_label == 'core'
+
+
+@receiver(post_save)
+@receiver(post_delete)
+@receiver(bulk_created)
+@receiver(bulk_updated)
+def invalidate_cached_responses(sender, **kwargs):
+    if is_core_model(sender):
+        # once the write is visible, see api/cache.py
+        transaction.on_commit(partial(cache.invalidate, sender))
+
+
+# Keeps the authentication cache (api/authentication.py) in step with the users.
+
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def remember_credentials(sender, instance, raw=False, update_fields=None, **kwargs):
+    instance._auth_previous = None
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and not set(update_fields) & set(authentication.REVOKING_FIELDS):
+        return  # e.g. the last_login update of a session login
+    instance._auth_previous = (sender.objects.filter(pk=instance.pk)
+                               .values(*authentication.REVOKING_FIELDS).first())
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def refresh_cached_user(sender, instance, created=False, raw=False, **kwargs):
+    previous = getattr(instance, '_auth_previous', None)
+    instance._auth_previous = None
+    if previous is not None and any(previous[field] != getattr(instance, field)
+                                    for field in authentication.REVOKING_FIELDS):
+        authentication.revoke(instance.pk)
+    elif not created:
+        authentication.forget(instance.pk)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def revoke_deleted_user(sender, instance, **kwargs):
+    authentication.revoke(instance.pk)
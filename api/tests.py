@@ -1,3 +1,1327 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import decimal
+import importlib
+import io
+import json
+import logging
+import os
+import re
+import runpy
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.cache import caches
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils.translation import gettext_lazy
+from django_filters import rest_framework as filters
+
+from api import authentication, cache, parsers, renderers, views
+from api.middleware import RequestMetricsMiddleware
+from core import connections, events, logs, metrics, profiling, rollups, seeding, sync
+from core.models import (Diagnostic, Equipment, Hospital, MedicalHistory, Patient, Referral, ReferralDailyStat,
+                         Tombstone, User)
+from referral_app.staticfiles import StaticFilesApplication
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+def create_rows(count):
+    """Create `count` rows of every model, each pointing at fresh related rows."""
+    first = Patient.objects.count()
+    for index in range(first, first + count):
+        sender = Hospital.objects.create(name=f'Sender {index}', type='Public')
+        receiver = Hospital.objects.create(name=f'Receiver {index}', type='Private')
+        patient = Patient.objects.create(first_name='Grace', last_name=f'Chiwaya {index}',
+                                         dob=datetime.date(1960, 1, 1), gender='Female')
+        User.objects.create(username=f'doctor{index}', hospital=receiver, role='Doctor')
+        MedicalHistory.objects.create(patient=patient, condition='Hypertension', treatment='Medication',
+                                      start_date=datetime.date(2022, 5, 1))
+        Diagnostic.objects.create(patient=patient, diagnostic_type='Blood Test', result='Normal',
+                                  date_taken=datetime.date(2022, 5, 1))
+        Equipment.objects.create(hospital=receiver, equipment_name='MRI Machine')
+        Referral.objects.create(patient=patient, referred_from=sender, referred_to=receiver,
+                                referral_reason='Specialized surgery required',
+                                referral_date=datetime.date(2022, 5, 1))
+
+
+class ListQueryCountTests(TestCase):
+    """
+    Every list endpoint has to run the same number of queries whether it returns 1 row or 5,
+    otherwise something in the serializer is querying once per row (N+1).
+    """
+    endpoints = {
+        '/api/hospitals/': 1,
+        '/api/users/': 3,  # users + prefetched groups + prefetched permissions
+        '/api/users/?expand=hospital': 3,
+        '/api/patients/': 1,
+        '/api/medical-history/': 1,
+        '/api/medical-history/?expand=patient': 1,
+        '/api/diagnostics/': 1,
+        '/api/diagnostics/?expand=patient': 1,
+        '/api/equipment/': 1,
+        '/api/equipment/?expand=hospital': 1,
+        '/api/referrals/': 1,
+        '/api/referrals/?expand=patient,referred_from,referred_to': 1,
+        '/api/referrals/?page_size=2&expand=patient,referred_to': 1,
+    }
+
+    def assertQueryCountIsConstant(self, url, expected):
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):  # the response cache is invalidated on commit
+                create_rows(3)
+            with self.subTest(url=url, rows=Referral.objects.count()), self.assertNumQueries(expected):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+
+    def test_list_endpoints_run_a_fixed_number_of_queries(self):
+        for url, expected in self.endpoints.items():
+            self.assertQueryCountIsConstant(url, expected)
+
+    def test_expanded_fields_are_nested_objects(self):
+        create_rows(1)
+        referral = self.client.get('/api/referrals/?expand=patient,referred_to').json()[0]
+        self.assertEqual(referral['patient']['last_name'], 'Chiwaya 0')
+        self.assertEqual(referral['referred_to']['name'], 'Receiver 0')
+        self.assertIsInstance(referral['referred_from'], int)
+
+    def test_writes_with_expand_take_ids_and_answer_nested_objects(self):
+        create_rows(1)
+        patient = Patient.objects.get()
+        body = {'patient': patient.id, 'condition': 'Asthma', 'treatment': 'Inhaler', 'start_date': '2024-03-01'}
+        response = self.client.post('/api/medical-history/?expand=patient', body, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['patient']['id'], patient.id)
+        history = MedicalHistory.objects.get(condition='Asthma')
+        response = self.client.patch(f'/api/medical-history/{history.id}/?expand=patient', {'treatment': 'Steroids'},
+                                     content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['patient']['last_name']), (200, patient.last_name))
+
+    def test_unknown_expand_fields_are_ignored(self):
+        create_rows(1)
+        referral = self.client.get('/api/referrals/?expand=status,nonsense').json()[0]
+        self.assertEqual(referral['status'], 'Pending')
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        create_rows(4)  # four referrals on the same day
+        patient, hospital = Patient.objects.first(), Hospital.objects.first()
+        for day in (3, 1, 3, 2, 1):
+            Referral.objects.create(patient=patient, referred_from=hospital, referred_to=hospital,
+                                    referral_reason='Needs dialysis', referral_date=datetime.date(2022, 5, day))
+
+    def walk(self, url):
+        pages, ids = 0, []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in response.json()['results']]
+            url, pages = response.json()['next'], pages + 1
+        return pages, ids
+
+    def test_every_row_is_seen_once_in_order_when_sort_keys_tie(self):
+        pages, ids = self.walk('/api/referrals/?page_size=2')
+        expected = list(Referral.objects.order_by('referral_date', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 5)
+        # filters carry over to the next pages
+        self.assertEqual(self.walk('/api/referrals/?page_size=1&referral_date=2022-05-03')[1],
+                         list(Referral.objects.filter(referral_date='2022-05-03').order_by('id').values_list('id', flat=True)))
+
+    def test_tampered_cursors_are_not_found(self):
+        for cursor in ('nonsense', 'WyIyMDIyLTA1LTAxIl0=', 'WyJub3QtYS1kYXRlIiwxXQ=='):  # [date], ["not-a-date",1]
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/api/referrals/', {'cursor': cursor}).status_code, 404)
+
+    def test_unpaginated_lists_are_unchanged(self):
+        self.assertEqual(len(self.client.get('/api/referrals/').json()), Referral.objects.count())
+
+
+class StreamingListTests(TestCase):
+
+    def setUp(self):
+        create_rows(3)
+
+    def stream(self, query):
+        response = self.client.get(f'/api/referrals/?{query}')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response['Content-Type'], b''.join(response.streaming_content).decode()
+
+    def test_json_stream_is_the_same_array_as_the_list(self):
+        content_type, body = self.stream('stream=json&status=Pending')
+        self.assertEqual(content_type, 'application/json')
+        self.assertEqual(json.loads(body), self.client.get('/api/referrals/?status=Pending').json())
+        self.assertEqual(self.stream('stream=json&status=Accepted')[1], '[]')
+
+    def test_ndjson_stream_has_one_object_per_line(self):
+        content_type, body = self.stream('stream=ndjson')
+        self.assertEqual(content_type, 'application/x-ndjson')
+        self.assertTrue(body.endswith('\n'))
+        self.assertEqual([json.loads(line) for line in body.splitlines()], self.client.get('/api/referrals/').json())
+        self.assertEqual(self.stream('stream=ndjson&status=Accepted')[1], '')
+
+
+class PatientDossierTests(TestCase):
+
+    def setUp(self):
+        create_rows(1)
+        self.patient = Patient.objects.get()
+        for _ in range(3):
+            Referral.objects.create(patient=self.patient, referred_from=Hospital.objects.first(),
+                                    referred_to=Hospital.objects.last(), referral_reason='Needs dialysis',
+                                    referral_date=datetime.date(2023, 1, 1))
+        self.url = f'/api/patients/{self.patient.id}/dossier/'
+
+    def test_dossier_is_built_from_a_fixed_number_of_queries(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.json()['referrals']), 4)
+        self.assertEqual(response.json()['referrals'][0]['referred_to']['name'], 'Receiver 0')
+
+    def test_matching_etag_returns_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Diagnostic.objects.create(patient=self.patient, diagnostic_type='Chest X-ray', result='Clear',
+                                  date_taken=datetime.date(2023, 2, 1))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_follows_every_row_of_the_dossier(self):
+        changes = [
+            lambda: Hospital.objects.last().save(),  # a hospital of the referrals
+            lambda: MedicalHistory.objects.get().delete(),
+            lambda: Referral.objects.filter(patient=self.patient).first().delete(),
+            lambda: Patient.objects.get(pk=self.patient.pk).save(),
+        ]
+        etags = [self.client.get(self.url)['ETag']]
+        for change in changes:
+            change()
+            etags.append(self.client.get(self.url)['ETag'])
+        self.assertEqual(len(set(etags)), len(etags))
+        # another patient's rows leave it alone
+        create_rows(1)
+        self.assertEqual(self.client.get(self.url)['ETag'], etags[-1])
+        self.assertEqual(self.client.get('/api/patients/999999/dossier/').status_code, 404)
+
+
+class CachedResponseTests(TestCase):
+
+    def setUp(self):
+        cache.get_cache().clear()
+        create_rows(2)
+        self.hospital = Hospital.objects.first()
+
+    def cache_status(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['X-Cache']
+
+    def test_responses_are_served_from_the_cache_until_a_write_commits(self):
+        url = f'/api/hospitals/{self.hospital.id}/'
+        self.assertEqual([self.cache_status(url), self.cache_status(url)], ['MISS', 'HIT'])
+        self.assertEqual(self.cache_status('/api/hospitals/?type=Public'), 'MISS')
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.hospital.name = 'Kamuzu Central'
+            self.hospital.save()
+            # not committed yet: a concurrent read still sees the old row, which may stay cached
+            self.assertEqual(self.cache_status(url), 'HIT')
+        for callback in callbacks:
+            callback()
+        response = self.client.get(url)
+        self.assertEqual((response['X-Cache'], response.json()['name']), ('MISS', 'Kamuzu Central'))
+
+    def test_bulk_writes_and_related_rows_invalidate(self):
+        url = '/api/equipment/?expand=hospital'
+        self.cache_status(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/hospitals/', data=[{'name': 'Nkhoma', 'type': 'Private'}], content_type='application/json')
+        # equipment embeds hospitals
+        self.assertEqual(self.cache_status(url), 'MISS')
+        with self.captureOnCommitCallbacks(execute=True):
+            Referral.objects.first().save()
+        self.assertEqual(self.cache_status(url), 'HIT')
+
+    def test_an_evicted_generation_never_comes_back_to_old_entries(self):
+        url = '/api/hospitals/'
+        self.cache_status(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            Hospital.objects.create(name='Nkhoma', type='Private')
+        self.assertEqual(self.cache_status(url), 'MISS')
+        # what culling does to the generation keys
+        cache.get_cache().delete_many([cache.generation_key(Hospital)])
+        self.assertEqual(self.cache_status(url), 'MISS')
+        self.assertEqual(self.cache_status(url), 'HIT')
+
+
+class BulkIngestTests(TestCase):
+
+    def patient(self, name, **fields):
+        return {'first_name': 'Grace', 'last_name': name, 'dob': '1960-01-01', 'gender': 'Female', **fields}
+
+    def post(self, url, body, content_type='application/json'):
+        response = self.client.post(url, data=body, content_type=content_type)
+        return response.status_code, response.json()
+
+    def test_rows_are_created_and_failures_reported_by_row(self):
+        rows = [self.patient('Banda'), self.patient('Phiri', gender='Unknown'), 'not an object',
+                self.patient('Mwale', dob='yesterday'), self.patient('Chirwa')]
+        status_code, report = self.post('/api/patients/bulk/?chunk_size=2', rows)
+        self.assertEqual(status_code, 207)
+        self.assertEqual((report['created'], report['failed']), (2, 3))
+        self.assertEqual([(row['row'], row['status']) for row in report['rows']],
+                         [(0, 'created'), (1, 'failed'), (2, 'failed'), (3, 'failed'), (4, 'created')])
+        self.assertEqual(list(report['rows'][1]['errors']), ['gender'])
+        self.assertEqual(report['rows'][2]['errors'], {'non_field_errors': ['Expected an object.']})
+        self.assertEqual(sorted(Patient.objects.values_list('last_name', flat=True)), ['Banda', 'Chirwa'])
+        self.assertEqual(Patient.objects.get(last_name='Chirwa').id, report['rows'][4]['id'])
+
+        self.assertEqual(self.post('/api/patients/bulk/', [self.patient('Tembo')])[0], 201)
+        self.assertEqual(self.post('/api/patients/bulk/', {'first_name': 'Grace'})[0], 400)
+
+    def test_ndjson_bodies_are_read_line_by_line(self):
+        lines = [json.dumps(self.patient('Banda')), '', '{"first_name": ', json.dumps(self.patient('Phiri')), '[1, 2]']
+        status_code, report = self.post('/api/patients/bulk/', '\n'.join(lines) + '\n', content_type='application/x-ndjson')
+        self.assertEqual(status_code, 207)
+        # blank lines don't count as rows
+        self.assertEqual([(row['row'], row['status']) for row in report['rows']],
+                         [(0, 'created'), (1, 'failed'), (2, 'created'), (3, 'failed')])
+        self.assertTrue(report['rows'][1]['errors']['non_field_errors'][0].startswith('Invalid JSON'))
+        self.assertEqual(Patient.objects.count(), 2)
+
+    def test_a_chunk_the_database_refuses_is_retried_row_by_row(self):
+        hospital = Hospital.objects.create(name='Kamuzu Central', type='Public')
+        user = lambda name: {'username': name, 'password': 'secret-pass', 'hospital': hospital.id, 'role': 'Doctor'}
+        # both "banda" rows pass validation, the unique index refuses the second one
+        rows = [user('banda'), user('phiri'), user('banda'), user('mwale')]
+        with self.assertLogs('api.bulk', 'ERROR') as logged:
+            status_code, report = self.post('/api/users/bulk/?chunk_size=3', rows)
+        self.assertIn('retrying row by row', logged.output[0])
+        self.assertEqual(status_code, 207)
+        self.assertEqual([(row['row'], row['status']) for row in report['rows']],
+                         [(0, 'created'), (1, 'created'), (2, 'failed'), (3, 'created')])
+        self.assertIn('UNIQUE', report['rows'][2]['errors']['non_field_errors'][0].upper())
+        # the failed bulk INSERT left nothing behind, every row is there once
+        self.assertEqual(sorted(User.objects.values_list('username', flat=True)), ['banda', 'mwale', 'phiri'])
+        self.assertEqual({row['id'] for row in report['rows'] if row['status'] == 'created'},
+                         set(User.objects.values_list('id', flat=True)))
+
+
+class UpsertTests(TestCase):
+
+    def setUp(self):
+        self.grace = Patient.objects.create(first_name='Grace', last_name='Banda', dob=datetime.date(1960, 1, 1),
+                                            gender='Female', contact_info='0888 000 111')
+        self.other = Patient.objects.create(first_name='John', last_name='Phiri', dob=datetime.date(1970, 2, 2),
+                                            gender='Male')
+
+    def patient(self, first_name, last_name, dob, **fields):
+        return {'first_name': first_name, 'last_name': last_name, 'dob': dob, 'gender': 'Female', **fields}
+
+    def upsert(self, rows, query=''):
+        response = self.client.post(f'/api/patients/upsert/{query}', data=rows, content_type='application/json')
+        return response.status_code, response.json()
+
+    def counts(self, report):
+        return {name: report[name] for name in ('inserted', 'updated', 'unchanged', 'duplicates', 'failed')}
+
+    def test_new_rows_are_inserted_and_existing_ones_updated_on_the_natural_key(self):
+        status_code, report = self.upsert([
+            self.patient('Grace', 'Banda', '1960-01-01', contact_info='0999 222 333'),
+            self.patient('John', 'Phiri', '1970-02-02', gender='Male'),
+            self.patient('Mercy', 'Mwale', '1985-03-03'),
+        ])
+        self.assertEqual(status_code, 200)
+        self.assertEqual(self.counts(report), {'inserted': 1, 'updated': 1, 'unchanged': 1, 'duplicates': 0, 'failed': 0})
+        self.grace.refresh_from_db()
+        self.assertEqual(self.grace.contact_info, '0999 222 333')
+        self.assertEqual(Patient.objects.count(), 3)
+        # sent again, nothing changes
+        self.assertEqual(self.counts(self.upsert([self.patient('Mercy', 'Mwale', '1985-03-03')])[1])['unchanged'], 1)
+
+    def test_the_last_of_duplicate_keys_wins(self):
+        _, report = self.upsert([self.patient('Grace', 'Banda', '1960-01-01', contact_info='first'),
+                                 self.patient('Grace', 'Banda', '1960-01-01', contact_info='second')])
+        self.assertEqual(self.counts(report), {'inserted': 0, 'updated': 1, 'unchanged': 0, 'duplicates': 1, 'failed': 0})
+        self.grace.refresh_from_db()
+        self.assertEqual(self.grace.contact_info, 'second')
+
+    def test_rows_without_a_key_value_fail_instead_of_matching_each_other(self):
+        _, report = self.upsert([self.patient('Grace', 'Banda', None), self.patient('Ruth', 'Banda', None),
+                                 {'first_name': 'Esther', 'gender': 'Female', 'dob': '1990-01-01'}],
+                                query='?on=last_name,dob')
+        self.assertEqual(self.counts(report), {'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0, 'failed': 3})
+        self.assertEqual([list(error['errors']) for error in report['errors']], [['dob'], ['dob'], ['last_name']])
+        self.assertEqual(Patient.objects.count(), 2)
+
+    def test_only_required_fields_can_be_matched_on(self):
+        for query in ('?on=contact_info', '?on=first_name,nonsense', '?on=,'):
+            with self.subTest(query=query):
+                status_code, report = self.upsert([self.patient('Grace', 'Banda', '1960-01-01')], query)
+                self.assertEqual(status_code, 400)
+                self.assertIn('on', report)
+        _, report = self.upsert([self.patient('Grace', 'Banda', '1960-01-01', contact_info='on the key')], '?on=last_name,dob')
+        self.assertEqual(report['updated'], 1)
+        response = self.client.post('/api/hospitals/upsert/?on=contact_info', data=[], content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class BatchValidationTests(TestCase):
+
+    def setUp(self):
+        create_rows(2)
+        self.patients = list(Patient.objects.values_list('id', flat=True))
+        self.hospitals = list(Hospital.objects.values_list('id', flat=True))
+
+    def referral_rows(self, count):
+        return [{'patient': self.patients[index % 2], 'referred_from': self.hospitals[0],
+                 'referred_to': self.hospitals[index % 4], 'referral_reason': 'Needs dialysis',
+                 'referral_date': f'2024-01-{1 + index % 28:02d}', 'status': 'Pending'}
+                for index in range(count)]
+
+    def test_foreign_keys_are_resolved_once_per_model(self):
+        for count in (10, 200):
+            rows = self.referral_rows(count)
+            rows[3]['patient'] = 999999
+            # one IN query for patients and one for hospitals, whatever the batch size
+            with self.subTest(count=count), self.assertNumQueries(2):
+                response = self.client.post('/api/referrals/', data=rows, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()[3], {'patient': ['Invalid pk "999999" - object does not exist.']})
+            self.assertEqual(response.json()[4], {})
+
+    def test_invalid_choices_and_dates_are_reported_by_row(self):
+        rows = self.referral_rows(5)
+        rows[1]['status'] = 'Maybe'
+        rows[2]['referral_date'] = 'yesterday'
+        errors = self.client.post('/api/referrals/', data=rows, content_type='application/json').json()
+        self.assertEqual(list(errors[1]), ['status'])
+        self.assertEqual(list(errors[2]), ['referral_date'])
+        self.assertEqual(errors[0], {})
+
+
+class BulkUpdateTests(TestCase):
+
+    def setUp(self):
+        create_rows(3)
+        self.first, self.second, self.third = Referral.objects.order_by('id')
+
+    def bulk_update(self, body):
+        response = self.client.patch('/api/referrals/bulk-update/', data=body, content_type='application/json')
+        return response.status_code, response.json()
+
+    def statuses(self):
+        return list(Referral.objects.order_by('id').values_list('status', flat=True))
+
+    def test_changes_are_applied_to_every_id(self):
+        status_code, report = self.bulk_update({'ids': [self.first.id, self.second.id], 'status': 'Accepted',
+                                                'expected_status': 'Pending'})
+        self.assertEqual((status_code, report), (200, {'updated': 2, 'failed': 0, 'errors': []}))
+        self.assertEqual(self.statuses(), ['Accepted', 'Accepted', 'Pending'])
+        self.assertIsNotNone(Referral.objects.get(pk=self.first.id).decision_date)
+
+    def test_transitions_not_allowed_are_rejected(self):
+        Referral.objects.filter(pk=self.first.id).update(status='Rejected')
+        status_code, report = self.bulk_update([{'id': self.first.id, 'status': 'Accepted'},
+                                                {'id': self.second.id, 'status': 'Rejected'}])
+        self.assertEqual((status_code, report['updated'], report['failed']), (207, 1, 1))
+        self.assertEqual(report['errors'], [{'index': 0, 'id': self.first.id, 'errors': {
+            'status': ['Cannot change status from "Rejected" to "Accepted".']}}])
+        self.assertEqual(self.statuses(), ['Rejected', 'Rejected', 'Pending'])
+
+    def test_a_row_that_moved_on_is_a_conflict(self):
+        # another clerk accepted it after this client loaded it as Pending
+        Referral.objects.filter(pk=self.second.id).update(status='Accepted')
+        status_code, report = self.bulk_update({'ids': [self.second.id, self.third.id], 'status': 'Rejected',
+                                                'expected_status': 'Pending'})
+        self.assertEqual((status_code, report['updated']), (207, 1))
+        [error] = report['errors']
+        self.assertEqual((error['index'], error['id'], list(error['errors'])), (0, self.second.id, ['expected_status']))
+        self.assertIn('Conflict', error['errors']['expected_status'][0])
+        self.assertEqual(self.statuses(), ['Pending', 'Accepted', 'Rejected'])
+
+    def test_unknown_and_missing_ids_are_reported(self):
+        status_code, report = self.bulk_update([{'id': 999999, 'status': 'Accepted'}, {'status': 'Accepted'},
+                                                {'id': 'three', 'status': 'Accepted'},
+                                                {'id': self.third.id, 'status': 'Maybe'}])
+        self.assertEqual((status_code, report['updated'], report['failed']), (207, 0, 4))
+        self.assertEqual([(error['index'], error['id'], list(error['errors'])) for error in report['errors']],
+                         [(0, 999999, ['id']), (1, None, ['id']), (2, None, ['id']), (3, self.third.id, ['status'])])
+        self.assertEqual(self.statuses(), ['Pending'] * 3)
+        self.assertEqual(self.bulk_update({'status': 'Accepted'})[0], 400)
+
+
+class ReferralAnalyticsTests(TestCase):
+
+    def setUp(self):
+        create_rows(1)
+        self.sender, self.receiver = Hospital.objects.order_by('id')[:2]
+        patient = Patient.objects.get()
+        start = datetime.date(2024, 3, 1)
+        # decided after 2, 4, 6 and 10 days, plus one still pending
+        for days, status in ((2, 'Accepted'), (4, 'Accepted'), (6, 'Rejected'), (10, 'Accepted'), (None, 'Pending')):
+            Referral.objects.create(patient=patient, referred_from=self.sender, referred_to=self.receiver,
+                                    referral_reason='Needs dialysis', referral_date=start, status=status,
+                                    decision_date=start + datetime.timedelta(days=days) if days else None)
+
+    def stats(self, query):
+        response = self.client.get(f'/api/referrals/analytics/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_live_statistics_per_month(self):
+        row, = self.stats('group_by=referred_to&period=month&date_from=2024-01-01')
+        self.assertEqual(row['referred_to'], self.receiver.id)
+        self.assertEqual((row['total'], row['pending'], row['accepted'], row['rejected']), (5, 1, 3, 1))
+        self.assertEqual(row['acceptance_rate'], 0.75)
+        self.assertEqual(row['mean_days_to_decision'], 5.5)
+        self.assertEqual(row['median_days_to_decision'], 5)
+
+    def test_bad_filters_are_refused_by_both_sources(self):
+        for source in ('live', 'rollup'):
+            for query, field in (('referred_to=abc', 'referred_to'), ('referred_from=1x', 'referred_from'),
+                                 ('status=Lost', 'status')):
+                with self.subTest(source=source, query=query):
+                    response = self.client.get(f'/api/referrals/analytics/?source={source}&{query}')
+                    self.assertEqual(response.status_code, 400)
+                    self.assertIn(field, response.json())
+        rollup = self.stats(f'source=rollup&referred_to={self.receiver.id}&status=Accepted')
+        self.assertEqual(sum(row['total'] for row in rollup), 3)
+
+    def test_rollup_matches_live_statistics(self):
+        rollup = self.stats('group_by=referred_to,status&source=rollup')
+        live = self.stats('group_by=referred_to,status')
+        for row in live:
+            del row['median_days_to_decision']
+        self.assertEqual(rollup, live)
+
+    def test_decisions_update_the_rollup(self):
+        pending = Referral.objects.get(status='Pending', referral_date__year=2024)
+        response = self.client.patch('/api/referrals/bulk-update/', data={'ids': [pending.id], 'status': 'Rejected'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        incremental = self.stats('source=rollup&date_from=2024-01-01')
+        self.assertEqual((incremental[0]['pending'], incremental[0]['rejected']), (0, 2))
+        # the incrementally kept table ends up the same as one rebuilt from scratch
+        rollups.rebuild()
+        self.assertEqual(self.stats('source=rollup&date_from=2024-01-01'), incremental)
+
+    def test_a_batch_is_added_to_the_rollup_by_one_statement_in_its_transaction(self):
+        rows = [{'patient': Patient.objects.get().id, 'referred_from': self.sender.id, 'referred_to': hospital.id,
+                 'referral_reason': 'Needs dialysis', 'referral_date': f'2024-04-{1 + index % 5:02d}'}
+                for index, hospital in enumerate([self.sender, self.receiver] * 10)]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.post('/api/referrals/', data=rows, content_type='application/json').status_code, 201)
+        self.assertEqual(len([query for query in queries if 'core_referraldailystat' in query['sql']]), 1)
+        incremental = self.stats('source=rollup&group_by=referred_to,status')
+        rollups.rebuild()
+        self.assertEqual(self.stats('source=rollup&group_by=referred_to,status'), incremental)
+
+        # a rollup that can't be written takes the referrals down with it
+        count = Referral.objects.count()
+        original, rollups.apply_deltas = rollups.apply_deltas, lambda deltas: 1 / 0
+        try:
+            with (self.assertRaises(ZeroDivisionError), self.assertLogs('api.mixins', 'ERROR'),
+                  self.assertLogs('django.request', 'ERROR')):
+                self.client.post('/api/referrals/', data=rows, content_type='application/json')
+        finally:
+            rollups.apply_deltas = original
+        self.assertEqual(Referral.objects.count(), count)
+
+    def test_the_migration_fills_the_rollup_from_existing_referrals(self):
+        backfill = importlib.import_module('core.migrations.0013_backfill_referral_rollup').backfill
+        live = self.stats('group_by=referred_to,status')
+        ReferralDailyStat.objects.all().delete()
+        backfill(django_apps, None)
+        rollup = self.stats('group_by=referred_to,status&source=rollup')
+        for row in live:
+            del row['median_days_to_decision']
+        self.assertEqual(rollup, live)
+
+    def test_invalid_parameters_are_rejected(self):
+        for query in ('group_by=patient', 'period=decade', 'date_from=soon', 'source=cache'):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(f'/api/referrals/analytics/?{query}').status_code, 400)
+
+
+class HospitalCandidateTests(TestCase):
+
+    def setUp(self):
+        self.full = Hospital.objects.create(name='Kamuzu Central', type='Public')
+        self.partial = Hospital.objects.create(name='Mwaiwathu', type='Private')
+        self.busy = Hospital.objects.create(name='Zomba Central', type='Public')
+        for hospital, name, available in ((self.full, 'MRI Machine', True), (self.full, 'MRI Machine', True),
+                                          (self.full, 'Dialysis Machine', True), (self.partial, ' mri machine', True),
+                                          (self.busy, 'MRI Machine', False), (self.busy, 'Dialysis Machine', True)):
+            Equipment.objects.create(hospital=hospital, equipment_name=name, available=available)
+
+    def candidates(self, query):
+        response = self.client.get(f'/api/hospitals/candidates/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return [(row['hospital']['id'], row['matched'], row['available_units'], row['missing'])
+                for row in response.json()['results']]
+
+    def test_only_hospitals_with_all_available_equipment_by_default(self):
+        self.assertEqual(self.candidates('equipment=mri MACHINE,Dialysis Machine'),
+                         [(self.full.id, 2, 3, [])])
+
+    def test_partial_matches_are_ranked_after_full_matches(self):
+        self.assertEqual(self.candidates('equipment=MRI Machine,Dialysis Machine&match=any&type=Public'),
+                         [(self.full.id, 2, 3, []), (self.busy.id, 1, 1, ['mri machine'])])
+
+    def test_names_are_normalized_like_the_stored_ones(self):
+        # SQLite's LOWER() leaves non-ASCII letters alone, the search has to agree with the stored names
+        Equipment.objects.create(hospital=self.partial, equipment_name=' Échographe', available=True)
+        stored = Equipment.objects.get(equipment_name=' Échographe').normalized_name
+        self.assertEqual(self.candidates('equipment=Échographe  '), [(self.partial.id, 1, 1, [])])
+        response = self.client.get('/api/hospitals/candidates/?equipment=ÉCHOGRAPHE, mri MACHINE&match=any')
+        self.assertEqual(response.json()['equipment'], Equipment.normalize_names(['ÉCHOGRAPHE', 'mri MACHINE']))
+        self.assertEqual(response.json()['results'][0]['missing'], [])
+        self.assertEqual(Equipment.normalize_names(['Échographe ']), [stored])
+
+    def test_search_is_cached_until_equipment_changes(self):
+        url = '/api/hospitals/candidates/?equipment=MRI Machine'
+        self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get(url)['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            Equipment.objects.filter(hospital=self.busy).first().save()
+        self.assertEqual(self.client.get(url)['X-Cache'], 'MISS')
+
+    def test_invalid_parameters_are_rejected(self):
+        for query in ('', 'equipment=MRI Machine&match=some', 'equipment=MRI Machine&type=Mission',
+                      'equipment=MRI Machine&limit=0'):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get(f'/api/hospitals/candidates/?{query}').status_code, 400)
+
+
+class PatientSearchTests(TestCase):
+
+    def setUp(self):
+        for first_name, last_name, contact_info in (('Grace', 'Chiwaya', '0999 123 456'), ('Chikondi', 'Banda', None),
+                                                    ('Mercy', 'Chirwa', 'mercy@example.com'),
+                                                    ('Joseph', 'Phiri', None)):
+            Patient.objects.create(first_name=first_name, last_name=last_name, contact_info=contact_info,
+                                   dob=datetime.date(1980, 1, 1), gender='Female')
+
+    def search(self, query):
+        response = self.client.get('/api/patients/search/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [f"{row['first_name']} {row['last_name']}" for row in response.json()['results']]
+
+    def test_prefix_matches_rank_first(self):
+        self.assertEqual(set(self.search('chi')[:3]), {'Grace Chiwaya', 'Chikondi Banda', 'Mercy Chirwa'})
+
+    def test_misspelled_names_are_found(self):
+        self.assertEqual(self.search('chiwya')[0], 'Grace Chiwaya')
+        self.assertEqual(self.search('Phirri')[0], 'Joseph Phiri')
+
+    def test_contact_info_and_full_names_match(self):
+        self.assertEqual(self.search('mercy@example')[0], 'Mercy Chirwa')
+        self.assertEqual(self.search('grace chiw'), ['Grace Chiwaya'])
+
+    def test_index_follows_updates_and_deletes(self):
+        patient = Patient.objects.get(last_name='Phiri')
+        patient.last_name = 'Mwale'
+        patient.save()
+        self.assertNotIn('Joseph Phiri', self.search('phiri'))
+        self.assertEqual(self.search('mwale'), ['Joseph Mwale'])
+        patient.delete()
+        self.assertEqual(self.search('mwale'), [])
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get('/api/patients/search/').status_code, 400)
+
+
+class ClinicalSearchTests(TestCase):
+
+    def setUp(self):
+        create_rows(2)
+        self.first, self.second = Patient.objects.order_by('id')
+        Diagnostic.objects.create(patient=self.first, diagnostic_type='Chest X-ray', date_taken=datetime.date(2024, 8, 2),
+                                  result='Cavitating lesion in the upper lobe, suspected TB', notes='Sputum sent for GeneXpert')
+        Diagnostic.objects.create(patient=self.second, diagnostic_type='Chest X-ray', date_taken=datetime.date(2023, 1, 5),
+                                  result='Suspected TB, bilateral infiltrates')
+        MedicalHistory.objects.create(patient=self.second, condition='Tuberculosis', treatment='RHZE',
+                                      start_date=datetime.date(2023, 2, 1), notes='Completed intensive phase, suspected TB relapse ruled out')
+
+    def search(self, query):
+        response = self.client.get('/api/search/?' + query)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_every_word_must_match_and_words_are_highlighted(self):
+        results = self.search('q=suspected tb chest x-ray')
+        self.assertEqual([hit['kind'] for hit in results], ['diagnostic', 'diagnostic'])
+        for hit in results:
+            self.assertIn('<mark>suspected</mark> <mark>tb</mark>', hit['snippet'].lower())
+
+    def test_filters_by_date_patient_and_type(self):
+        hits = self.search('q=suspected tb&date_from=2024-07-01&date_to=2024-09-30')
+        self.assertEqual([(hit['kind'], hit['patient'], hit['day']) for hit in hits],
+                         [('diagnostic', self.first.id, '2024-08-02')])
+        hits = self.search(f'q=suspected tb&patient={self.second.id}&type=medical_history')
+        self.assertEqual([hit['kind'] for hit in hits], ['medical_history'])
+
+    def test_hospital_filter_follows_referrals(self):
+        sender = Referral.objects.get(patient=self.first).referred_from
+        hits = self.search(f'q=suspected&hospital={sender.id}')
+        self.assertEqual({hit['patient'] for hit in hits}, {self.first.id})
+        self.assertEqual(self.search(f'q=surgery&hospital={sender.id}')[0]['kind'], 'referral')
+
+    def test_index_follows_edits(self):
+        diagnostic = Diagnostic.objects.get(patient=self.first, diagnostic_type='Chest X-ray')
+        diagnostic.result = 'Normal chest film'
+        diagnostic.save()
+        self.assertEqual(len(self.search('q=cavitating')), 0)
+        self.assertEqual(len(self.search('q=normal chest film')), 1)
+        diagnostic.delete()
+        self.assertEqual(len(self.search('q=normal chest film')), 0)
+
+    def test_invalid_parameters_are_rejected(self):
+        for query in ('', 'q=tb&type=notes', 'q=tb&patient=first', 'q=tb&date_to=soon'):
+            with self.subTest(query=query):
+                self.assertEqual(self.client.get('/api/search/?' + query).status_code, 400)
+
+
+class FilterQueryPlanTests(TestCase):
+    """
+    Every filter a list endpoint exposes on one of the big tables has to be answered from an index.
+    Filters are picked up from the viewsets' filterset classes, so a new one is checked automatically.
+    """
+    viewsets = [views.PatientViewSet, views.MedicalHistoryViewSet, views.DiagnosticViewSet,
+                views.EquipmentViewSet, views.ReferralViewSet]
+
+    def sample_values(self, model, name, filter):
+        if isinstance(filter, filters.BaseInFilter):
+            return ['1,2'] if isinstance(filter, filters.NumberFilter) else ['Pending,Accepted']
+        if isinstance(filter, filters.BooleanFilter):
+            return ['true', 'false']
+        if isinstance(filter, filters.NumberFilter):
+            return ['1']
+        if isinstance(filter, filters.DateFilter):
+            return ['2024-01-01']
+        choices = model._meta.get_field(filter.field_name).choices
+        return [choices[-1][0] if choices else 'x']
+
+    def plan(self, queryset):
+        if connection.vendor == 'postgresql':
+            with transaction.atomic(), connection.cursor() as cursor:
+                # with sequential scans priced out, a Seq Scan in the plan means no index could be used
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                return queryset.explain()
+        return queryset.explain()
+
+    def full_scans(self, plan):
+        if connection.vendor == 'postgresql':
+            return re.findall(r'Seq Scan on (core_\w+)', plan)
+        # sqlite: "SCAN core_referral" reads the whole table, "SCAN ... USING INDEX" only a (partial) index
+        return re.findall(r'\bSCAN (core_\w+)\s*$', plan, re.MULTILINE)
+
+    def test_exposed_filters_use_an_index(self):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            self.skipTest(f'no query plan check for {connection.vendor}')
+        for viewset in self.viewsets:
+            filterset_class = viewset.filterset_class
+            model = filterset_class._meta.model
+            for name, filter in filterset_class.base_filters.items():
+                for value in self.sample_values(model, name, filter):
+                    filterset = filterset_class({name: value}, queryset=model.objects.all())
+                    self.assertTrue(filterset.is_valid(), filterset.errors)
+                    with self.subTest(endpoint=viewset.__name__, filter=f'{name}={value}'):
+                        self.assertEqual(self.full_scans(self.plan(filterset.qs)), [])
+
+
+class SyncFeedTests(TestCase):
+
+    def setUp(self):
+        create_rows(2)
+
+    def sync(self, since, **params):
+        response = self.client.get('/api/sync/', {'since': since, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_full_download_then_only_the_delta(self):
+        feed = self.sync(0, resources='patients,referrals')
+        self.assertEqual(sorted(change['resource'] for change in feed['changes']),
+                         ['patients', 'patients', 'referrals', 'referrals'])
+        self.assertFalse(feed['has_more'])
+
+        patient = Patient.objects.order_by('id').first()
+        patient.contact_info = '0888 000 111'
+        patient.save()
+        referral = Referral.objects.order_by('id').last()
+        referral_id = referral.id
+        referral.delete()
+
+        delta = self.sync(feed['next'], resources='patients,referrals')
+        self.assertEqual([(change['resource'], change['op'], change['id']) for change in delta['changes']],
+                         [('patients', 'upsert', patient.id), ('referrals', 'delete', referral_id)])
+        self.assertEqual(delta['changes'][0]['data']['contact_info'], '0888 000 111')
+        self.assertEqual(self.sync(delta['next'])['changes'], [])
+
+    def test_pages_follow_versions(self):
+        seen, since, has_more = [], 0, True
+        while has_more:
+            feed = self.sync(since, limit=3)
+            seen += [change['version'] for change in feed['changes']]
+            since, has_more = feed['next'], feed['has_more']
+        self.assertEqual(seen, sorted(set(seen)))
+        # every row of the synced models, the users aren't part of the feed
+        self.assertEqual(len(seen), sum(model.objects.count() for model in (Hospital, Patient, MedicalHistory,
+                                                                             Diagnostic, Equipment, Referral)))
+
+    def test_bulk_writes_are_versioned(self):
+        since = self.sync(0)['next']
+        pending = list(Referral.objects.values_list('id', flat=True))
+        self.client.patch('/api/referrals/bulk-update/', data={'ids': pending, 'status': 'Accepted'},
+                          content_type='application/json')
+        self.client.post('/api/hospitals/', data=[{'name': 'Nkhoma', 'type': 'Private'}], content_type='application/json')
+        changes = self.sync(since)['changes']
+        self.assertEqual(sorted((change['resource'], change['op']) for change in changes),
+                         [('hospitals', 'upsert'), ('referrals', 'upsert'), ('referrals', 'upsert')])
+
+    def test_expired_token_must_start_over(self):
+        since = self.sync(0)['next']
+        Equipment.objects.first().delete()
+        Tombstone.objects.update(deleted_at=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual(sync.prune_tombstones(older_than_days=30), 1)
+        self.assertEqual(self.client.get('/api/sync/', {'since': since}).status_code, 410)
+        self.assertEqual(self.client.get('/api/sync/', {'since': 0}).status_code, 200)
+
+
+@override_settings(REFERRAL_EVENTS_HEARTBEAT=0.1)
+class ReferralEventsTests(TestCase):
+
+    def setUp(self):
+        create_rows(2)
+        self.referral = Referral.objects.order_by('id').first()
+        self.sender_user = User.objects.create(username='sender', hospital=self.referral.referred_from)
+        self.other_user = User.objects.exclude(hospital__in=[self.referral.referred_from, self.referral.referred_to]).first()
+
+    async def subscribe(self, user):
+        token = await sync_to_async(lambda: str(AccessToken.for_user(user)))()
+        response = await self.async_client.get('/api/referrals/events/', {'token': token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertIn(b'subscribed', await anext(stream))
+        return stream
+
+    async def disconnect(self, stream):
+        # what the ASGI handler does when the client goes away: cancel the pending read
+        pending = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        pending.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await pending
+
+    def accept_referral(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.referral.status = 'Accepted'
+            self.referral.save()
+
+    async def test_status_change_reaches_the_referring_hospital_only(self):
+        sender_stream = await self.subscribe(self.sender_user)
+        other_stream = await self.subscribe(self.other_user)
+        await sync_to_async(self.accept_referral)()
+
+        message = (await asyncio.wait_for(anext(sender_stream), 1)).decode()
+        self.assertIn('event: referral.status_changed', message)
+        self.assertIn(f'id: {self.referral.version}', message)
+        self.assertIn('"previous_status": "Pending"', message)
+        self.assertEqual(await asyncio.wait_for(anext(other_stream), 1), b': keepalive\n\n')
+        await self.disconnect(sender_stream)
+        await self.disconnect(other_stream)
+        self.assertEqual(events.get_broker().subscriber_count(), 0)
+
+    def test_rejects_missing_tokens_and_wsgi(self):
+        with self.assertLogs('django.request', 'ERROR'):  # kept out of django_error.log
+            self.assertEqual(self.client.get('/api/referrals/events/').status_code, 501)
+        response = asyncio.run(self.async_client.get('/api/referrals/events/', {'token': 'nonsense'}))
+        self.assertEqual(response.status_code, 401)
+
+    def test_bulk_created_referrals_are_published(self):
+        published = []
+        broker = events.get_broker()
+        broker.publish, original = (lambda name, message: published.append(name)), broker.publish
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/referrals/', content_type='application/json', data=[{
+                    'patient': self.referral.patient_id, 'referred_from': self.referral.referred_from_id,
+                    'referred_to': self.referral.referred_to_id, 'referral_reason': 'Needs dialysis',
+                    'referral_date': '2024-05-01'}])
+        finally:
+            broker.publish = original
+        self.assertEqual(sorted(published), sorted([events.channel(self.referral.referred_from_id),
+                                                    events.channel(self.referral.referred_to_id)]))
+
+
+@override_settings(API_ASYNC_READS=True)
+class AsyncReadTests(TestCase):
+    """The async list/retrieve (AsyncReadMixin) must answer exactly what the sync views answer."""
+
+    def setUp(self):
+        create_rows(3)
+
+    async def async_request(self, method, url, **extra):
+        match = resolve(url.partition('?')[0])
+        # the urlconf was built with the setting off, build the view again with it on
+        view = match.func.cls.as_view(dict(match.func.actions), **match.func.initkwargs)
+        self.assertTrue(asyncio.iscoroutinefunction(view))
+        response = await view(getattr(AsyncRequestFactory(), method)(url, **extra), *match.args, **match.kwargs)
+        if response.streaming:
+            return response.status_code, b''.join([chunk async for chunk in response.streaming_content])
+        response.render()
+        return response.status_code, response.content
+
+    def sync_request(self, url):
+        response = self.client.get(url)
+        return response.status_code, b''.join(response.streaming_content) if response.streaming else response.content
+
+    async def test_reads_match_the_sync_views(self):
+        referral = await Referral.objects.afirst()
+        urls = ['/api/referrals/', '/api/referrals/?status=Pending&expand=patient,referred_to',
+                '/api/referrals/?page_size=2', '/api/users/?expand=hospital', '/api/hospitals/',
+                '/api/equipment/?available=true', '/api/referrals/?stream=json', '/api/diagnostics/?stream=ndjson',
+                f'/api/referrals/{referral.id}/', f'/api/hospitals/{referral.referred_to_id}/',
+                '/api/referrals/999999/', '/api/referrals/?referral_date=not-a-date']
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(await self.async_request('get', url), await sync_to_async(self.sync_request)(url))
+
+    async def test_writes_still_go_through_the_sync_view(self):
+        referral = await Referral.objects.afirst()
+        status_code, _ = await self.async_request('patch', f'/api/referrals/{referral.id}/', data={'status': 'Accepted'},
+                                                  content_type='application/json')
+        self.assertEqual(status_code, 200)
+        await referral.arefresh_from_db()
+        self.assertEqual(referral.status, 'Accepted')
+
+
+class StaticFilesApplicationTests(TestCase):
+    """referral_app/asgi.py serves the static files itself so the middleware chain stays async."""
+
+    async def request(self, application, path, headers=()):
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http', 'method': 'GET', 'path': path, 'root_path': '', 'query_string': b'',
+            'headers': [(name.encode(), value.encode()) for name, value in headers]})
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output()
+        body = b''
+        while True:
+            message = await communicator.receive_output()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                return start['status'], dict(start['headers']), body
+
+    async def django(self, scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'django'})
+
+    async def test_static_files_are_served_in_front_of_django(self):
+        with tempfile.TemporaryDirectory() as root:
+            with open(os.path.join(root, 'app.css'), 'wb') as output:
+                output.write(b'body {}' * 20_000)  # more than one chunk
+            with override_settings(STATIC_ROOT=root, STATIC_URL='/static/'):
+                application = StaticFilesApplication(self.django)
+                status, headers, body = await self.request(application, '/static/app.css')
+                self.assertEqual((status, body), (200, b'body {}' * 20_000))
+                self.assertEqual(headers[b'content-type'], b'text/css; charset="utf-8"')
+                status, _, body = await self.request(application, '/static/app.css',
+                                                     [('if-none-match', headers[b'etag'].decode())])
+                self.assertEqual((status, body), (304, b''))
+                self.assertEqual(await self.request(application, '/api/referrals/'), (200, {}, b'django'))
+                self.assertEqual(await self.request(application, '/static/missing.css'), (200, {}, b'django'))
+
+    def test_without_whitenoise_django_adapts_no_middleware(self):
+        middleware = [path for path in settings.MIDDLEWARE if not path.startswith('whitenoise.')]
+        with override_settings(MIDDLEWARE=middleware, DEBUG=True), self.assertNoLogs('django.request', 'DEBUG'):
+            ASGIHandler()  # logs "Asynchronous handler adapted for middleware ..." for a sync only one
+        with override_settings(DEBUG=True), self.assertLogs('django.request', 'DEBUG') as logged:
+            ASGIHandler()
+        self.assertIn('whitenoise', logged.output[0])
+
+
+class DatabasePoolStatsTests(TestCase):
+
+    def test_admins_see_the_connection_counters(self):
+        self.assertEqual(self.client.get('/api/db-pool-stats/').status_code, 401)
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        stats = self.client.get('/api/db-pool-stats/').json()
+        self.assertEqual((stats['vendor'], stats['pooled']), (connection.vendor, False))
+        self.assertGreaterEqual(stats['requests'], 2)
+        self.assertIn('connections_per_request', stats)
+
+    def test_without_a_pool_the_connections_per_request_are_reported(self):
+        self.client.force_login(User.objects.create(username='admin', is_staff=True))
+        before = self.client.get('/api/db-pool-stats/').json()
+        connection_created.send(sender=connection.__class__, connection=connection)  # a reconnect during the request
+        stats = self.client.get('/api/db-pool-stats/').json()
+        self.assertIsNone(connections.get_pool('default'))
+        self.assertEqual((stats['pooled'], stats['conn_max_age'], stats['health_checks']),
+                         (False, connection.settings_dict['CONN_MAX_AGE'], connection.settings_dict['CONN_HEALTH_CHECKS']))
+        self.assertEqual((stats['requests'], stats['connections_opened']), (before['requests'] + 1, before['connections_opened'] + 1))
+        self.assertEqual(stats['connections_per_request'], round(stats['connections_opened'] / stats['requests'], 4))
+        self.assertNotIn('checkouts', stats)
+
+    def settings_with(self, **environment):
+        with mock.patch.dict(os.environ, environment):
+            return runpy.run_path(os.path.join(settings.BASE_DIR, 'referral_app', 'settings.py'))['DATABASES']['default']
+
+    def test_db_pool_configures_the_postgres_pool(self):
+        database = self.settings_with(DATABASE_URL='postgres://app:secret@db:5432/referrals', DB_POOL='True',
+                                      DB_POOL_MIN_SIZE='1', DB_POOL_MAX_SIZE='4', DB_POOL_TIMEOUT='2.5')
+        self.assertEqual(database['CONN_MAX_AGE'], 0)  # django refuses persistent connections with a pool
+        self.assertTrue(database['CONN_HEALTH_CHECKS'])
+        self.assertEqual(database['OPTIONS']['pool'], {'min_size': 1, 'max_size': 4, 'timeout': 2.5, 'max_idle': 300})
+
+    def test_db_pool_is_ignored_without_postgres_or_without_the_flag(self):
+        for environment in ({'DATABASE_URL': 'sqlite:////tmp/referrals.sqlite3', 'DB_POOL': 'True'},
+                            {'DATABASE_URL': 'postgres://app:secret@db:5432/referrals', 'DB_POOL': 'False'}):
+            with self.subTest(**environment):
+                database = self.settings_with(DB_CONN_MAX_AGE='30', **environment)
+                self.assertEqual(database['CONN_MAX_AGE'], 30)
+                self.assertNotIn('pool', database.get('OPTIONS', {}))
+
+
+class CachedAuthenticationTests(TestCase):
+
+    def setUp(self):
+        authentication.get_cache().clear()
+        hospital = Hospital.objects.create(name='Kamuzu Central Hospital', type='Public')
+        self.user = User.objects.create(username='admin', hospital=hospital, role='Doctor', is_staff=True)
+        self.user.set_password('secret-pass')
+        self.user.save()
+        self.tokens = self.client.post('/api/token/', {'username': 'admin', 'password': 'secret-pass'}).json()
+
+    def get(self, token):
+        return self.client.get('/api/cache-stats/', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def user_queries(self, token):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(token).status_code, 200)
+        return [query for query in queries if 'core_user' in query['sql']]
+
+    def test_tokens_carry_claims_and_users_come_from_the_cache(self):
+        claims = AccessToken(self.tokens['access'])
+        self.assertEqual((claims['role'], claims['hospital'], claims['is_staff']), ('Doctor', self.user.hospital_id, True))
+        self.assertEqual(len(self.user_queries(self.tokens['access'])), 1)
+        self.assertEqual(self.user_queries(self.tokens['access']), [])
+        with override_settings(AUTH_STATELESS_CLAIMS=True):
+            authentication.get_cache().clear()
+            self.assertEqual(self.user_queries(self.tokens['access']), [])
+
+    def test_deactivated_users_are_refused_at_once(self):
+        self.user_queries(self.tokens['access'])  # cached
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.get(self.tokens['access']).status_code, 401)
+        with override_settings(AUTH_STATELESS_CLAIMS=True):
+            self.assertEqual(self.get(self.tokens['access']).status_code, 401)
+
+    @override_settings(AUTH_STATELESS_CLAIMS=True)
+    def test_changed_claims_revoke_the_tokens_issued_before(self):
+        self.user.first_name = 'Grace'  # not in the token, keeps it valid
+        self.user.save()
+        self.assertEqual(self.get(self.tokens['access']).status_code, 200)
+
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(self.get(self.tokens['access']).status_code, 401)
+        self.assertEqual(self.client.post('/api/token/refresh/', {'refresh': self.tokens['refresh']}).status_code, 401)
+        # a new login gets tokens with the new claims
+        tokens = self.client.post('/api/token/', {'username': 'admin', 'password': 'secret-pass'}).json()
+        self.assertEqual(self.get(tokens['access']).status_code, 403)
+
+    def test_revocations_survive_a_full_default_cache(self):
+        self.user.is_active = False
+        self.user.save()
+        # enough entries to make the default and api caches cull (300 and API_CACHE_MAX_ENTRIES)
+        for alias in ('default', 'api'):
+            caches[alias].set_many({f'filler:{index}': index for index in range(settings.CACHES[alias].get('OPTIONS', {})
+                                                                                   .get('MAX_ENTRIES', 300) + 1)})
+        with override_settings(AUTH_STATELESS_CLAIMS=True):
+            self.assertEqual(self.get(self.tokens['access']).status_code, 401)
+        for alias in ('default', 'api'):
+            caches[alias].clear()
+
+
+class FastJSONTests(TestCase):
+
+    def test_renders_the_same_bytes_as_drf(self):
+        data = {
+            'when': datetime.datetime(2024, 5, 1, 8, 30, 15, 250, tzinfo=datetime.timezone.utc),
+            'day': datetime.date(2024, 5, 1),
+            'amount': decimal.Decimal('12.50'),
+            'wait': datetime.timedelta(minutes=90),
+            'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+            'label': gettext_lazy('Referral'),
+            'notes': 'line\u2028separator, Chichewa: Mwadzuka bwanji \u00e9',
+            7: [1.5, None, True, (1, 2)],
+            'huge': 2 ** 70,
+        }
+        self.assertEqual(renderers.FastJSONRenderer().render(data), JSONRenderer().render(data))
+        # pretty printing goes through DRF's renderer
+        self.assertEqual(renderers.FastJSONRenderer().render({'a': 1}, 'application/json; indent=2'), b'{\n  "a": 1\n}')
+
+    def test_orjson_renders_application_json_and_drf_only_when_asked(self):
+        create_rows(1)
+        url = f'/api/referrals/{Referral.objects.get().id}/'
+        for headers in ({}, {'HTTP_ACCEPT': 'application/json'}, {'HTTP_ACCEPT': '*/*'}):
+            with self.subTest(headers=headers):
+                self.assertIs(type(self.client.get(url, **headers).accepted_renderer), renderers.FastJSONRenderer)
+        self.assertIs(type(self.client.get(url, {'format': 'json'}).accepted_renderer), renderers.FastJSONRenderer)
+        fast, drf = self.client.get(url, HTTP_ACCEPT='application/json'), self.client.get(url, {'format': 'drfjson'})
+        self.assertIs(type(drf.accepted_renderer), renderers.JSONRenderer)
+        self.assertEqual((fast['Content-Type'], fast.content), (drf['Content-Type'], drf.content))
+        # the browsable api is still there for browsers
+        self.assertIn('text/html', self.client.get(url, HTTP_ACCEPT='text/html')['Content-Type'])
+
+    def test_parses_request_bodies(self):
+        self.assertEqual(parsers.FastJSONParser().parse(io.BytesIO('{"name": "Zomba Central", "beds": [1, 2]}'.encode())),
+                         {'name': 'Zomba Central', 'beds': [1, 2]})
+        for body in (b'{"beds": NaN}', b'{"name": '):
+            with self.assertRaises(ParseError):
+                parsers.FastJSONParser().parse(io.BytesIO(body))
+
+        response = self.client.post('/api/hospitals/', '{"name": "Zomba Central", "type": "Public"}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['name'], 'Zomba Central')
+        response = self.client.post('/api/hospitals/', '{"name": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(API_METRICS_TOKEN='scrape-secret')
+class RequestMetricsTests(TestCase):
+
+    def setUp(self):
+        create_rows(3)
+        metrics.registry.reset()
+
+    def test_server_timing_counts_the_queries_of_the_request(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/referrals/', {'expand': 'patient'})
+        timing = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+        self.assertEqual(list(timing), ['db', 'auth', 'serialize', 'render', 'total'])
+        self.assertIn(f'desc="{len(queries)} queries"', timing['db'])
+
+    def test_metrics_are_exposed_in_the_prometheus_format(self):
+        self.client.get('/api/referrals/')
+        self.client.get(f'/api/referrals/{Referral.objects.first().id}/')
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 401)
+        self.assertEqual(self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+
+        response = self.client.get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        labels = f'worker="{os.getpid()}",endpoint="referral-list",method="GET",action="list"'
+        self.assertIn(f'api_requests_total{{{labels},status="200"}} 1', text)
+        self.assertIn(f'api_db_queries_bucket{{{labels},le="+Inf"}} 1', text)
+        self.assertIn(f'api_serialize_duration_seconds_count{{{labels}}} 1', text)
+        self.assertIn('action="retrieve"', text)
+        self.assertIn('# TYPE api_response_size_bytes histogram', text)
+
+
+@override_settings(QUERY_PROFILER_SAMPLE_RATE=1.0, QUERY_PROFILER_REPEAT_THRESHOLD=3, QUERY_PROFILER_EXPLAIN=True,
+                   QUERY_PROFILER_CACHE_ALIAS='default')
+class QueryProfilerTests(TestCase):
+
+    def setUp(self):
+        create_rows(4)
+        profiling.clear()
+
+    def n_plus_one_view(self, request):
+        # one query per patient, what a serializer reading an unprefetched relation does
+        for patient in Patient.objects.all():
+            list(patient.referrals.all())
+        return HttpResponse('ok')
+
+    def test_reports_repeated_and_slow_queries_of_sampled_requests(self):
+        RequestMetricsMiddleware(self.n_plus_one_view)(RequestFactory().get('/patients-with-referrals/'))
+        with override_settings(QUERY_PROFILER_SLOW_MS=0), CaptureQueriesContext(connection) as queries:
+            self.client.get(f'/api/referrals/{Referral.objects.first().id}/')
+        # EXPLAIN waits for dump_query_profiles, the request only runs its own queries
+        self.assertFalse([query for query in queries if query['sql'].startswith('EXPLAIN')])
+        with override_settings(QUERY_PROFILER_SAMPLE_RATE=0):
+            self.client.get('/api/referrals/')
+
+        first, second = profiling.entries()
+        [repeated] = first['findings']
+        self.assertEqual((repeated['kind'], repeated['count']), ('repeated', 4))
+        self.assertEqual(repeated['fingerprint'], profiling.fingerprint(str(Referral.objects.filter(patient=1).query)))
+        self.assertTrue(repeated['origin'].startswith('api/tests.py:'))
+
+        self.assertEqual((second['endpoint'], second['action']), ('referral-detail', 'retrieve'))
+        slow = [finding for finding in second['findings'] if 'core_referral' in finding['sql']]
+        self.assertEqual(slow[0]['kind'], 'slow')
+        self.assertNotIn('explain', slow[0])
+        self.assertIsNotNone(slow[0]['replay'])
+
+        output = io.StringIO()
+        call_command('dump_query_profiles', '--kind', 'slow', stdout=output)
+        self.assertIn('explain:', output.getvalue())
+        self.assertIn(profiling.explain(slow[0]).splitlines()[0], output.getvalue())
+        output = io.StringIO()
+        call_command('dump_query_profiles', '--kind', 'slow', '--no-explain', stdout=output)
+        self.assertNotIn('explain:', output.getvalue())
+
+        output = io.StringIO()
+        call_command('dump_query_profiles', '--kind', 'repeated', '--clear', stdout=output)
+        self.assertIn('REPEATED up to 4x per request', output.getvalue())
+        self.assertEqual(profiling.entries(), [])
+
+    def test_fingerprints_ignore_literals_and_list_lengths(self):
+        self.assertEqual(profiling.fingerprint("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x' LIMIT 21"),
+                         profiling.fingerprint('SELECT *  FROM t WHERE id IN (%s) AND name = %s LIMIT 5'))
+
+    def test_sampling_overhead_stays_under_two_percent(self):
+        # the time spent in the profiler's own code, sampling 1% of the requests; --max-overhead fails the command
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            call_command('benchmark_profiler', '--rows', '300', '--rounds', '3', '--requests', '20',
+                         '--max-overhead', '2', '--json', path, stdout=io.StringIO())
+            with open(path) as results_file:
+                modes = json.load(results_file)['modes']
+        self.assertEqual(len({mode['queries_per_round'] for mode in modes.values()}), 1)
+        self.assertLess(modes['sampled']['profiler_pct'], 2)
+        self.assertEqual(profiling.entries(), [])  # the benchmark's findings went to a buffer of its own
+
+
+class LoggingPipelineTests(TestCase):
+
+    def test_repeated_messages_are_rate_limited(self):
+        rate_limit = logs.RateLimitFilter(rate=2, per=0.05)
+        record = lambda message: logging.makeLogRecord({'name': 'api.bulk', 'levelno': logging.ERROR, 'msg': message})
+        self.assertEqual([rate_limit.filter(record('duplicate key')) for _ in range(4)], [True, True, False, False])
+        self.assertTrue(rate_limit.filter(record('another error')))
+
+        time.sleep(0.06)
+        next_window = record('duplicate key')
+        self.assertTrue(rate_limit.filter(next_window))
+        self.assertEqual(next_window.suppressed, 2)
+
+    def test_records_are_written_as_rotated_json_lines_by_a_background_thread(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'errors.log')
+            handler = logs.QueuedRotatingFileHandler(filename, maxBytes=4096, backupCount=2)
+            handler.setFormatter(logs.JSONFormatter())
+            # only the handler under test, not the configured `api` one that writes django_error.log
+            logger = logging.getLogger('api.tests.logging')
+            logger.addHandler(handler)
+            logger.propagate = False
+            try:
+                rows = ['first']
+                logger.error('Bulk insert of %s failed', rows, extra={'chunk': 3})
+                rows.append('second')  # the message keeps the values it was logged with
+                for number in range(20):
+                    try:
+                        1 / 0
+                    except ZeroDivisionError:
+                        logger.exception('Row %d failed', number)
+                handler.flush()
+                self.assertNotEqual(handler.listener._thread, threading.current_thread())
+            finally:
+                logger.removeHandler(handler)
+                logger.propagate = True
+                handler.close()
+
+            self.assertTrue(os.path.exists(filename + '.1'))
+            self.assertFalse(os.path.exists(filename + '.3'))
+            with open(filename + '.2') as rotated:
+                first = json.loads(rotated.readline())
+            self.assertEqual((first['message'], first['chunk'], first['level']), ("Bulk insert of ['first'] failed", 3, 'ERROR'))
+            with open(filename) as current:
+                last = json.loads(current.readlines()[-1])
+            self.assertEqual(last['message'], 'Row 19 failed')
+            self.assertIn('ZeroDivisionError', last['exception'])
+
+
+class BenchmarkApiTests(TestCase):
+
+    def test_every_scenario_runs_and_writes_are_rolled_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            call_command('benchmark_api', '--rows', '300', '--requests', '2', '--warmup', '0', '--batch-size', '3',
+                         '--json', path, stdout=io.StringIO())
+            rows = {'patients': Patient.objects.count(), 'referrals': Referral.objects.count()}
+            output = io.StringIO()
+            call_command('benchmark_api', '--skip-seed', '--scenarios', 'referrals:batch-create', '--requests', '2',
+                         '--warmup', '0', '--compare', path, stdout=output)
+            with open(path) as results_file:
+                results = json.load(results_file)
+
+        self.assertEqual(len(results['scenarios']), 7 * 4 + 1)
+        for scenario, result in results['scenarios'].items():
+            self.assertEqual((scenario, result['failures'], result['latency']['count']), (scenario, 0, 2))
+        self.assertEqual(results['scenarios']['referrals:retrieve']['queries']['max'], 1)
+        self.assertEqual(results['rows']['referrals'], rows['referrals'])
+        self.assertEqual({'patients': Patient.objects.count(), 'referrals': Referral.objects.count()}, rows)
+        self.assertIn('referrals:batch-create: p50', output.getvalue())
+
+
+class SeedDataTests(TestCase):
+
+    def seeded_rows(self):
+        return {key: [{field: value for field, value in row.items() if field != 'version'}
+                      for row in model.objects.order_by('id').values()]
+                for key, model in seeding.MODELS.items()}
+
+    def test_the_same_seed_gives_the_same_rows(self):
+        call_command('seed_data', '--rows', '600', '--seed', '7', stdout=io.StringIO())
+        first = self.seeded_rows()
+        self.assertEqual(len(first['users']), 20)
+        self.assertTrue(all(rows for rows in first.values()))
+
+        Hospital.objects.all().delete()
+        Patient.objects.all().delete()
+        output = io.StringIO()
+        call_command('seed_data', '--rows', '600', '--seed', '7', '--batch-size', '17', stdout=output)
+        self.assertEqual(self.seeded_rows(), first)
+        self.assertIn('Inserted 654 rows', output.getvalue())
+
+    def test_seeded_data_is_indexed_versioned_and_usable(self):
+        call_command('seed_data', '--rows', '0', '--hospitals', '3', '--patients', '40', '--referrals', '60',
+                     '--histories', '0', '--diagnostics', '0', '--equipment', '0', '--users', '2', stdout=io.StringIO())
+        self.assertEqual(Referral.objects.count(), 60)
+        self.assertFalse(Referral.objects.filter(version=0).exists())
+
+        patient = Patient.objects.first()
+        response = self.client.get('/api/patients/search/', {'q': patient.last_name})
+        self.assertIn(patient.id, [row['id'] for row in response.json()['results']])
+        response = self.client.get('/api/referrals/analytics/', {'source': 'rollup'})
+        self.assertEqual(sum(group['total'] for group in response.json()['results']), 60)
+        # decided referrals carry the day of the decision, like the ones Referral.save() stamps
+        self.assertFalse(Referral.objects.filter(status='Pending', decision_date__isnull=False).exists())
+        self.assertFalse(Referral.objects.exclude(status='Pending').filter(decision_date__isnull=True).exists())
+        self.assertFalse(Referral.objects.filter(decision_date__lt=F('referral_date')).exists())
+        row, = self.client.get('/api/referrals/analytics/').json()['results']
+        self.assertIsNotNone(row['mean_days_to_decision'])
+
+        user = User.objects.filter(username__startswith=seeding.SEED_USERNAME_PREFIX).first()
+        response = self.client.post('/api/token/', {'username': user.username, 'password': seeding.SEED_PASSWORD})
+        self.assertEqual(response.status_code, 200)
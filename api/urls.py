@@ -3,9 +3,9 @@ from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import (TokenObtainPairView,
                                             TokenRefreshView) #controllers imported to handle authentication
 
-from .views import (DiagnosticViewSet, EquipmentViewSet, HospitalViewSet,
-                    MedicalHistoryViewSet, PatientViewSet, ReferralViewSet,
-                    UserViewSet)
+from .views import (CacheStatsView, ClinicalSearchView, DatabasePoolStatsView, DiagnosticViewSet, EquipmentViewSet,
+                    HospitalViewSet, MedicalHistoryViewSet, MetricsView, PatientViewSet,
+                    ReferralEventsView, ReferralViewSet, SyncView, UserViewSet)
 
 router = DefaultRouter() # register(endpoint, controller). Powerful because it auto maps METHODS to the appropriate function in the Viewset
 router.register(r'hospitals', HospitalViewSet)
@@ -19,11 +19,18 @@ router.register(r'referrals', ReferralViewSet)
 
 
 urlpatterns = [
+    # before the router, which would take 'events' for a referral id
+    path('referrals/events/', ReferralEventsView.as_view(), name='referral_events'),
     # include maps all urls in its argument to the endpoint specified by path
     path('', include(router.urls)),
     # path (name of endpoint, controller or view, identifier)
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('cache-stats/', CacheStatsView.as_view(), name='cache_stats'),
+    path('db-pool-stats/', DatabasePoolStatsView.as_view(), name='db_pool_stats'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('search/', ClinicalSearchView.as_view(), name='clinical_search'),
+    path('sync/', SyncView.as_view(), name='sync'),
 ]
 
 
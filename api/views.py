@@ -2,278 +2,494 @@ from rest_framework import viewsets
 from core.models import Hospital, User, Patient, MedicalHistory, Diagnostic, Equipment, Referral
 from core.serializers import (
     HospitalSerializer, UserSerializer, PatientSerializer,
-    MedicalHistorySerializer, DiagnosticSerializer, EquipmentSerializer, ReferralSerializer
+    MedicalHistorySerializer, DiagnosticSerializer, EquipmentSerializer, ReferralSerializer,
+    PatientDossierSerializer
 )
 from django_filters.rest_framework import DjangoFilterBackend
-import logging
+from django_filters.utils import translate_validation
+from django.db.models import Count, Max, OuterRef, Prefetch, Subquery, prefetch_related_objects
+from django.db.models.functions import Greatest
+from django.shortcuts import get_object_or_404
+from django.utils.crypto import constant_time_compare
+from django.utils.http import parse_etags, quote_etag
+import hashlib
+import json
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import BasePermission, IsAdminUser
+from rest_framework.views import APIView
+from rest_framework.exceptions import ValidationError
+from django.utils.dateparse import parse_date
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from core import analytics, connections, events, metrics, search, sync
+from . import cache
+from .authentication import CachedJWTAuthentication
+from .filters import (DiagnosticFilter, EquipmentFilter, HospitalFilter, MedicalHistoryFilter, PatientFilter,
+                      ReferralFilter, UserFilter)
+from .mixins import (AsyncReadMixin, BatchCreateMixin, BulkIngestMixin, BulkUpdateMixin, CachedResponseMixin,
+                     ExpandableQuerysetMixin, StreamingListMixin, UpsertMixin)
+
+
+def parse_date_params(params, names=('date_from', 'date_to')):
+    """{name: date} for the given query parameters that are present, ValidationError if one isn't a date"""
+    dates = {}
+    for name in names:
+        if params.get(name):
+            try:
+                dates[name] = parse_date(params[name])
+            except ValueError:
+                dates[name] = None
+            if dates[name] is None:
+                raise ValidationError({name: 'Use the YYYY-MM-DD format.'})
+    return dates
 
-logger = logging.getLogger(__name__)
 
 # Hospital Viewset
-class HospitalViewSet(viewsets.ModelViewSet):
+class HospitalViewSet(CachedResponseMixin, UpsertMixin, BatchCreateMixin, BulkIngestMixin, ExpandableQuerysetMixin, StreamingListMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Hospital.objects.all() # The resources that this controller modifies
     serializer_class = HospitalSerializer # Converts the objects in the queryset into JSON objects
     filter_backends = [DjangoFilterBackend] # allows filtering by params like /api/hospitals/?type=Public
-    filterset_fields = '__all__' #configure which fields of the model the API  endpoint's controller should allow filtering based on
-
+    filterset_class = HospitalFilter # which query params the endpoint accepts, see api/filters.py
+    upsert_key_fields = ('name',) # /api/hospitals/upsert/ matches existing hospitals by name
+    upsert_allowed_key_fields = ('name',) # ?on= only takes required fields, a missing value matches nothing
+    max_candidates = 100
 
-    def create(self, request, *args, **kwargs):
+    @action(detail=False, methods=['get'])
+    def candidates(self, request):
         """_summary_
-        A viewset is robust in that with just a few lines you have produced a controller 
-        that auto maps the request's METHOD to the appropriate CRUD operation 
-        But we wanted to allow batch creation of resources if the clients wanted to add multiple resources with 
-        one POST request, so we had to override the create method of the viewset
-    
+        GET /api/hospitals/candidates/?equipment=MRI Machine,Dialysis Machine&type=Public
+        Hospitals that can take a patient needing the given equipment, best first: hospitals
+        with more of the requested equipment available, then with more available units.
+        ?match=any also lists hospitals that only have part of it (default: all of it).
+        Names are matched case-insensitively against Equipment.normalized_name, which has a
+        partial index over available equipment, so the ranking is one index-only GROUP BY.
+        Cached like the list endpoint, any equipment or hospital change invalidates it.
         """
-        # Check if the request data is a list (batch insert)
-        if isinstance(request.data, list):
-            # Use many=True to serialize the list of patients
-            serializer = self.get_serializer(data=request.data, many=True)
-        else:
-            # Single object creation
-            serializer = self.get_serializer(data=request.data)
-        
-        # Validate the data
-        serializer.is_valid(raise_exception=True)
-        
-        # Save the data (handle single and batch creation)
-        self.perform_create(serializer)
-
-        # Return the response
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-    def perform_create(self, serializer):
+        requested = [name for value in request.query_params.getlist('equipment')
+                     for name in value.split(',') if name.strip()]
+        if not requested:
+            raise ValidationError({'equipment': 'Give at least one equipment name.'})
+        match = request.query_params.get('match', 'all')
+        if match not in ('all', 'any'):
+            raise ValidationError({'match': 'Choose all or any.'})
+        hospital_type = request.query_params.get('type')
+        if hospital_type and hospital_type not in dict(Hospital.HOSPITAL_TYPE_CHOICES):
+            raise ValidationError({'type': f"Choose one of {', '.join(dict(Hospital.HOSPITAL_TYPE_CHOICES))}."})
         try:
-            if isinstance(serializer.validated_data, list):
-                hospitals = Hospital.objects.bulk_create([Hospital(**data) for data in serializer.validated_data])
-                serializer.instance = hospitals
-            else:
-                serializer.save()
-        except Exception as e:
-            logger.error(f"Error during patient creation: {e}")
-            raise
+            limit = min(int(request.query_params.get('limit', 20)), self.max_candidates)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValidationError({'limit': 'A positive number is required.'})
+
+        def build_response():
+            # normalized by the same SQL as the stored names, so non-ASCII names compare the way they are stored
+            names = list(dict.fromkeys(Equipment.normalize_names(requested)))
+            available = Equipment.objects.filter(available=True, normalized_name__in=names)
+            if hospital_type:
+                available = available.filter(hospital__type=hospital_type)
+            ranking = (available
+                       .values('hospital')
+                       .annotate(matched=Count('normalized_name', distinct=True), units=Count('normalized_name'))
+                       .order_by('-matched', '-units', 'hospital'))
+            if match == 'all':
+                ranking = ranking.filter(matched=len(names))
+            ranking = list(ranking[:limit])
+
+            ids = [row['hospital'] for row in ranking]
+            hospitals = Hospital.objects.in_bulk(ids)
+            found = {}
+            for hospital, name in (available.filter(hospital__in=ids)
+                                   .values_list('hospital', 'normalized_name').distinct()):
+                found.setdefault(hospital, set()).add(name)
+
+            results = [{
+                'hospital': HospitalSerializer(hospitals[row['hospital']]).data,
+                'matched': row['matched'],
+                'available_units': row['units'],
+                'missing': [name for name in names if name not in found.get(row['hospital'], ())],
+            } for row in ranking]
+            return Response({'equipment': names, 'results': results})
+
+        return self.cached_response(request, 'candidates', None, build_response, model=Equipment)
+
 
 # Custom User Viewset
-class UserViewSet(viewsets.ModelViewSet):
-    queryset = User.objects.all()
+class UserViewSet(BatchCreateMixin, BulkIngestMixin, ExpandableQuerysetMixin, StreamingListMixin, AsyncReadMixin, viewsets.ModelViewSet):
+    queryset = User.objects.prefetch_related('groups', 'user_permissions') # both are m2m id lists in UserSerializer, without this every user costs 2 extra queries
     serializer_class = UserSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = '__all__' 
+    filterset_class = UserFilter
 
-    def create(self, request, *args, **kwargs):
-        # Check if the request data is a list (batch insert)
-        if isinstance(request.data, list):
-            # Use many=True to serialize the list of patients
-            serializer = self.get_serializer(data=request.data, many=True)
-        else:
-            # Single object creation
-            serializer = self.get_serializer(data=request.data)
-        
-        # Validate the data
-        serializer.is_valid(raise_exception=True)
-        
-        # Save the data (handle single and batch creation)
-        self.perform_create(serializer)
-
-        # Return the response
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-    def perform_create(self, serializer):
-        try:
-            if isinstance(serializer.validated_data, list):
-                users = User.objects.bulk_create([User(**data) for data in serializer.validated_data])
-                serializer.instance = users
-            else:
-                serializer.save()
-        except Exception as e:
-            logger.error(f"Error during user creation: {e}")
-            raise
 
 # Patient Viewset
-class PatientViewSet(viewsets.ModelViewSet):
+class PatientViewSet(UpsertMixin, BatchCreateMixin, BulkIngestMixin, ExpandableQuerysetMixin, StreamingListMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = '__all__'
+    filterset_class = PatientFilter
+    upsert_key_fields = ('first_name', 'last_name', 'dob') # /api/patients/upsert/ matches existing patients on these
+    upsert_allowed_key_fields = ('first_name', 'last_name', 'dob')
+    max_search_results = 100
 
-    def create(self, request, *args, **kwargs):
-        # Check if the request data is a list (batch insert)
-        if isinstance(request.data, list):
-            # Use many=True to serialize the list of patients
-            serializer = self.get_serializer(data=request.data, many=True)
-        else:
-            # Single object creation
-            serializer = self.get_serializer(data=request.data)
-        
-        # Validate the data
-        serializer.is_valid(raise_exception=True)
-        
-        # Save the data (handle single and batch creation)
-        self.perform_create(serializer)
-
-        # Return the response
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-    def perform_create(self, serializer):
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """_summary_
+        GET /api/patients/search/?q=chiwya&limit=20
+        Patients whose names or contact info match the query, best first: names starting with
+        the query, then fuzzy (misspelled) and partial matches. Backed by a trigram index
+        (pg_trgm on postgres, FTS5 on sqlite), see core/search.py.
+        """
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'A search query is required.'})
         try:
-            if isinstance(serializer.validated_data, list):
-                patients = Patient.objects.bulk_create([Patient(**data) for data in serializer.validated_data])
-                serializer.instance = patients
-            else:
-                serializer.save()
-        except Exception as e:
-            logger.error(f"Error during patient creation: {e}")
-            raise
+            limit = min(int(request.query_params.get('limit', 20)), self.max_search_results)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise ValidationError({'limit': 'A positive number is required.'})
+
+        matches = search.search_patients(query, limit)
+        patients = Patient.objects.in_bulk([patient for patient, score in matches])
+        results = []
+        for patient, score in matches:
+            if patient in patients:  # deleted since the search ran
+                results.append({**PatientSerializer(patients[patient]).data, 'score': score})
+        return Response({'query': query, 'results': results})
+
+    @action(detail=True, methods=['get'])
+    def dossier(self, request, pk=None):
+        """_summary_
+        GET /api/patients/<id>/dossier/
+        Everything a receiving hospital needs to open a case in one response: the patient,
+        their medical history, diagnostics and referrals with both hospitals. It is always
+        4 queries (the patient plus one prefetch per relation) however long the history is.
+
+        The response carries an ETag, clients that send it back in If-None-Match get an
+        empty 304 when nothing changed, answered from the first of those queries alone.
+        """
+        # the ETag is built from the sync versions of every row in the dossier (core/sync.py), read with
+        # the patient in one query: a repeat view that gets its 304 never loads or serializes the rest
+        patient = get_object_or_404(Patient.objects.annotate(**self.dossier_versions()), pk=pk)
+        state = [patient.version] + [getattr(patient, name) for name in self.dossier_versions()]
+        etag = quote_etag(hashlib.sha1(json.dumps(['dossier', 1, state]).encode()).hexdigest())
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        prefetch_related_objects(
+            [patient],
+            Prefetch('medical_history', queryset=MedicalHistory.objects.order_by('-start_date', '-id')),
+            Prefetch('diagnostics', queryset=Diagnostic.objects.order_by('-date_taken', '-id')),
+            Prefetch('referrals', queryset=Referral.objects.select_related('referred_from', 'referred_to')
+                     .order_by('-referral_date', '-id')),
+        )
+        return Response(PatientDossierSerializer(patient).data, headers={'ETag': etag})
+
+    @staticmethod
+    def dossier_versions():
+        """_summary_
+        Subqueries summing up the rows of a dossier: a write to any of them takes a version above every
+        other (core/sync.py) and raises a max, deleting one lowers a count.
+        """
+        def per_patient(model, **aggregates):
+            rows = model.objects.filter(patient=OuterRef('pk')).order_by().values('patient')
+            return {name: Subquery(rows.annotate(value=aggregate).values('value'))
+                    for name, aggregate in aggregates.items()}
+
+        return {
+            **per_patient(MedicalHistory, history_version=Max('version'), history_count=Count('id')),
+            **per_patient(Diagnostic, diagnostic_version=Max('version'), diagnostic_count=Count('id')),
+            **per_patient(Referral, referral_version=Max('version'), referral_count=Count('id'),
+                          hospital_version=Greatest(Max('referred_from__version'), Max('referred_to__version'))),
+        }
+
 
 # Medical History Viewset
-class MedicalHistoryViewSet(viewsets.ModelViewSet):
+class MedicalHistoryViewSet(BatchCreateMixin, BulkIngestMixin, ExpandableQuerysetMixin, StreamingListMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = MedicalHistory.objects.all()
     serializer_class = MedicalHistorySerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = '__all__' 
+    filterset_class = MedicalHistoryFilter
 
-    def create(self, request, *args, **kwargs):
-        # Check if the request data is a list (batch insert)
-        if isinstance(request.data, list):
-            # Use many=True to serialize the list of patients
-            serializer = self.get_serializer(data=request.data, many=True)
-        else:
-            # Single object creation
-            serializer = self.get_serializer(data=request.data)
-        
-        # Validate the data
-        serializer.is_valid(raise_exception=True)
-        
-        # Save the data (handle single and batch creation)
-        self.perform_create(serializer)
-
-        # Return the response
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-    def perform_create(self, serializer):
-        try:
-            if isinstance(serializer.validated_data, list):
-                medical_histories = MedicalHistory.objects.bulk_create([MedicalHistory(**data) for data in serializer.validated_data])
-                serializer.instance = medical_histories
-            else:
-                serializer.save()
-        except Exception as e:
-            logger.error(f"Error during medical history creation: {e}")
-            raise
 
 # Diagnostic Viewset
-class DiagnosticViewSet(viewsets.ModelViewSet):
+class DiagnosticViewSet(BatchCreateMixin, BulkIngestMixin, ExpandableQuerysetMixin, StreamingListMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Diagnostic.objects.all()
     serializer_class = DiagnosticSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = '__all__'
+    filterset_class = DiagnosticFilter
 
-    def create(self, request, *args, **kwargs):
-        # Check if the request data is a list (batch insert)
-        if isinstance(request.data, list):
-            # Use many=True to serialize the list of patients
-            serializer = self.get_serializer(data=request.data, many=True)
-        else:
-            # Single object creation
-            serializer = self.get_serializer(data=request.data)
-        
-        # Validate the data
-        serializer.is_valid(raise_exception=True)
-        
-        # Save the data (handle single and batch creation)
-        self.perform_create(serializer)
-
-        # Return the response
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-    def perform_create(self, serializer):
-        try:
-            if isinstance(serializer.validated_data, list):
-                diagnostics = Diagnostic.objects.bulk_create([Diagnostic(**data) for data in serializer.validated_data])
-                serializer.instance = diagnostics
-            else:
-                serializer.save()
-        except Exception as e:
-            logger.error(f"Error during diagnostic creation: {e}")
-            raise
 
 # Equipment Viewset
-class EquipmentViewSet(viewsets.ModelViewSet):
+class EquipmentViewSet(CachedResponseMixin, BatchCreateMixin, BulkIngestMixin, ExpandableQuerysetMixin, StreamingListMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Equipment.objects.all()
     serializer_class = EquipmentSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = '__all__' 
+    filterset_class = EquipmentFilter
 
-    def create(self, request, *args, **kwargs):
-        # Check if the request data is a list (batch insert)
-        if isinstance(request.data, list):
-            # Use many=True to serialize the list of patients
-            serializer = self.get_serializer(data=request.data, many=True)
-        else:
-            # Single object creation
-            serializer = self.get_serializer(data=request.data)
-        
-        # Validate the data
-        serializer.is_valid(raise_exception=True)
-        
-        # Save the data (handle single and batch creation)
-        self.perform_create(serializer)
-
-        # Return the response
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-    def perform_create(self, serializer):
-        try:
-            if isinstance(serializer.validated_data, list):
-                equipments = Equipment.objects.bulk_create([Equipment(**data) for data in serializer.validated_data])
-                serializer.instance = equipments
-            else:
-                serializer.save()
-        except Exception as e:
-            logger.error(f"Error during equipment creation: {e}")
-            raise
 
 # Referral Viewset
-class ReferralViewSet(viewsets.ModelViewSet):
+class ReferralViewSet(BulkUpdateMixin, BatchCreateMixin, BulkIngestMixin, ExpandableQuerysetMixin, StreamingListMixin, AsyncReadMixin, viewsets.ModelViewSet):
     queryset = Referral.objects.all()
     serializer_class = ReferralSerializer
     filter_backends = [DjangoFilterBackend]
-    filterset_fields = '__all__' 
+    filterset_class = ReferralFilter
+    keyset_ordering = ('referral_date', 'id') # pages walk referrals in date order, id breaks ties so cursors stay stable
+    bulk_state_field = 'status' # PATCH /api/referrals/bulk-update/ only allows Referral.STATUS_TRANSITIONS
+    bulk_state_transitions = Referral.STATUS_TRANSITIONS
 
-    def create(self, request, *args, **kwargs):
-        # Check if the request data is a list (batch insert)
-        if isinstance(request.data, list):
-            # Use many=True to serialize the list of patients
-            serializer = self.get_serializer(data=request.data, many=True)
+    @action(detail=False, methods=['get'])
+    def analytics(self, request):
+        """_summary_
+        GET /api/referrals/analytics/?group_by=referred_to,status&period=month&date_from=2024-01-01
+        Referral counts, acceptance rate and days to decision per group, computed by the database.
+        ?source=rollup reads the pre-aggregated daily table instead of the referrals (no median then).
+        """
+        params = request.query_params
+        group_by = [name for name in params.get('group_by', '').split(',') if name]
+        unknown = [name for name in group_by if name not in analytics.GROUP_FIELDS]
+        if unknown:
+            raise ValidationError({'group_by': f"Unknown field(s) {', '.join(unknown)}, choose from {', '.join(analytics.GROUP_FIELDS)}."})
+        group_by = list(dict.fromkeys(group_by))
+
+        period = params.get('period') or None
+        if period and period not in analytics.PERIODS:
+            raise ValidationError({'period': f"Choose one of {', '.join(analytics.PERIODS)}."})
+
+        dates = parse_date_params(params)
+
+        source = params.get('source', 'live')
+        if source == 'live':
+            queryset = self.filter_queryset(self.get_queryset())
+            if 'date_from' in dates:
+                queryset = queryset.filter(referral_date__gte=dates['date_from'])
+            if 'date_to' in dates:
+                queryset = queryset.filter(referral_date__lte=dates['date_to'])
+            results = analytics.referral_stats(queryset, group_by, period)
+        elif source == 'rollup':
+            # only the filters the daily table can answer, checked by the same form as the live ones
+            filterset = ReferralFilter(params, queryset=Referral.objects.none())
+            if not filterset.is_valid():
+                raise translate_validation(filterset.errors)
+            filters = {name: filterset.form.cleaned_data[name] for name in analytics.GROUP_FIELDS
+                       if filterset.form.cleaned_data.get(name) not in (None, '')}
+            if 'date_from' in dates:
+                filters['day__gte'] = dates['date_from']
+            if 'date_to' in dates:
+                filters['day__lte'] = dates['date_to']
+            results = analytics.rollup_stats(filters, group_by, period)
         else:
-            # Single object creation
-            serializer = self.get_serializer(data=request.data)
-        
-        # Validate the data
-        serializer.is_valid(raise_exception=True)
-        
-        # Save the data (handle single and batch creation)
-        self.perform_create(serializer)
-
-        # Return the response
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-
-    def perform_create(self, serializer):
+            raise ValidationError({'source': 'Choose live or rollup.'})
+
+        return Response({'group_by': group_by, 'period': period, 'source': source, 'results': results})
+
+
+# Change feed
+class SyncView(APIView):
+    """_summary_
+    GET /api/sync/?since=1234&resources=patients,referrals&limit=500
+    Everything created, updated or deleted since the client's last sync, oldest first, so mobile
+    clients download the delta instead of whole tables. Start with since=0 (a full download), then
+    send back `next` until `has_more` is false, and keep the last `next` for the next sync.
+    Answers 410 when `since` is older than the kept tombstones: start again from since=0.
+    """
+    resources = {
+        'hospitals': HospitalSerializer,
+        'patients': PatientSerializer,
+        'medical-history': MedicalHistorySerializer,
+        'diagnostics': DiagnosticSerializer,
+        'equipment': EquipmentSerializer,
+        'referrals': ReferralSerializer,
+    }
+    default_limit = 500
+    max_limit = 5000
+
+    def get(self, request):
+        params = request.query_params
+        names = [name for name in params.get('resources', '').split(',') if name] or list(self.resources)
+        unknown = [name for name in names if name not in self.resources]
+        if unknown:
+            raise ValidationError({'resources': f"Unknown resource(s) {', '.join(unknown)}, choose from {', '.join(self.resources)}."})
+        names = list(dict.fromkeys(names))
         try:
-            if isinstance(serializer.validated_data, list):
-                referrals = Referral.objects.bulk_create([Referral(**data) for data in serializer.validated_data])
-                serializer.instance = referrals
+            since = int(params.get('since', 0))
+            limit = min(int(params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            raise ValidationError({'detail': 'since and limit must be numbers.'})
+        if since < 0 or limit < 1:
+            raise ValidationError({'detail': 'since must be 0 or more and limit at least 1.'})
+
+        serializers = {self.resources[name].Meta.model: (name, self.resources[name]) for name in names}
+        try:
+            changes, has_more = sync.changes(list(serializers), since=since, limit=limit)
+        except sync.SyncTokenExpired:
+            return Response({'detail': 'This sync token has expired, sync again from since=0.'}, status=status.HTTP_410_GONE)
+
+        # serialize the rows of each resource in one go
+        rows = {}
+        for model, (name, serializer_class) in serializers.items():
+            instances = [instance for _, changed_model, instance, _ in changes if changed_model is model and instance]
+            for instance, data in zip(instances, serializer_class(instances, many=True).data):
+                rows[model, instance.pk] = data
+
+        results = []
+        for version, model, instance, pk in changes:
+            change = {'resource': serializers[model][0], 'id': pk, 'version': version}
+            if instance is None:
+                change['op'] = 'delete'
             else:
-                serializer.save()
-        except Exception as e:
-            logger.error(f"Error during referral creation: {e}")
-            raise
+                change.update(op='upsert', data=rows[model, pk])
+            results.append(change)
+        next_version = changes[-1][0] if changes else since
+        return Response({'since': since, 'next': next_version, 'has_more': has_more, 'changes': results})
+
+
+# Referral events
+class ReferralEventsView(View):
+    """_summary_
+    GET /api/referrals/events/ (server-sent events, e.g. new EventSource('/api/referrals/events/?token=<access>'))
+    Pushes referral.created and referral.status_changed events for referrals from or to the user's
+    hospital as they commit, instead of clients polling /api/referrals/. Authenticated with the usual
+    SimpleJWT access token, in the Authorization header or, for browsers' EventSource which can't
+    send headers, in ?token=. Each event id is the referral's sync version: after a reconnect, fetch
+    /api/sync/?resources=referrals&since=<last id> for anything missed. An `event: reset` means the
+    client fell too far behind and should do the same.
+    Only served through asgi.py (one coroutine per client), a sync worker would be held forever.
+    """
+    authentication = CachedJWTAuthentication()
+
+    async def get(self, request):
+        if not isinstance(request, ASGIRequest):
+            return JsonResponse({'detail': 'Event streams are only served by the ASGI application.'}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        user = await self.authenticate(request)
+        if user is None:
+            return JsonResponse({'detail': 'A valid access token is required.'}, status=status.HTTP_401_UNAUTHORIZED)
+        if user.hospital_id is None:
+            return JsonResponse({'detail': 'Only hospital staff can subscribe to referral events.'}, status=status.HTTP_403_FORBIDDEN)
+
+        response = StreamingHttpResponse(self.stream(user.hospital_id), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # stops nginx from buffering the stream
+        return response
+
+    async def authenticate(self, request):
+        header = self.authentication.get_header(request)
+        raw_token = self.authentication.get_raw_token(header) if header else request.GET.get('token')
+        if not raw_token:
+            return None
+        try:
+            token = self.authentication.get_validated_token(raw_token)
+            return await sync_to_async(self.load_user)(token)
+        except (InvalidToken, AuthenticationFailed):
+            return None
+
+    def load_user(self, token):
+        user = self.authentication.get_user(token)
+        # Django closes the database connection when the response finishes, for a stream that may be
+        # hours: close it now or every idle subscriber keeps a connection (tests run in a transaction)
+        if not connection.in_atomic_block:
+            connection.close()
+        return user
+
+    async def stream(self, hospital_id):
+        # subscribed only once the response starts, and always unsubscribed: when the client
+        # disconnects the ASGI handler cancels this generator inside subscription.get()
+        subscription = events.get_broker().subscribe([events.channel(hospital_id)])
+        try:
+            yield 'retry: 5000\n: subscribed\n\n'
+            while not subscription.overflowed:
+                message = await subscription.get(timeout=settings.REFERRAL_EVENTS_HEARTBEAT)
+                yield message if message is not None else ': keepalive\n\n'
+            yield 'event: reset\ndata: {}\n\n'
+        finally:
+            subscription.close()
+
+
+# Cache statistics
+class CacheStatsView(APIView):
+    """GET /api/cache-stats/ hit/miss counters of the response cache in this worker process"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(cache.stats.snapshot())
+
+
+# Database connection statistics
+class DatabasePoolStatsView(APIView):
+    """GET /api/db-pool-stats/ connection pool (or persistent connection) counters of this worker process"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(connections.stats())
+
+
+# Request metrics
+class HasMetricsToken(BasePermission):
+    """The request carries settings.API_METRICS_TOKEN as a bearer token (how Prometheus authenticates)."""
+
+    def has_permission(self, request, view):
+        expected = settings.API_METRICS_TOKEN
+        return bool(expected) and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {expected}')
+
+
+class MetricsView(APIView):
+    """_summary_
+    GET /api/metrics/ request counts and per-endpoint histograms (duration, SQL queries and time,
+    auth, serialization and render time, response size) of this worker process, in the Prometheus
+    text format. Every series has a worker label (the process id), scrape each worker or expect
+    the numbers of whichever one answers.
+    """
+    permission_classes = [HasMetricsToken | IsAdminUser]
+
+    def perform_authentication(self, request):
+        # authenticate lazily: a request with the metrics token is let in before anything reads it as a JWT
+        pass
+
+    def get(self, request):
+        return HttpResponse(metrics.registry.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# Clinical text search
+class ClinicalSearchView(APIView):
+    """_summary_
+    GET /api/search/?q=suspected TB chest x-ray&type=diagnostic&date_from=2024-07-01&hospital=3
+    Full-text search over diagnostic results and notes, medical history notes and referral reasons,
+    best matches first, with the matching words of each hit highlighted in `snippet`.
+    Optional filters: type (comma separated), patient, hospital (referrals from/to it and everything
+    about the patients of those referrals), date_from/date_to, limit. See core/search.py.
+    """
+    max_results = 100
+
+    def get(self, request):
+        params = request.query_params
+        query = params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'A search query is required.'})
+        kinds = [kind for kind in params.get('type', '').split(',') if kind]
+        unknown = [kind for kind in kinds if kind not in search.CLINICAL_SOURCES]
+        if unknown:
+            raise ValidationError({'type': f"Unknown type(s) {', '.join(unknown)}, choose from {', '.join(search.CLINICAL_SOURCES)}."})
+
+        filters = {}
+        for name in ('patient', 'hospital', 'limit'):
+            if params.get(name):
+                try:
+                    filters[name] = int(params[name])
+                except ValueError:
+                    raise ValidationError({name: 'A number is required.'})
+        limit = min(filters.pop('limit', 20), self.max_results)
+        if limit < 1:
+            raise ValidationError({'limit': 'A positive number is required.'})
+        filters.update(parse_date_params(params))
+
+        results = search.search_clinical(query, kinds=list(dict.fromkeys(kinds)), limit=limit, **filters)
+        return Response({'query': query, 'results': results})
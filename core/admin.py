@@ -5,12 +5,26 @@ from django.contrib.auth.admin import UserAdmin
 class CustomUserAdmin(UserAdmin):
     model=User
 
+# The __str__ of these models reads related objects (patient, hospital...), so the change lists
+# join them in with list_select_related instead of running one query per row
+class MedicalHistoryAdmin(admin.ModelAdmin):
+    list_select_related = ('patient',)
+
+class DiagnosticAdmin(admin.ModelAdmin):
+    list_select_related = ('patient',)
+
+class EquipmentAdmin(admin.ModelAdmin):
+    list_select_related = ('hospital',)
+
+class ReferralAdmin(admin.ModelAdmin):
+    list_select_related = ('patient', 'referred_from', 'referred_to')
+
 
 # Register your models here.
 admin.site.register(Hospital)
 admin.site.register(Patient)
-admin.site.register(MedicalHistory)
-admin.site.register(Diagnostic)
-admin.site.register(Equipment)
-admin.site.register(Referral)
-admin.site.register(User, CustomUserAdmin)
\ No newline at end of file
+admin.site.register(MedicalHistory, MedicalHistoryAdmin)
+admin.site.register(Diagnostic, DiagnosticAdmin)
+admin.site.register(Equipment, EquipmentAdmin)
+admin.site.register(Referral, ReferralAdmin)
+admin.site.register(User, CustomUserAdmin)
@@ -0,0 +1,101 @@
+from collections import defaultdict
+
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Q, Sum, Window
+from django.db.models.functions import RowNumber, Trunc
+
+from .models import ReferralDailyStat
+
+# Referral statistics computed by the database (GROUP BY + window functions) for the
+# /api/referrals/analytics/ endpoint. Two sources give the same shape of result:
+#   referral_stats()  reads the referrals table and also computes the median time to decision
+#   rollup_stats()    reads the pre-aggregated ReferralDailyStat table, much cheaper on big tables,
+#                     but only has the mean time to decision (a median can't be kept incrementally)
+
+GROUP_FIELDS = ('referred_from', 'referred_to', 'status')
+PERIODS = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def group_arguments(group_by, period, date_field):
+    """values() arguments for the requested grouping: field names, plus a truncated date named `period`"""
+    return list(group_by), ({'period': Trunc(date_field, period)} if period else {})
+
+
+def grouped(queryset, fields, expressions, aggregates):
+    """One row per group, or a single row for the whole queryset when nothing is grouped."""
+    if not fields and not expressions:
+        # values() without arguments would mean "every column", not "no grouping"
+        return [queryset.aggregate(**aggregates)]
+    return list(queryset.values(*fields, **expressions).annotate(**aggregates).order_by(*fields, *expressions))
+
+
+def finish(row):
+    decided = row['accepted'] + row['rejected']
+    row['acceptance_rate'] = round(row['accepted'] / decided, 4) if decided else None
+    return row
+
+
+def referral_stats(queryset, group_by, period=None):
+    """_summary_
+    Counts per group plus acceptance rate, mean and median days from referral_date to decision_date.
+    `queryset` is an (already filtered) Referral queryset, `group_by` a subset of GROUP_FIELDS.
+    Two queries whatever the number of referrals: one GROUP BY for the counts, and one for the
+    medians that numbers the decided referrals of each group by decision time with ROW_NUMBER()
+    and only returns the middle one or two rows of every group.
+    """
+    fields, expressions = group_arguments(group_by, period, 'referral_date')
+    names = fields + list(expressions)
+    decision_days = ExpressionWrapper(F('decision_date') - F('referral_date'), output_field=DurationField())
+
+    rows = grouped(queryset, fields, expressions, {
+        'total': Count('id'),
+        'pending': Count('id', filter=Q(status='Pending')),
+        'accepted': Count('id', filter=Q(status='Accepted')),
+        'rejected': Count('id', filter=Q(status='Rejected')),
+        'decided': Count('id', filter=Q(decision_date__isnull=False)),
+        'decision_total': Sum(decision_days, filter=Q(decision_date__isnull=False)),
+    })
+
+    partition = [F(name) for name in fields] + list(expressions.values()) or None
+    middle = (queryset
+              .filter(decision_date__isnull=False)
+              .annotate(days=decision_days,
+                        position=Window(RowNumber(), partition_by=partition, order_by=decision_days.asc()),
+                        group_size=Window(Count('id'), partition_by=partition))
+              .filter(Q(position=(F('group_size') + 1) / 2) | Q(position=(F('group_size') + 2) / 2))
+              .values(*fields, 'days', **expressions))
+    medians = defaultdict(list)
+    for row in middle:
+        medians[tuple(row[name] for name in names)].append(row['days'].days)
+
+    results = []
+    for row in rows:
+        if not row['total']:
+            continue  # aggregate() over no referrals
+        decision_total = row.pop('decision_total')
+        row['mean_days_to_decision'] = round(decision_total.days / row['decided'], 2) if row['decided'] else None
+        middle_days = medians.get(tuple(row[name] for name in names))
+        row['median_days_to_decision'] = sum(middle_days) / len(middle_days) if middle_days else None
+        results.append(finish(row))
+    return results
+
+
+def rollup_stats(filters, group_by, period=None):
+    """Same counts as referral_stats() from ReferralDailyStat, `filters` are lookups on its fields."""
+    fields, expressions = group_arguments(group_by, period, 'day')
+    rows = grouped(ReferralDailyStat.objects.filter(**filters), fields, expressions, {
+        'total': Sum('count', default=0),
+        'pending': Sum('count', filter=Q(status='Pending'), default=0),
+        'accepted': Sum('count', filter=Q(status='Accepted'), default=0),
+        'rejected': Sum('count', filter=Q(status='Rejected'), default=0),
+        'decided': Sum('decided_count', default=0),
+        'decision_total': Sum('decision_days_total', default=0),
+    })
+
+    results = []
+    for row in rows:
+        if not row['total']:
+            continue  # buckets emptied by status changes or deletes, or aggregate() over none
+        decision_total = row.pop('decision_total')
+        row['mean_days_to_decision'] = round(decision_total / row['decided'], 2) if row['decided'] else None
+        results.append(finish(row))
+    return results
@@ -1,6 +1,19 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        # connects the receivers that keep ReferralDailyStat up to date and leave sync tombstones
+        from . import rollups, search, sync  # noqa: F401
+        # after rollups: its pre_save loads the previous referral, which the events receivers reuse
+        from . import events  # noqa: F401
+        # counts requests and opened database connections for /api/db-pool-stats/
+        from . import connections  # noqa: F401
+        # times the SQL queries of every request for api.middleware.RequestMetricsMiddleware
+        from . import metrics  # noqa: F401
+        # sqlite drops triggers when a migration rebuilds a table, the search indexes depend on them
+        post_migrate.connect(search.restore_sqlite_triggers, sender=self)
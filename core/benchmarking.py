@@ -0,0 +1,99 @@
+import asyncio
+import math
+import time
+
+# Small timing helpers and a load generator shared by the benchmark management commands
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers, e.g. percentile(latencies, 99)."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(samples):
+    """p50/p95/p99/mean of a list of latencies in milliseconds."""
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples), 3),
+        'p50_ms': round(percentile(samples, 50), 3),
+        'p95_ms': round(percentile(samples, 95), 3),
+        'p99_ms': round(percentile(samples, 99), 3),
+    }
+
+
+class QueryCounter:
+    """Execute wrapper counting queries: `with connection.execute_wrapper(counter):`.
+    Lighter than CaptureQueriesContext, which keeps the SQL of every query."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def time_repeated(func, repeat):
+    """Call func `repeat` times and return the latency of each call in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+async def fetch(host, port, path, headers=None):
+    """One HTTP/1.1 GET on a fresh connection, returns (status code, body bytes)."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        lines = [f'GET {path} HTTP/1.1', f'Host: {host}:{port}', 'Connection: close']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    status = int(head.split(b' ', 2)[1]) if head else 0
+    return status, body
+
+
+async def http_load(host, port, paths, concurrency, duration, headers=None):
+    """_summary_
+    Closed-loop load generator: `concurrency` clients request `paths` round robin, each sending its
+    next request as soon as the previous answer arrived, for `duration` seconds.
+    Returns the latency summary (ms), requests per second and the count of non-2xx answers/errors.
+    """
+    latencies, failures = [], 0
+    started = time.perf_counter()
+    deadline = started + duration
+
+    async def client(offset):
+        nonlocal failures
+        number = offset
+        while time.perf_counter() < deadline:
+            path = paths[number % len(paths)]
+            number += 1
+            sent = time.perf_counter()
+            try:
+                status, _ = await fetch(host, port, path, headers)
+            except OSError:
+                status = 0
+            if 200 <= status < 300:
+                latencies.append((time.perf_counter() - sent) * 1000)
+            else:
+                failures += 1
+
+    await asyncio.gather(*(client(offset) for offset in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'failures': failures,
+        'latency': summarize(latencies),
+    }
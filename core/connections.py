@@ -0,0 +1,77 @@
+import threading
+from collections import Counter
+
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Database connection statistics of this worker process, reported by /api/db-pool-stats/.
+# With the psycopg pool (settings.DB_POOL) they come from the pool itself: checkouts, time spent
+# waiting for a free connection and how much of the pool is in use. Without it we count how many
+# connections were opened per request: with persistent connections (CONN_MAX_AGE) working that
+# ratio falls towards 0, at 1 every request pays for a new connection.
+# (connection_created also fires on every pool checkout, so the count is only reported without one)
+
+_lock = threading.Lock()
+_counts = Counter()
+
+
+@receiver(request_started)
+def count_request(sender, **kwargs):
+    with _lock:
+        _counts['requests'] += 1
+
+
+@receiver(connection_created)
+def count_connection(sender, connection, **kwargs):
+    with _lock:
+        _counts[f'opened:{connection.alias}'] += 1
+
+
+def get_pool(alias):
+    # postgres DatabaseWrapper.pool exists since Django 5.1 and is None without OPTIONS['pool']
+    connection = connections[alias]
+    if connection.vendor != 'postgresql' or not connection.settings_dict['OPTIONS'].get('pool'):
+        return None
+    return connection.pool
+
+
+def stats(alias='default'):
+    connection = connections[alias]
+    with _lock:
+        requests, opened = _counts['requests'], _counts[f'opened:{alias}']
+    result = {'alias': alias, 'vendor': connection.vendor, 'pooled': False, 'requests': requests}
+    pool = get_pool(alias)
+    if pool is None:
+        result.update(
+            conn_max_age=connection.settings_dict['CONN_MAX_AGE'],
+            health_checks=connection.settings_dict['CONN_HEALTH_CHECKS'],
+            connections_opened=opened,
+            connections_per_request=round(opened / requests, 4) if requests else None,
+        )
+        return result
+
+    pool_stats = pool.get_stats()  # counters are only present once they are non-zero
+    checkouts = pool_stats.get('requests_num', 0)
+    queued = pool_stats.get('requests_queued', 0)
+    in_use = pool_stats.get('pool_size', 0) - pool_stats.get('pool_available', 0)
+    result.update(
+        pooled=True,
+        min_size=pool_stats.get('pool_min'),
+        max_size=pool_stats.get('pool_max'),
+        size=pool_stats.get('pool_size', 0),
+        # saturation right now, and since the worker started: the share of checkouts that had to wait
+        in_use=in_use,
+        saturation=round(in_use / pool_stats['pool_max'], 4) if pool_stats.get('pool_max') else None,
+        waiting=pool_stats.get('requests_waiting', 0),
+        checkouts=checkouts,
+        checkouts_queued=queued,
+        queued_ratio=round(queued / checkouts, 4) if checkouts else None,
+        checkout_errors=pool_stats.get('requests_errors', 0),  # gave up after DB_POOL_TIMEOUT
+        wait_ms_total=pool_stats.get('requests_wait_ms', 0),
+        wait_ms_mean=round(pool_stats.get('requests_wait_ms', 0) / checkouts, 3) if checkouts else None,
+        server_connections_opened=pool_stats.get('connections_num', 0),
+        server_connections_lost=pool_stats.get('connections_lost', 0),
+    )
+    return result
@@ -0,0 +1,236 @@
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import Referral
+from .signals import bulk_created, bulk_updated
+
+# Push notifications for referrals, streamed by /api/referrals/events/ (server-sent events, see
+# ReferralEventsView) so referring hospitals stop polling /api/referrals/?referred_from=X.
+# Every referral that is created or changes status becomes one event, published once the
+# transaction commits on the channel of the referring and of the receiving hospital.
+# Events are ready-to-send SSE frames (str), built once however many clients receive them.
+# The broker is picked with settings.REFERRAL_EVENTS_BROKER:
+#   LocalBroker  fan-out inside this process, only reaches clients connected to the same worker
+#   RedisBroker  publishes through redis pub/sub so every worker sees every event (REDIS_URL)
+
+CREATED = 'referral.created'
+STATUS_CHANGED = 'referral.status_changed'
+
+
+def channel(hospital_id):
+    return f'referral-events:hospital:{hospital_id}'
+
+
+def frame(referral, event, previous_status=None):
+    """The SSE frame of one referral event. The id is the referral's sync version, a client that
+    reconnects can catch up with /api/sync/?resources=referrals&since=<last event id>."""
+    data = {
+        'id': referral.pk,
+        'version': referral.version,
+        'patient': referral.patient_id,
+        'referred_from': referral.referred_from_id,
+        'referred_to': referral.referred_to_id,
+        'status': referral.status,
+        'previous_status': previous_status,
+        'referral_date': referral.referral_date,
+        'decision_date': referral.decision_date,
+    }
+    return f'id: {referral.version}\nevent: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+class Subscription:
+    """The events of some channels for one client, read with get() on the event loop that subscribed."""
+
+    def __init__(self, broker, channels, maxsize):
+        self.broker = broker
+        self.channels = list(channels)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def deliver(self, message):
+        # always runs on self.loop
+        if self.queue.full():
+            # the client stopped reading, rather than buffering forever the stream tells it to resync
+            self.overflowed = True
+        else:
+            self.queue.put_nowait(message)
+
+    async def get(self, timeout):
+        """The next message, None if nothing arrived within `timeout` seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """In-process fan-out. publish() is thread safe: sync views and signal receivers call it from
+    worker threads, the message is handed to each subscriber's event loop."""
+
+    queue_size = 100  # events buffered per client before it is considered gone
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}  # channel -> set of Subscription
+
+    def subscribe(self, channels):
+        """Must be called from the event loop the subscription will be read on."""
+        subscription = Subscription(self, channels, self.queue_size)
+        with self.lock:
+            for name in subscription.channels:
+                self.subscribers.setdefault(name, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for name in subscription.channels:
+                subscribers = self.subscribers.get(name)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[name]
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(set().union(*self.subscribers.values())) if self.subscribers else 0
+
+    def publish(self, channel, message):
+        return self.deliver(channel, message)
+
+    def deliver(self, channel, message):
+        """Hand a message to the local subscribers of a channel, returns how many there were."""
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                # its event loop is closed, the client is long gone
+                self.unsubscribe(subscription)
+        return len(subscribers)
+
+
+class RedisBroker(LocalBroker):
+    """LocalBroker whose publish() goes through redis pub/sub. One listener task per worker process
+    receives every channel and hands the messages to the local subscribers, so a worker keeps a
+    single redis connection however many clients it serves."""
+
+    retry_delay = 1  # seconds before reconnecting a lost redis connection
+
+    def __init__(self, url=None):
+        super().__init__()
+        import redis  # only needed when REDIS_URL is set
+
+        self.url = url or settings.REFERRAL_EVENTS_REDIS_URL
+        self.client = redis.Redis.from_url(self.url)
+        self.listener = None
+
+    def publish(self, channel, message):
+        return self.client.publish(channel, message)
+
+    def subscribe(self, channels):
+        subscription = super().subscribe(channels)
+        with self.lock:
+            if self.listener is None or self.listener.done():
+                self.listener = subscription.loop.create_task(self.listen())
+        return subscription
+
+    async def listen(self):
+        from redis import asyncio as aioredis
+        from redis.exceptions import ConnectionError
+
+        while True:
+            client = aioredis.Redis.from_url(self.url)
+            try:
+                async with client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.psubscribe(channel('*'))
+                    async for item in pubsub.listen():
+                        self.deliver(item['channel'].decode(), item['data'].decode())
+            except ConnectionError:
+                # events published while we are disconnected are lost, clients catch up through /api/sync/
+                await asyncio.sleep(self.retry_delay)
+            finally:
+                await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """The process wide broker of settings.REFERRAL_EVENTS_BROKER."""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(settings.REFERRAL_EVENTS_BROKER)()
+        return _broker
+
+
+def publish_on_commit(events):
+    """Publish (referral, event, previous status) tuples once the current transaction commits,
+    nothing is sent if it rolls back."""
+    messages = []
+    for referral, event, previous_status in events:
+        message = frame(referral, event, previous_status)
+        for hospital_id in {referral.referred_from_id, referral.referred_to_id}:
+            messages.append((channel(hospital_id), message))
+    if not messages:
+        return
+
+    def send():
+        broker = get_broker()
+        for name, message in messages:
+            broker.publish(name, message)
+    # robust: a broker that is down must not turn a saved referral into a 500
+    transaction.on_commit(send, robust=True)
+
+
+# Signal receivers, connected in CoreConfig.ready()
+
+@receiver(pre_save, sender=Referral)
+def remember_previous_status(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    # core.rollups loads the previous row first when the rollup is enabled, reuse it
+    previous = getattr(instance, '_rollup_previous', None)
+    if previous is not None:
+        instance._events_previous_status = previous.status
+    else:
+        instance._events_previous_status = (Referral.objects.filter(pk=instance.pk)
+                                            .values_list('status', flat=True).first())
+
+
+@receiver(post_save, sender=Referral)
+def referral_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    previous_status = getattr(instance, '_events_previous_status', None)
+    instance._events_previous_status = None
+    if created:
+        publish_on_commit([(instance, CREATED, None)])
+    elif previous_status is not None and previous_status != instance.status:
+        publish_on_commit([(instance, STATUS_CHANGED, previous_status)])
+
+
+@receiver(bulk_created, sender=Referral)
+def referrals_bulk_created(sender, instances, **kwargs):
+    publish_on_commit([(referral, CREATED, None) for referral in instances])
+
+
+@receiver(bulk_updated, sender=Referral)
+def referrals_bulk_updated(sender, instances, previous=(), **kwargs):
+    previous_status = {referral.pk: referral.status for referral in previous}
+    publish_on_commit([(referral, STATUS_CHANGED, previous_status[referral.pk]) for referral in instances
+                       if referral.pk in previous_status and previous_status[referral.pk] != referral.status])
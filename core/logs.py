@@ -0,0 +1,168 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# Logging that never makes a request wait for the disk (settings.LOGGING).
+#
+# A request thread that logs only:
+#   1. goes through RateLimitFilter, which drops a message already written LOG_RATE_LIMIT times in the
+#      last LOG_RATE_LIMIT_WINDOW seconds (a bad bulk upload retried in a loop logs the same error
+#      over and over); the next copy written after the window says how many were dropped
+#   2. renders the message and traceback, and puts the record on an in-memory queue
+# A background thread per worker process takes the records off the queue, encodes them as one JSON
+# object per line (JSONFormatter) and appends them to the log file, rotated at LOG_MAX_BYTES.
+# If the disk is so slow that the queue fills up, records are dropped rather than waited for, and
+# the next record written counts them.
+
+# attributes every LogRecord has, anything else was passed with extra={...}
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, where it was logged from,
+    the traceback if any, and the extra={...} fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        request = entry.pop('request', None)
+        if request is not None:
+            # django.request passes the HttpRequest itself
+            entry['request'] = {'method': getattr(request, 'method', None), 'path': getattr(request, 'path', None)}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets each distinct message (same logger, level and text) through `rate` times per `per` seconds."""
+
+    max_keys = 1000  # distinct messages remembered, past that the oldest windows are forgotten
+
+    def __init__(self, rate=10, per=60.0):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.lock = threading.Lock()
+        self.windows = {}  # (logger, level, message) -> [window start, records passed, records dropped]
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.per:
+                if len(self.windows) >= self.max_keys:
+                    self.forget(now)
+                dropped = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+                if dropped:
+                    record.suppressed = dropped
+                return True
+            if window[1] < self.rate:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+    def forget(self, now):
+        expired = [key for key, window in self.windows.items() if now - window[0] >= self.per]
+        for key in expired or list(self.windows):
+            del self.windows[key]
+
+
+class QueuedRotatingFileHandler(logging.handlers.QueueHandler):
+    """_summary_
+    A RotatingFileHandler behind a queue: emit() only puts the record on the queue, a
+    QueueListener thread does the formatting and the writing. The formatter given in LOGGING
+    is used by that thread.
+    The listener starts with the first record of each process, so gunicorn workers forked from
+    a master that already configured logging get a thread of their own, and it is stopped (the
+    queue written out) when the process exits.
+    """
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.target = logging.handlers.RotatingFileHandler(filename, maxBytes=maxBytes, backupCount=backupCount,
+                                                           encoding='utf-8', delay=True)
+        self.queue_size = queue_size
+        self.listener = None
+        self.listener_pid = None
+        self.start_lock = threading.Lock()
+        self.dropped = 0
+        self.traceback_formatter = logging.Formatter()
+
+    def setFormatter(self, fmt):
+        # formatting is the listener's job
+        self.target.setFormatter(fmt)
+
+    def start(self):
+        with self.start_lock:
+            if self.listener_pid == os.getpid():
+                return
+            # after a fork the parent's thread is gone and its queue may hold records it already wrote
+            self.queue = queue.Queue(self.queue_size)
+            self.listener = logging.handlers.QueueListener(self.queue, self.target)
+            self.listener.start()
+            self.listener_pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        with self.start_lock:
+            if self.listener is not None and self.listener_pid == os.getpid():
+                self.listener.stop()
+            self.listener = self.listener_pid = None
+
+    def prepare(self, record):
+        # render now what may change or go away once the call returns: the arguments and the traceback
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = self.traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.listener_pid != os.getpid():
+            self.start()
+        if self.dropped:
+            record.dropped, self.dropped = self.dropped, 0
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Wait until every queued record is written."""
+        if self.listener_pid == os.getpid():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        self.stop()
+        self.target.close()
+        super().close()
@@ -0,0 +1,228 @@
+import json
+import random
+import subprocess
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.test import Client
+
+from api.urls import router
+from core import seeding
+from core.benchmarking import QueryCounter, summarize
+from core.models import User
+
+KINDS = ('list', 'filter', 'retrieve', 'batch-create')
+
+# query string of the filter scenario of each router endpoint, see api/filters.py
+FILTERS = {
+    'hospitals': lambda rng, ids: 'type=Private',
+    'users': lambda rng, ids: f"hospital={rng.randrange(*ids['hospitals'])}&role=Doctor",
+    'patients': lambda rng, ids: f'last_name={rng.choice(seeding.LAST_NAMES)}',
+    'medical-history': lambda rng, ids: f"patient={rng.randrange(*ids['patients'])}&ongoing=true",
+    'diagnostics': lambda rng, ids: f"patient={rng.randrange(*ids['patients'])}",
+    'equipment': lambda rng, ids: f"hospital={rng.randrange(*ids['hospitals'])}&available=true",
+    'referrals': lambda rng, ids: f"referred_to={rng.randrange(*ids['hospitals'])}&status=Pending&page_size=50",
+}
+
+# rows sent by the batch create scenario of each router endpoint, made by the generators of core/seeding.py
+GENERATORS = {
+    'hospitals': lambda rng, first, count, ids: seeding.generate_hospitals(rng, first, count),
+    'users': lambda rng, first, count, ids: seeding.generate_users(rng, first, count, ids['hospitals'], '!'),
+    'patients': lambda rng, first, count, ids: seeding.generate_patients(rng, first, count),
+    'medical-history': lambda rng, first, count, ids: seeding.generate_histories(rng, first, count, ids['patients']),
+    'diagnostics': lambda rng, first, count, ids: seeding.generate_diagnostics(rng, first, count, ids['patients']),
+    'equipment': lambda rng, first, count, ids: seeding.generate_equipment(rng, first, count, ids['hospitals']),
+    'referrals': lambda rng, first, count, ids: seeding.generate_referrals(rng, first, count, ids['patients'], ids['hospitals']),
+}
+
+
+def request_data(instance):
+    """The fields of a generated (unsaved) row, as a client would POST them."""
+    return {field.name: field.value_from_object(instance) for field in instance._meta.concrete_fields
+            if field.editable and not field.primary_key}
+
+
+class Command(BaseCommand):
+    help = ("Seed a synthetic dataset (core/seeding.py) and run scripted scenarios against every router "
+            "endpoint of api/urls.py: list, filter, retrieve and batch create, plus token obtain. Requests go "
+            "through the whole Django stack in this process (no server, no network), so the numbers are "
+            "repeatable enough to compare commits: requests per second, p50/p95/p99 latency and queries per "
+            "request, as JSON with --json and compared with an earlier file with --compare. Writes are rolled "
+            "back. Uses the database of DATABASE_URL (a SQLite file or a throwaway Postgres), never run it "
+            "against production. benchmark_serving measures real servers under concurrent load.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000, help='Approximate number of rows to seed')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated data and requests')
+        parser.add_argument('--skip-seed', action='store_true', help='Reuse the data already in the database')
+        parser.add_argument('--scenarios', help='Comma separated endpoints (referrals), kinds (list, filter, retrieve, '
+                                                'batch-create, obtain) or scenarios (referrals:filter). Default: all')
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per scenario')
+        parser.add_argument('--duration', type=float, default=10, help='At most this many seconds per scenario')
+        parser.add_argument('--warmup', type=int, default=5, help='Requests sent before measuring each scenario')
+        parser.add_argument('--batch-size', type=int, default=50, help='Rows per batch create request')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file as JSON')
+        parser.add_argument('--compare', help='Results JSON of an earlier run to compare with')
+        parser.add_argument('--threshold', type=float, default=10,
+                            help='With --compare, a p50 this many percent slower is a regression')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='With --compare, exit with an error when a scenario regressed')
+
+    def handle(self, *args, **options):
+        if settings.DEBUG:
+            self.stdout.write(self.style.WARNING('DEBUG is on: every query is kept in memory, the numbers will be off.'))
+        if not options['skip_seed']:
+            counts = seeding.counts_for_total(options['rows'])
+            self.stdout.write(f'Seeding {counts} ...')
+            seeding.seed(counts, seed=options['seed'], log=self.stdout.write)
+
+        self.ids = self.id_ranges()
+        self.usernames = list(User.objects.filter(username__startswith=seeding.SEED_USERNAME_PREFIX)
+                              .order_by('id').values_list('username', flat=True)[:1000])
+        self.batch_size = options['batch_size']
+        scenarios = self.select(options['scenarios'])
+
+        results = {
+            'commit': self.current_commit(),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'rows': {prefix: viewset.queryset.model.objects.count() for prefix, viewset, _ in router.registry},
+            'requests': options['requests'],
+            'batch_size': options['batch_size'],
+            'seed': options['seed'],
+            'scenarios': {},
+        }
+        client = Client()
+        for scenario in scenarios:
+            results['scenarios'][scenario] = self.run(client, scenario, options)
+            self.report(scenario, results['scenarios'][scenario])
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+        if options['compare']:
+            regressions = self.compare(options['compare'], results, options['threshold'])
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"{len(regressions)} scenario(s) regressed: {', '.join(regressions)}")
+
+    def id_ranges(self):
+        # (first id, last id + 1) of every endpoint's table, for rng.randrange; the seeded ids have no gaps
+        ranges = {}
+        for prefix, viewset, _ in router.registry:
+            bounds = viewset.queryset.model.objects.aggregate(first=Min('id'), last=Max('id'))
+            if bounds['first'] is None:
+                raise CommandError(f'No {prefix} to read, run without --skip-seed.')
+            ranges[prefix] = (bounds['first'], bounds['last'] + 1)
+        return ranges
+
+    def select(self, wanted):
+        scenarios = [f'{prefix}:{kind}' for prefix, _, _ in router.registry for kind in KINDS] + ['token:obtain']
+        if not wanted:
+            return scenarios
+        names = [name.strip() for name in wanted.split(',') if name.strip()]
+        selected = [scenario for scenario in scenarios
+                    if scenario in names or any(part in names for part in scenario.split(':'))]
+        if not selected:
+            raise CommandError(f"No scenario matches {wanted}, choose from {', '.join(scenarios)}")
+        return selected
+
+    def make_request(self, scenario, number):
+        """(method, path, JSON body) of the `number`th request of a scenario"""
+        prefix, kind = scenario.split(':')
+        if kind == 'list':
+            return 'get', f'/api/{prefix}/', None
+        if kind == 'filter':
+            return 'get', f'/api/{prefix}/?{FILTERS[prefix](self.rng, self.ids)}', None
+        if kind == 'retrieve':
+            return 'get', f'/api/{prefix}/{self.rng.randrange(*self.ids[prefix])}/', None
+        if kind == 'batch-create':
+            # numbered past the existing rows so every generated username is new
+            first = self.ids[prefix][1] + number * self.batch_size
+            rows = GENERATORS[prefix](self.rng, first, self.batch_size, self.ids)
+            return 'post', f'/api/{prefix}/', [request_data(row) for row in rows]
+        return 'post', '/api/token/', {'username': self.rng.choice(self.usernames), 'password': seeding.SEED_PASSWORD}
+
+    def run(self, client, scenario, options):
+        if scenario == 'token:obtain' and not self.usernames:
+            self.stdout.write(self.style.WARNING(f'{scenario}: skipped, no seeded users (run without --skip-seed).'))
+            return {'skipped': True}
+        # a generator per scenario: the same requests whichever other scenarios run
+        self.rng = random.Random(f"{options['seed']}:{scenario}")
+        counter = QueryCounter()
+        latencies, queries, statuses = [], [], {}
+        # the writes are rolled back so every run, on every commit, reads the same data
+        with transaction.atomic(), connection.execute_wrapper(counter):
+            for number in range(options['warmup']):
+                self.send(client, *self.make_request(scenario, number))
+            started = time.perf_counter()
+            deadline = started + options['duration']
+            for number in range(options['warmup'], options['warmup'] + options['requests']):
+                if time.perf_counter() > deadline:
+                    break
+                request = self.make_request(scenario, number)
+                before = counter.count
+                sent = time.perf_counter()
+                status = self.send(client, *request)
+                elapsed = (time.perf_counter() - sent) * 1000
+                statuses[status] = statuses.get(status, 0) + 1
+                if 200 <= status < 300:
+                    latencies.append(elapsed)
+                    queries.append(counter.count - before)
+            total = time.perf_counter() - started
+            transaction.set_rollback(True)
+        return {
+            'requests_per_second': round(len(latencies) / total, 1),
+            'failures': sum(count for status, count in statuses.items() if not 200 <= status < 300),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'latency': summarize(latencies),
+            'queries': {'mean': round(sum(queries) / len(queries), 2) if queries else None,
+                        'max': max(queries, default=None)},
+        }
+
+    def send(self, client, method, path, body):
+        if body is None:
+            response = getattr(client, method)(path)
+        else:
+            response = getattr(client, method)(path, body, content_type='application/json')
+        if response.streaming:
+            b''.join(response.streaming_content)
+        return response.status_code
+
+    def report(self, scenario, result):
+        if result.get('skipped'):
+            return
+        latency = result['latency']
+        self.stdout.write(f"{scenario:>28}: {result['requests_per_second']:>8} req/s, p50 {latency.get('p50_ms')} ms, "
+                          f"p95 {latency.get('p95_ms')} ms, p99 {latency.get('p99_ms')} ms, "
+                          f"{result['queries']['mean']} queries, {result['failures']} failures")
+
+    def compare(self, path, results, threshold):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Compared with {path} (commit {baseline.get('commit')})"))
+        regressions = []
+        for scenario, result in results['scenarios'].items():
+            before = baseline['scenarios'].get(scenario)
+            if not before or not before.get('latency', {}).get('count') or not result.get('latency', {}).get('count'):
+                continue
+            # the median: the tail moves too much between runs of the same code to gate on
+            change = (result['latency']['p50_ms'] / before['latency']['p50_ms'] - 1) * 100
+            more_queries = result['queries']['mean'] > before['queries']['mean']
+            line = (f"{scenario:>28}: p50 {before['latency']['p50_ms']} -> {result['latency']['p50_ms']} ms "
+                    f"({change:+.1f}%), p95 {before['latency']['p95_ms']} -> {result['latency']['p95_ms']} ms, "
+                    f"queries {before['queries']['mean']} -> {result['queries']['mean']}")
+            if change > threshold or more_queries:
+                regressions.append(scenario)
+                self.stdout.write(self.style.ERROR(f'{line}  REGRESSION'))
+            else:
+                self.stdout.write(line)
+        return regressions
+
+    def current_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,78 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from api.authentication import CachedJWTAuthentication, ClaimsTokenObtainPairSerializer
+from core.benchmarking import summarize, time_repeated
+from core.models import Hospital, User
+
+# authenticator and settings of each mode
+MODES = {
+    # SimpleJWT's JWTAuthentication, a SELECT on core.User per request (what the api used before)
+    'jwt': (JWTAuthentication, {}),
+    # the user from its cached snapshot, the database only on a miss
+    'cached': (CachedJWTAuthentication, {'AUTH_STATELESS_CLAIMS': False}),
+    # the user from the token's claims, only the revocation is looked up in the cache
+    'stateless': (CachedJWTAuthentication, {'AUTH_STATELESS_CLAIMS': True}),
+}
+
+
+class Command(BaseCommand):
+    help = ("Time the authentication of one API request (token decoding and user lookup) with SimpleJWT's "
+            "JWTAuthentication and with CachedJWTAuthentication, cached and stateless, and count the "
+            "database queries each makes. Creates bench-auth-<n> users, only run it against a throwaway database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Distinct users the requests come from')
+        parser.add_argument('--repeat', type=int, default=5000, help='Requests authenticated per mode')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        tokens = self.tokens(options['users'])
+        factory = RequestFactory()
+        requests = [factory.get('/api/referrals/', HTTP_AUTHORIZATION=f'Bearer {token}') for token in tokens]
+
+        results = {'database': connection.vendor, 'users': len(tokens), 'modes': {}}
+        for mode, (authentication_class, mode_settings) in MODES.items():
+            with override_settings(**mode_settings):
+                results['modes'][mode] = self.measure(authentication_class(), requests, options['repeat'])
+            self.report(mode, results['modes'][mode])
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def tokens(self, count):
+        hospital = Hospital.objects.order_by('id').first() or Hospital.objects.create(name='Benchmark Hospital', type='Public')
+        tokens = []
+        for number in range(count):
+            user, _ = User.objects.get_or_create(username=f'bench-auth-{number}',
+                                                 defaults={'hospital': hospital, 'role': 'Doctor'})
+            tokens.append(str(ClaimsTokenObtainPairSerializer.get_token(user).access_token))
+        return tokens
+
+    def measure(self, authentication, requests, repeat):
+        position = 0
+
+        def authenticate():
+            nonlocal position
+            request = Request(requests[position % len(requests)])
+            position += 1
+            user, _ = authentication.authenticate(request)
+            assert user.hospital_id is not None
+
+        # one pass over every user first: fills the cache of the cached mode, opens the database connection
+        for _ in requests:
+            authenticate()
+        with CaptureQueriesContext(connection) as queries:
+            samples = time_repeated(authenticate, repeat)
+        return {**summarize(samples), 'queries_per_request': round(len(queries) / repeat, 3)}
+
+    def report(self, mode, result):
+        self.stdout.write(f"{mode:>10}: mean {result['mean_ms']} ms, p50 {result['p50_ms']} ms, "
+                          f"p99 {result['p99_ms']} ms, {result['queries_per_request']} queries per request")
@@ -0,0 +1,96 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+
+from core.benchmarking import summarize, time_repeated
+from core.models import Diagnostic, Equipment, Hospital, MedicalHistory, Patient, Referral
+from core.seeding import counts_for_total, seed
+
+
+class Command(BaseCommand):
+    help = ("Seed a synthetic dataset and compare query plans and latencies of the hot API filters "
+            "without and with the Meta.indexes declared in core/models.py. "
+            "Only run this against a throwaway benchmark database: the indexes are dropped and recreated.")
+
+    indexed_models = [Referral, Diagnostic, MedicalHistory, Equipment]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Approximate number of rows to seed')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated data')
+        parser.add_argument('--skip-seed', action='store_true', help='Reuse the data already in the database')
+        parser.add_argument('--repeat', type=int, default=50, help='Times each query is run per phase')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        if not options['skip_seed']:
+            counts = counts_for_total(options['rows'])
+            self.stdout.write(f'Seeding {counts} ...')
+            seed(counts, seed=options['seed'], log=self.stdout.write)
+
+        queries = self.hot_queries()
+        results = {}
+        try:
+            self.set_indexes(enabled=False)
+            results['before'] = self.measure(queries, options['repeat'])
+        finally:
+            # always put the indexes back, even if a query blows up
+            self.set_indexes(enabled=True)
+        results['after'] = self.measure(queries, options['repeat'])
+
+        self.report(results)
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def hot_queries(self):
+        # the filter combinations our clients actually send, see api/views.py
+        hospital = Hospital.objects.order_by('id').values_list('id', flat=True).first()
+        patient = Patient.objects.order_by('-id').values_list('id', flat=True).first()
+        return {
+            'pending referrals to hospital': lambda: Referral.objects.filter(referred_to=hospital, status='Pending').order_by('-referral_date'),
+            'referrals from hospital by status': lambda: Referral.objects.filter(referred_from=hospital, status='Accepted').order_by('-referral_date'),
+            'referrals of patient': lambda: Referral.objects.filter(patient=patient).order_by('referral_date'),
+            'diagnostics of patient by date': lambda: Diagnostic.objects.filter(patient=patient).order_by('date_taken'),
+            'ongoing treatments of patient': lambda: MedicalHistory.objects.filter(patient=patient, end_date__isnull=True),
+            'medical history of patient': lambda: MedicalHistory.objects.filter(patient=patient).order_by('start_date'),
+            'available equipment at hospital': lambda: Equipment.objects.filter(hospital=hospital, available=True),
+            'hospitals with available equipment': lambda: Equipment.objects.filter(equipment_name='Dialysis Machine', available=True),
+            'hospital candidates for equipment': lambda: (Equipment.objects
+                                                          .filter(available=True, normalized_name__in=['dialysis machine', 'mri machine'])
+                                                          .values('hospital')
+                                                          .annotate(matched=Count('normalized_name', distinct=True), units=Count('normalized_name'))
+                                                          .filter(matched=2)
+                                                          .order_by('-matched', '-units', 'hospital')[:20]),
+        }
+
+    def set_indexes(self, enabled):
+        with connection.schema_editor() as schema_editor:
+            for model in self.indexed_models:
+                for index in model._meta.indexes:
+                    if enabled:
+                        schema_editor.add_index(model, index)
+                    else:
+                        schema_editor.remove_index(model, index)
+        # refresh planner statistics so the plans reflect the current set of indexes
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def measure(self, queries, repeat):
+        measured = {}
+        for label, build in queries.items():
+            measured[label] = {
+                'plan': build().explain(),
+                'latency': summarize(time_repeated(lambda: list(build()), repeat)),
+            }
+        return measured
+
+    def report(self, results):
+        for label in results['after']:
+            before, after = results['before'][label], results['after'][label]
+            self.stdout.write(self.style.MIGRATE_HEADING(label))
+            self.stdout.write(f"  before: p50 {before['latency']['p50_ms']} ms, p95 {before['latency']['p95_ms']} ms")
+            self.stdout.write(f"    {before['plan']}".replace('\n', '\n    '))
+            self.stdout.write(f"  after:  p50 {after['latency']['p50_ms']} ms, p95 {after['latency']['p95_ms']} ms")
+            self.stdout.write(f"    {after['plan']}".replace('\n', '\n    '))
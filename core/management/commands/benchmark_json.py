@@ -0,0 +1,79 @@
+import io
+import json
+import random
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from api.parsers import FastJSONParser
+from api.renderers import FastJSONRenderer, orjson
+from core import seeding
+from core.benchmarking import summarize, time_repeated
+from core.models import Equipment
+from core.serializers import (DiagnosticSerializer, EquipmentSerializer, HospitalSerializer, MedicalHistorySerializer,
+                              PatientSerializer, ReferralSerializer)
+
+
+def with_normalized_names(equipment):
+    # the database computes normalized_name, set it by hand on these unsaved rows
+    equipment = list(equipment)
+    for unit, name in zip(equipment, Equipment.normalize_names(unit.equipment_name for unit in equipment)):
+        unit.normalized_name = name
+        yield unit
+
+
+# payload name -> (serializer, rows generator of core/seeding.py)
+PAYLOADS = {
+    'hospitals': (HospitalSerializer, lambda rng, count: seeding.generate_hospitals(rng, 1, count)),
+    'patients': (PatientSerializer, lambda rng, count: seeding.generate_patients(rng, 1, count)),
+    'medical-history': (MedicalHistorySerializer, lambda rng, count: seeding.generate_histories(rng, 1, count, (1, 1000))),
+    'diagnostics': (DiagnosticSerializer, lambda rng, count: seeding.generate_diagnostics(rng, 1, count, (1, 1000))),
+    'equipment': (EquipmentSerializer, lambda rng, count: with_normalized_names(seeding.generate_equipment(rng, 1, count, (1, 50)))),
+    'referrals': (ReferralSerializer, lambda rng, count: seeding.generate_referrals(rng, 1, count, (1, 1000), (1, 50))),
+}
+
+
+class Command(BaseCommand):
+    help = ("Render list payloads of every core model (built in memory with the generators of core/seeding.py, "
+            "no database needed) with DRF's JSONRenderer and with api.renderers.FastJSONRenderer, parse them back "
+            "with JSONParser and FastJSONParser, and compare the latencies. Also checks both renderers "
+            "produce the same bytes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000, help='Rows per payload, e.g. a page_size=1000 list')
+        parser.add_argument('--repeat', type=int, default=50, help='Times each payload is rendered and parsed')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated rows')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stdout.write(self.style.WARNING('orjson is not installed, FastJSONRenderer falls back to the json module.'))
+        rng = random.Random(options['seed'])
+        results = {'orjson': orjson.__version__ if orjson else None, 'rows': options['rows'], 'payloads': {}}
+        for name, (serializer_class, generate) in PAYLOADS.items():
+            data = serializer_class(list(generate(rng, options['rows'])), many=True).data
+            results['payloads'][name] = self.measure(data, options['repeat'])
+            self.report(name, results['payloads'][name])
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def measure(self, data, repeat):
+        standard, fast = JSONRenderer(), FastJSONRenderer()
+        body = standard.render(data)
+        result = {'bytes': len(body), 'identical_output': fast.render(data) == body}  # also warms up both
+        for name, renderer, parser in (('json', standard, JSONParser()), ('fast', fast, FastJSONParser())):
+            result[f'render_{name}'] = summarize(time_repeated(lambda: renderer.render(data), repeat))
+            result[f'parse_{name}'] = summarize(time_repeated(lambda: parser.parse(io.BytesIO(body)), repeat))
+        for step in ('render', 'parse'):
+            result[f'{step}_speedup'] = round(result[f'{step}_json']['mean_ms'] / result[f'{step}_fast']['mean_ms'], 1)
+        return result
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:>16}: {result['bytes'] // 1024} KB, render {result['render_json']['mean_ms']} -> "
+            f"{result['render_fast']['mean_ms']} ms (x{result['render_speedup']}), parse "
+            f"{result['parse_json']['mean_ms']} -> {result['parse_fast']['mean_ms']} ms (x{result['parse_speedup']}), "
+            f"identical output: {result['identical_output']}")
@@ -0,0 +1,153 @@
+import functools
+import json
+import random
+import statistics
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Min
+from django.test import Client, override_settings
+
+from api.middleware import RequestMetricsMiddleware
+from core import profiling, seeding
+from core.benchmarking import QueryCounter
+from core.models import Patient, Referral
+
+# the overheads are relative to 'off'
+MODES = ('off', 'sampled', 'every request')
+
+
+class ProfilerClock:
+    """Time spent in the profiler's own code while requests run: starting a profile (the sampling
+    decision), recording each query and reporting the findings. Unlike the difference between two
+    wall clock runs, this share doesn't drown in the noise of a busy machine."""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def wrap(self, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - started
+        return timed
+
+    def patch(self):
+        return [mock.patch.object(profiling, 'start', self.wrap(profiling.start)),
+                mock.patch.object(profiling.Profile, 'record', self.wrap(profiling.Profile.record)),
+                mock.patch.object(RequestMetricsMiddleware, 'report_profile', self.wrap(RequestMetricsMiddleware.report_profile))]
+
+
+class Command(BaseCommand):
+    help = ("Measure what the query profiler (core/profiling.py) costs: the same list, filter and retrieve "
+            "requests with the profiler off, sampling at --sample-rate and profiling every request, in "
+            "alternating rounds so drift hits every mode alike. Prints the median latency of each mode, its "
+            "overhead over 'off', and the share of the request time spent in the profiler's own code, which "
+            "is what --max-overhead checks. Also checks no profiled request ran extra queries (EXPLAIN is left to "
+            "dump_query_profiles). The response cache is bypassed so every request reaches the database. "
+            "Seeds a synthetic dataset, only run it against a throwaway database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20_000, help='Approximate number of rows to seed')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated data and requests')
+        parser.add_argument('--skip-seed', action='store_true', help='Reuse the data already in the database')
+        parser.add_argument('--sample-rate', type=float, default=0.01, help='QUERY_PROFILER_SAMPLE_RATE of the sampled mode')
+        parser.add_argument('--rounds', type=int, default=15, help='Rounds, each runs every mode once')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per mode and round')
+        parser.add_argument('--max-overhead', type=float,
+                            help="Exit with an error when the profiler's code takes more than this many percent "
+                                 "of the request time in the sampled mode")
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        if settings.DEBUG:
+            self.stdout.write(self.style.WARNING('DEBUG is on: every query is kept in memory, the numbers will be off.'))
+        if not options['skip_seed']:
+            counts = seeding.counts_for_total(options['rows'])
+            self.stdout.write(f'Seeding {counts} ...')
+            seeding.seed(counts, seed=options['seed'], log=self.stdout.write)
+        paths = self.paths(random.Random(options['seed']), options['requests'])
+        rates = {'off': 0, 'sampled': options['sample_rate'], 'every request': 1.0}
+
+        caches = {**settings.CACHES,
+                  'profiler-benchmark-none': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+                  'profiler-benchmark': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                         'LOCATION': 'profiler-benchmark'}}
+        # the findings go to a throwaway buffer, not the one of the workers on this machine
+        with override_settings(CACHES=caches, API_CACHE_ALIAS='profiler-benchmark-none',
+                               QUERY_PROFILER_CACHE_ALIAS='profiler-benchmark', QUERY_PROFILER_EXPLAIN=True):
+            client = Client()
+            self.send(client, paths, rates['off'])  # warm up: connection, url resolver, lazy imports
+            rounds = {mode: [] for mode in MODES}
+            shares = {mode: [] for mode in MODES}
+            queries = {}
+            for number in range(options['rounds']):
+                # rotate the order, the first mode of a round would otherwise always run on a cooler process
+                order = MODES[number % len(MODES):] + MODES[:number % len(MODES)]
+                for mode in order:
+                    mean_ms, profiler_share, query_count = self.send(client, paths, rates[mode])
+                    rounds[mode].append(mean_ms)
+                    shares[mode].append(profiler_share)
+                    queries.setdefault(mode, query_count)
+
+        baseline = statistics.median(rounds['off'])
+        results = {'database': connection.vendor, 'requests_per_round': len(paths), 'rounds': options['rounds'],
+                   'sample_rate': options['sample_rate'], 'modes': {}}
+        for mode in MODES:
+            median = statistics.median(rounds[mode])
+            results['modes'][mode] = {'median_ms': round(median, 4), 'overhead_pct': round((median / baseline - 1) * 100, 2),
+                                      'profiler_pct': round(statistics.median(shares[mode]) * 100, 3),
+                                      'queries_per_round': queries[mode]}
+            self.stdout.write(f"{mode:>14}: {results['modes'][mode]['median_ms']} ms per request, "
+                              f"overhead {results['modes'][mode]['overhead_pct']:+}% (wall clock), "
+                              f"{results['modes'][mode]['profiler_pct']}% in the profiler, {queries[mode]} queries per round")
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+        if len(set(queries.values())) > 1:
+            raise CommandError('The profiled requests ran a different number of queries than the unprofiled ones.')
+        overhead = results['modes']['sampled']['profiler_pct']
+        if options['max_overhead'] is not None and overhead > options['max_overhead']:
+            raise CommandError(f"Sampling at {options['sample_rate']} spends {overhead}% of the request time in the "
+                               f"profiler, above --max-overhead {options['max_overhead']}%.")
+
+    def paths(self, rng, count):
+        patients = Patient.objects.aggregate(first=Min('id'), last=Max('id'))
+        referrals = Referral.objects.aggregate(first=Min('id'), last=Max('id'))
+        if referrals['first'] is None or patients['first'] is None:
+            raise CommandError('No referrals to read, run without --skip-seed.')
+        # the same requests in every round
+        kinds = (
+            lambda: '/api/referrals/?page_size=50&expand=patient',
+            lambda: f"/api/referrals/?patient={rng.randint(patients['first'], patients['last'])}",
+            lambda: f"/api/referrals/{rng.randint(referrals['first'], referrals['last'])}/",
+            lambda: f"/api/patients/{rng.randint(patients['first'], patients['last'])}/dossier/",
+        )
+        return [kinds[number % len(kinds)]() for number in range(count)]
+
+    def send(self, client, paths, rate):
+        """(mean latency in ms, share of the time spent in the profiler, queries) of one pass over
+        the paths with the given sample rate"""
+        counter, clock = QueryCounter(), ProfilerClock()
+        patches = clock.patch()
+        with override_settings(QUERY_PROFILER_SAMPLE_RATE=rate), connection.execute_wrapper(counter):
+            for patch in patches:
+                patch.start()
+            try:
+                started = time.perf_counter()
+                for path in paths:
+                    response = client.get(path)
+                    if response.status_code != 200:
+                        raise CommandError(f'{path} answered {response.status_code}.')
+                elapsed = time.perf_counter() - started
+            finally:
+                for patch in patches:
+                    patch.stop()
+        return elapsed * 1000 / len(paths), clock.seconds / elapsed, counter.count
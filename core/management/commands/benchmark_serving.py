@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarking import fetch, http_load
+from core.models import Hospital, Patient, Referral
+from core.seeding import counts_for_total, seed
+
+# server command line and extra environment of each serving mode
+MODES = {
+    # gunicorn sync workers behind referral_app/wsgi.py, how the app is deployed today
+    'wsgi': (['-m', 'gunicorn', 'referral_app.wsgi:application', '--bind', '127.0.0.1:{port}',
+              '--workers', '{workers}', '--log-level', 'warning'], {'API_ASYNC_READS': 'False'}),
+    # referral_app/asgi.py with the sync viewsets (Django runs them in a thread per request)
+    'asgi-sync': (['-m', 'uvicorn', 'referral_app.asgi:application', '--port', '{port}',
+                   '--workers', '{workers}', '--log-level', 'warning'], {'API_ASYNC_READS': 'False'}),
+    # referral_app/asgi.py with list/retrieve served by AsyncReadMixin
+    'asgi-async': (['-m', 'uvicorn', 'referral_app.asgi:application', '--port', '{port}',
+                    '--workers', '{workers}', '--log-level', 'warning'], {'API_ASYNC_READS': 'True'}),
+}
+
+
+class Command(BaseCommand):
+    help = ("Serve the API with gunicorn sync workers (wsgi) and with uvicorn (asgi, with and without the "
+            "async read path) in turn, hit the list and retrieve endpoints with a concurrent load generator "
+            "and compare requests per second and p50/p99 latency. Uses the database of DATABASE_URL "
+            "(a SQLite file or a throwaway Postgres), never run it against production.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000, help='Approximate number of rows to seed')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated data')
+        parser.add_argument('--skip-seed', action='store_true', help='Reuse the data already in the database')
+        parser.add_argument('--modes', default=','.join(MODES), help=f"Comma separated, from {', '.join(MODES)}")
+        parser.add_argument('--workers', type=int, default=2, help='Server worker processes per mode')
+        parser.add_argument('--concurrency', type=int, default=32, help='Concurrent clients')
+        parser.add_argument('--duration', type=float, default=15, help='Seconds of load per mode')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        modes = [mode for mode in options['modes'].split(',') if mode]
+        unknown = [mode for mode in modes if mode not in MODES]
+        if unknown:
+            raise CommandError(f"Unknown mode(s) {', '.join(unknown)}")
+        if settings.DATABASES['default']['NAME'] == ':memory:':
+            raise CommandError('The servers need a database they can share, use a file or a postgres DATABASE_URL.')
+
+        if not options['skip_seed']:
+            counts = counts_for_total(options['rows'])
+            self.stdout.write(f'Seeding {counts} ...')
+            seed(counts, seed=options['seed'], log=self.stdout.write)
+
+        paths = self.read_paths()
+        results = {'database': settings.DATABASES['default']['ENGINE'], 'paths': paths, 'modes': {}}
+        for mode in modes:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{mode}: {options["workers"]} workers, '
+                                                         f'{options["concurrency"]} clients, {options["duration"]}s'))
+            results['modes'][mode] = self.run_mode(mode, paths, options)
+            self.report(results['modes'][mode])
+
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def read_paths(self):
+        # the reads clients send most, see the filters in api/filters.py
+        hospital = Hospital.objects.order_by('id').values_list('id', flat=True).first()
+        patient = Patient.objects.order_by('-id').values_list('id', flat=True).first()
+        referral = Referral.objects.order_by('id').values_list('id', flat=True).first()
+        if None in (hospital, patient, referral):
+            raise CommandError('No data to read, run without --skip-seed.')
+        return [
+            f'/api/referrals/?referred_to={hospital}&status=Pending&page_size=50',
+            f'/api/referrals/?referred_from={hospital}&page_size=100&expand=patient,referred_to',
+            f'/api/referrals/{referral}/',
+            f'/api/patients/{patient}/',
+            f'/api/diagnostics/?patient={patient}',
+            f'/api/medical-history/?patient={patient}',
+            f'/api/equipment/?hospital={hospital}&available=true',
+        ]
+
+    def run_mode(self, mode, paths, options):
+        arguments, environment = MODES[mode]
+        command = [sys.executable] + [argument.format(port=options['port'], workers=options['workers'])
+                                      for argument in arguments]
+        server = subprocess.Popen(command, env={**os.environ, **environment})
+        try:
+            self.wait_until_ready(server, options['port'], paths[0])
+            # one warm up round so every worker has connected to the database and loaded the code
+            asyncio.run(http_load('127.0.0.1', options['port'], paths, options['concurrency'], 1))
+            return asyncio.run(http_load('127.0.0.1', options['port'], paths, options['concurrency'],
+                                         options['duration']))
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+
+    def wait_until_ready(self, server, port, path, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'The server exited with code {server.returncode}')
+            try:
+                status, _ = asyncio.run(fetch('127.0.0.1', port, path))
+                if status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise CommandError(f'The server did not answer within {timeout}s')
+
+    def report(self, result):
+        latency = result['latency']
+        self.stdout.write(f"  {result['requests_per_second']} req/s, p50 {latency.get('p50_ms')} ms, "
+                          f"p99 {latency.get('p99_ms')} ms, {result['failures']} failures")
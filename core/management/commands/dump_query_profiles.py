@@ -0,0 +1,87 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core import profiling
+
+
+class Command(BaseCommand):
+    help = ("Print what the sampled query profiler (core/profiling.py, QUERY_PROFILER_SAMPLE_RATE) found: "
+            "queries repeated within one request (N+1) and slow queries, grouped by SQL fingerprint with "
+            "the worst case, the endpoints and the line of code that ran them. Reads the ring buffer "
+            "the workers write to in the query_profiler cache. With QUERY_PROFILER_EXPLAIN the slow SELECTs "
+            "are EXPLAINed here, against the data as it is now, the requests never run EXPLAIN themselves.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=['repeated', 'slow'], help='Only this kind of finding')
+        parser.add_argument('--endpoint', help='Only requests to this url name, e.g. referral-list')
+        parser.add_argument('--entries', action='store_true', help='Print every request (newest first) instead of the summary')
+        parser.add_argument('--json', dest='json_path', help='Also write the raw entries to this file as JSON')
+        parser.add_argument('--no-explain', action='store_true', help="Don't run EXPLAIN on the slow queries")
+        parser.add_argument('--clear', action='store_true', help='Empty the buffer afterwards')
+
+    def handle(self, *args, **options):
+        entries = [entry for entry in profiling.entries()
+                   if options['endpoint'] in (None, entry['endpoint'])]
+        for entry in entries:
+            entry['findings'] = [finding for finding in entry['findings'] if options['kind'] in (None, finding['kind'])]
+        entries = [entry for entry in entries if entry['findings']]
+        self.explain = not options['no_explain']
+
+        if not entries:
+            self.stdout.write('No findings. Is QUERY_PROFILER_SAMPLE_RATE above 0, and do the workers and this '
+                              'command share the query_profiler cache (REDIS_URL or the same machine)?')
+        elif options['entries']:
+            for entry in reversed(entries):
+                for finding in entry['findings']:
+                    self.add_explain(finding).pop('replay', None)
+                self.stdout.write(json.dumps(entry, indent=2, default=str))
+        else:
+            self.summary(entries)
+
+        if options['json_path']:
+            for entry in entries:
+                for finding in entry['findings']:
+                    finding.pop('replay', None)  # the raw parameters, kept only for EXPLAIN
+            with open(options['json_path'], 'w') as output:
+                json.dump(entries, output, indent=2, default=str)
+        if options['clear']:
+            profiling.clear()
+
+    def summary(self, entries):
+        groups = {}
+        for entry in entries:
+            for finding in entry['findings']:
+                group = groups.setdefault((finding['kind'], finding['fingerprint']), {
+                    'requests': 0, 'endpoints': set(), 'worst': finding, 'origins': set()})
+                group['requests'] += 1
+                group['endpoints'].add(f"{entry['method']} {entry['endpoint']}")
+                group['origins'].add(finding['origin'])
+                if self.cost(finding) > self.cost(group['worst']):
+                    group['worst'] = finding
+
+        # the most expensive first
+        ordered = sorted(groups.items(), key=lambda item: item[1]['requests'] * self.cost(item[1]['worst']), reverse=True)
+        self.stdout.write(f'{len(entries)} requests with findings\n')
+        for (kind, fingerprint), group in ordered:
+            worst = self.add_explain(group['worst'])
+            if kind == 'repeated':
+                heading = f"REPEATED up to {worst['count']}x per request ({worst['total_ms']} ms)"
+            else:
+                heading = f"SLOW up to {worst['ms']} ms"
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{heading} in {group['requests']} requests"))
+            self.stdout.write(f"  endpoints: {', '.join(sorted(group['endpoints']))}")
+            self.stdout.write(f"  from:      {', '.join(sorted(str(origin) for origin in group['origins']))}")
+            self.stdout.write(f'  sql:       {fingerprint[:1000]}')
+            if worst.get('explain'):
+                self.stdout.write('  explain:\n' + '\n'.join(f'    {line}' for line in worst['explain'].splitlines()))
+            self.stdout.write('')
+
+    def add_explain(self, finding):
+        # once per finding, the summary only explains the worst case of each group
+        if self.explain and 'replay' in finding and 'explain' not in finding:
+            finding['explain'] = profiling.explain(finding)
+        return finding
+
+    def cost(self, finding):
+        return finding['total_ms'] if finding['kind'] == 'repeated' else finding['ms']
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import resource
+import threading
+import time
+
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core import events
+from core.benchmarking import summarize
+from core.models import Hospital, Referral, User
+
+
+def rss_mb():
+    """Resident memory of this process in MB (peak RSS where /proc isn't available)."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Client:
+    """One idle EventSource, talking to the ASGI application directly (no sockets)."""
+
+    def __init__(self, token):
+        self.token = token
+        self.status = None
+        self.received = {}  # event id -> perf_counter() when it arrived
+        self.subscribed = asyncio.Event()
+        self.gone = asyncio.Event()
+        self.task = None
+        self.body_read = False
+
+    def start(self, application):
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+            'path': '/api/referrals/events/', 'raw_path': b'/api/referrals/events/', 'query_string': b'',
+            'root_path': '', 'headers': [(b'host', b'localhost'), (b'accept', b'text/event-stream'),
+                                         (b'authorization', f'Bearer {self.token}'.encode())],
+            'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+        }
+        self.task = asyncio.ensure_future(application(scope, self.receive, self.send))
+
+    async def receive(self):
+        if not self.body_read:
+            self.body_read = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await self.gone.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+            if self.status != 200:
+                self.subscribed.set()
+        elif message['type'] == 'http.response.body':
+            now = time.perf_counter()
+            body = message.get('body', b'')
+            if b'subscribed' in body:
+                self.subscribed.set()
+            for line in body.split(b'\n'):
+                if line.startswith(b'id: '):
+                    self.received[int(line[4:])] = now
+
+    async def disconnect(self):
+        self.gone.set()
+        await self.task
+
+
+class Command(BaseCommand):
+    help = ("Connect thousands of idle /api/referrals/events/ subscribers to the ASGI application in this "
+            "process (one worker), publish referral events and report memory per subscriber and fan-out "
+            "latency. Uses the LocalBroker unless REDIS_URL is set. Creates a loadtest-<hospital id> user "
+            "per hospital used, so only run it against a throwaway database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=5000, help='Idle clients to connect')
+        parser.add_argument('--hospitals', type=int, default=50, help='Spread the clients over this many hospitals')
+        parser.add_argument('--events', type=int, default=20, help='Referral events to publish')
+        parser.add_argument('--idle', type=float, default=5, help='Seconds to keep the clients idle before publishing')
+        parser.add_argument('--json', dest='json_path', help='Also write the results to this file as JSON')
+
+    def handle(self, *args, **options):
+        hospital_ids = list(Hospital.objects.order_by('id').values_list('id', flat=True)[:options['hospitals']])
+        if len(hospital_ids) < 2:
+            raise CommandError('Needs at least 2 hospitals, seed some first (e.g. benchmark_indexes --rows 10000).')
+        tokens = {}
+        for hospital_id in hospital_ids:
+            user, _ = User.objects.get_or_create(username=f'loadtest-{hospital_id}', defaults={'hospital_id': hospital_id})
+            tokens[hospital_id] = str(AccessToken.for_user(user))
+
+        results = asyncio.run(self.run(hospital_ids, tokens, options))
+        self.stdout.write(json.dumps(results, indent=2))
+        if options['json_path']:
+            with open(options['json_path'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    async def run(self, hospital_ids, tokens, options):
+        application = get_asgi_application()
+        broker = events.get_broker()
+        memory_before = rss_mb()
+
+        started = time.perf_counter()
+        clients = []
+        for index in range(options['subscribers']):
+            hospital_id = hospital_ids[index % len(hospital_ids)]
+            client = Client(tokens[hospital_id])
+            client.hospital_id = hospital_id
+            client.start(application)
+            clients.append(client)
+        await asyncio.gather(*(client.subscribed.wait() for client in clients))
+        connect_seconds = time.perf_counter() - started
+        failed = sum(client.status != 200 for client in clients)
+        if failed:
+            raise CommandError(f'{failed} subscribers were refused')
+
+        await asyncio.sleep(options['idle'])
+        memory_idle = rss_mb()
+
+        # publish from another thread, the way a sync view's on_commit callback does
+        published = {}
+        referral = Referral(referral_date='2024-05-01', status='Accepted', patient_id=0)
+
+        def publish():
+            for number in range(1, options['events'] + 1):
+                referral.pk = referral.version = number
+                referral.referred_from_id = hospital_ids[number % len(hospital_ids)]
+                referral.referred_to_id = hospital_ids[(number + 1) % len(hospital_ids)]
+                message = events.frame(referral, events.STATUS_CHANGED, 'Pending')
+                published[number] = time.perf_counter()
+                for hospital_id in {referral.referred_from_id, referral.referred_to_id}:
+                    broker.publish(events.channel(hospital_id), message)
+                time.sleep(0.05)
+        await asyncio.to_thread(publish)
+        await asyncio.sleep(1)
+
+        latencies, expected, delivered = [], 0, 0
+        for number, sent_at in published.items():
+            audience = {hospital_ids[number % len(hospital_ids)], hospital_ids[(number + 1) % len(hospital_ids)]}
+            for client in clients:
+                if client.hospital_id in audience:
+                    expected += 1
+                    if number in client.received:
+                        delivered += 1
+                        latencies.append((client.received[number] - sent_at) * 1000)
+
+        await asyncio.gather(*(client.disconnect() for client in clients))
+        return {
+            'subscribers': len(clients),
+            'threads': threading.active_count(),
+            'connect_seconds': round(connect_seconds, 2),
+            'rss_mb_before': round(memory_before, 1),
+            'rss_mb_idle': round(memory_idle, 1),
+            'kb_per_subscriber': round((memory_idle - memory_before) * 1024 / len(clients), 2),
+            'events_published': len(published),
+            'deliveries_expected': expected,
+            'deliveries_received': delivered,
+            'fanout_latency': summarize(latencies),
+            'subscribers_left_after_disconnect': broker.subscriber_count(),
+        }
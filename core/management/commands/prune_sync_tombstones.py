@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core import sync
+
+
+class Command(BaseCommand):
+    help = ("Delete the /api/sync/ tombstones of rows deleted more than --days ago. Clients that last "
+            "synced before that get a 410 and download everything again, so keep it above the longest "
+            "time a clinic can stay offline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Keep tombstones younger than this')
+
+    def handle(self, *args, **options):
+        deleted = sync.prune_tombstones(older_than_days=options['days'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} tombstones'))
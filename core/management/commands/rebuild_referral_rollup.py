@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core import rollups
+
+
+class Command(BaseCommand):
+    help = ("Recompute the ReferralDailyStat rollup used by /api/referrals/analytics/?source=rollup "
+            "from the referrals table. Run it once after enabling the rollup or after loading data with raw SQL.")
+
+    def handle(self, *args, **options):
+        buckets = rollups.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {buckets} referral rollup buckets'))
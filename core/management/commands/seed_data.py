@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import cache
+from core import seeding
+
+
+class Command(BaseCommand):
+    help = ("Fill the database with consistent synthetic rows of every model in core/models.py (hospitals, "
+            "users, patients, medical history, diagnostics, equipment and referrals, at the ratios of "
+            "core/seeding.py), millions of them if needed, to reproduce production performance problems "
+            "locally. Loads with COPY on postgres and chunked bulk_create elsewhere, in parallel processes "
+            "where the foreign keys allow. The same --rows and --seed give the same rows on an empty "
+            "database (run `manage.py flush` first). The seeded users log in with the password "
+            f"'{seeding.SEED_PASSWORD}'. Never run it against production.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Approximate number of rows in total')
+        for key in seeding.MODELS:
+            parser.add_argument(f'--{key}', type=int, help=f'Exact number of {key}, instead of its share of --rows')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for the generated data')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes loading in parallel, worth it on postgres (sqlite takes one writer at a time)')
+        parser.add_argument('--method', choices=['auto', 'copy', 'bulk'], default='auto',
+                            help='copy: COPY FROM STDIN (postgres), bulk: bulk_create, auto: copy when possible')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per INSERT or COPY')
+
+    def handle(self, *args, **options):
+        counts = seeding.counts_for_total(options['rows'])
+        counts.update({key: options[key] for key in seeding.MODELS if options[key] is not None})
+        if counts['hospitals'] < 2 and (counts['referrals'] or counts['equipment'] or counts['users']):
+            raise CommandError('Referrals, equipment and users need at least 2 hospitals.')
+        if counts['patients'] < 1 and (counts['referrals'] or counts['histories'] or counts['diagnostics']):
+            raise CommandError('Referrals, histories and diagnostics need at least 1 patient.')
+        method = seeding.load_method(options['method'])
+        self.stdout.write(f"Seeding {counts} into {settings.DATABASES['default']['ENGINE']} with {method}, "
+                          f"{options['workers']} worker(s) ...")
+
+        started = time.perf_counter()
+        inserted = seeding.seed(counts, seed=options['seed'], batch_size=options['batch_size'], log=self.stdout.write,
+                                workers=options['workers'], method=method)
+        elapsed = time.perf_counter() - started
+        # bulk inserts send no signals, drop the cached API responses ourselves
+        cache.invalidate(*seeding.MODELS.values())
+
+        total = sum(inserted.values())
+        self.stdout.write(self.style.SUCCESS(f'Inserted {total} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)'))
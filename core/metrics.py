@@ -0,0 +1,177 @@
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+# Per-request performance numbers and the per-endpoint histograms of this worker process.
+#
+# RequestMetricsMiddleware (api/middleware.py) starts a RequestMetrics for every request and keeps it
+# in a context variable, which follows the request into sync_to_async threads and the async views.
+# While it runs:
+#   - every SQL query is counted and timed by an execute wrapper installed on each new connection,
+#     and handed to the query profiler (core/profiling.py) when it sampled the request
+#   - serializers (core/serializers.py), the JSON renderer and the JWT authentication time themselves
+#     with timer(); a timer leaves out the queries run inside it, those count as db time only
+# When the response is ready the middleware adds a Server-Timing header and observe()s the numbers
+# into the histograms, which /api/metrics/ exposes in the Prometheus text format.
+
+PHASES = ('auth', 'serialize', 'render')
+
+# histogram bucket upper bounds, Prometheus style
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class RequestMetrics:
+    """The numbers of one request. Durations in seconds."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.profile = None  # a core.profiling.Profile when the query profiler sampled this request
+
+    @contextmanager
+    def timer(self, phase):
+        started, db_time = time.perf_counter(), self.db_time
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.perf_counter() - started - (self.db_time - db_time)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """The Server-Timing header value, durations in milliseconds (shown by the browsers' devtools)."""
+        entries = [f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries"']
+        entries += [f'{phase};dur={self.phases[phase] * 1000:.2f}' for phase in PHASES]
+        entries.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(entries)
+
+
+current = contextvars.ContextVar('request_metrics', default=None)
+
+
+@contextmanager
+def timer(phase):
+    """Time a phase of the current request, does nothing outside of one."""
+    metrics = current.get()
+    if metrics is None:
+        yield
+    else:
+        with metrics.timer(phase):
+            yield
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        metrics.db_time += duration
+        metrics.queries += 1
+        if metrics.profile is not None:
+            metrics.profile.record(sql, params, duration, context['connection'].alias)
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # the same hook as connection.execute_wrapper(), for the whole life of the connection
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def format_labels(names, values):
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+class Histogram:
+    """Cumulative buckets with a sum and a count per label set. Not thread safe, see Registry."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # labels tuple -> [count per bucket (+Inf last), sum]
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def exposition(self, label_names):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in sorted(self.series.items()):
+            label_text = format_labels(label_names, labels)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {round(total, 6)}')
+            lines.append(f'{self.name}_count{{{label_text}}} {cumulative}')
+        return lines
+
+
+class Registry:
+    """The histograms of every endpoint (url name, method and viewset action) in this process."""
+
+    label_names = ('worker', 'endpoint', 'method', 'action')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # labels + status -> count
+        self.histograms = {
+            'duration': Histogram('api_request_duration_seconds', 'Time until the response was ready.', DURATION_BUCKETS),
+            'db': Histogram('api_db_duration_seconds', 'Time spent in SQL queries per request.', DURATION_BUCKETS),
+            'queries': Histogram('api_db_queries', 'SQL queries per request.', QUERY_BUCKETS),
+            'auth': Histogram('api_auth_duration_seconds', 'Authentication time per request, without its queries.', DURATION_BUCKETS),
+            'serialize': Histogram('api_serialize_duration_seconds', 'Serializer time per request, without its queries.', DURATION_BUCKETS),
+            'render': Histogram('api_render_duration_seconds', 'JSON rendering time per request.', DURATION_BUCKETS),
+            'size': Histogram('api_response_size_bytes', 'Response body size (streamed responses are not counted).', SIZE_BUCKETS),
+        }
+
+    def observe(self, endpoint, method, action, status, metrics, size=None):
+        labels = (str(os.getpid()), endpoint, method, action)
+        values = {'duration': metrics.elapsed(), 'db': metrics.db_time, 'queries': metrics.queries,
+                  **metrics.phases, 'size': size}
+        with self.lock:
+            key = labels + (str(status),)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            for name, histogram in self.histograms.items():
+                if values[name] is not None:
+                    histogram.observe(labels, values[name])
+
+    def exposition(self):
+        """Everything in the Prometheus text format (version 0.0.4)."""
+        lines = ['# HELP api_requests_total Requests answered.', '# TYPE api_requests_total counter']
+        with self.lock:
+            for key, count in sorted(self.requests.items()):
+                label_text = format_labels((*self.label_names, 'status'), key)
+                lines.append(f'api_requests_total{{{label_text}}} {count}')
+            for histogram in self.histograms.values():
+                lines += histogram.exposition(self.label_names)
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+            for histogram in self.histograms.values():
+                histogram.series.clear()
+
+
+registry = Registry()
@@ -0,0 +1,49 @@
+# Generated by Django 5.1.2 on 2026-10-17 02:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_alter_user_hospital_alter_user_role'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='diagnostic',
+            index=models.Index(fields=['patient', 'date_taken'], name='diagnostic_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='equipment',
+            index=models.Index(fields=['hospital', 'available'], name='equipment_hospital_avail_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='equipment',
+            index=models.Index(condition=models.Q(('available', True)), fields=['equipment_name'], name='equipment_available_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalhistory',
+            index=models.Index(fields=['patient', 'start_date'], name='medhistory_patient_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalhistory',
+            index=models.Index(condition=models.Q(('end_date__isnull', True)), fields=['patient'], name='medhistory_ongoing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['referred_to', 'status', 'referral_date'], name='referral_to_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['referred_from', 'status', 'referral_date'], name='referral_from_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(condition=models.Q(('status', 'Pending')), fields=['referred_to', 'referral_date'], name='referral_pending_to_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['patient', 'referral_date'], name='referral_patient_date_idx'),
+        ),
+    ]
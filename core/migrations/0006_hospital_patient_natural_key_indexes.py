@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-17 02:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_referral_diagnostic_equipment_medicalhistory_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='hospital',
+            index=models.Index(fields=['name'], name='hospital_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['last_name', 'first_name', 'dob'], name='patient_natural_key_idx'),
+        ),
+    ]
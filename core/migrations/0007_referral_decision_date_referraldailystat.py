@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-17 02:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_hospital_patient_natural_key_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referral',
+            name='decision_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='ReferralDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('Pending', 'Pending'), ('Accepted', 'Accepted'), ('Rejected', 'Rejected')], max_length=20)),
+                ('count', models.IntegerField(default=0)),
+                ('decided_count', models.IntegerField(default=0)),
+                ('decision_days_total', models.BigIntegerField(default=0)),
+                ('referred_from', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.hospital')),
+                ('referred_to', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.hospital')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'referred_from', 'referred_to', 'status'), name='referral_daily_stat_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-17 02:11
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_referral_decision_date_referraldailystat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='equipment',
+            name='normalized_name',
+            field=models.GeneratedField(db_persist=True, expression=django.db.models.functions.text.Lower(django.db.models.functions.text.Trim('equipment_name')), output_field=models.CharField(max_length=255)),
+        ),
+        migrations.AddIndex(
+            model_name='equipment',
+            index=models.Index(condition=models.Q(('available', True)), fields=['normalized_name', 'hospital'], name='equipment_available_norm_idx'),
+        ),
+    ]
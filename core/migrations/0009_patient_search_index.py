@@ -0,0 +1,40 @@
+from django.db import migrations
+
+from core import search
+
+# Search index behind /api/patients/search/ (see core/search.py). It can't be declared in
+# Patient.Meta because it is a different kind of index on every database:
+#   postgresql  a GIN trigram index (pg_trgm) over the lower-cased names and contact info
+#   sqlite      an FTS5 table with the trigram tokenizer, kept in step with core_patient by triggers,
+#               both defined in core/search.py (SQLITE_SEARCH_TABLES, sqlite_search_indexes())
+# Other databases get no index and core/search.py falls back to LIKE.
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS patient_search_trgm_idx ON core_patient USING gin "
+    "((lower(first_name || ' ' || last_name || ' ' || coalesce(contact_info, ''))) gin_trgm_ops)",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS patient_search_trgm_idx",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement, params=None)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_equipment_normalized_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRES_FORWARD, 'sqlite': search.sqlite_create_statements('core_patient_search')}),
+            run({'postgresql': POSTGRES_BACKWARD, 'sqlite': search.sqlite_drop_statements('core_patient_search')}),
+        ),
+    ]
@@ -0,0 +1,46 @@
+from django.db import migrations
+
+from core import search
+
+# Full-text index behind /api/search/ (see core/search.py) over diagnostic results and notes,
+# medical history notes and referral reasons:
+#   postgresql  one GIN tsvector expression index per table, postgres keeps them up to date itself.
+#               The expressions must stay identical to CLINICAL_SOURCES in core/search.py
+#   sqlite      one FTS5 table for all three, kept in step by triggers, both defined in core/search.py
+#               (SQLITE_SEARCH_TABLES, sqlite_search_indexes())
+# Other databases get no index and core/search.py falls back to LIKE.
+
+POSTGRES_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS diagnostic_search_idx ON core_diagnostic USING gin "
+    "(to_tsvector('english', diagnostic_type || ' ' || result || ' ' || coalesce(notes, '')))",
+    "CREATE INDEX IF NOT EXISTS medhistory_search_idx ON core_medicalhistory USING gin "
+    "(to_tsvector('english', condition || ' ' || treatment || ' ' || coalesce(notes, '')))",
+    "CREATE INDEX IF NOT EXISTS referral_search_idx ON core_referral USING gin "
+    "(to_tsvector('english', referral_reason))",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS diagnostic_search_idx",
+    "DROP INDEX IF EXISTS medhistory_search_idx",
+    "DROP INDEX IF EXISTS referral_search_idx",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement, params=None)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_patient_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRES_FORWARD, 'sqlite': search.sqlite_create_statements('core_clinical_search')}),
+            run({'postgresql': POSTGRES_BACKWARD, 'sqlite': search.sqlite_drop_statements('core_clinical_search')}),
+        ),
+    ]
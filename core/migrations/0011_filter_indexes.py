@@ -0,0 +1,49 @@
+# Generated by Django 5.1.2 on 2026-10-17 02:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_clinical_search_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='equipment',
+            name='equipment_hospital_avail_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='equipment',
+            name='equipment_available_name_idx',
+        ),
+        migrations.AddIndex(
+            model_name='diagnostic',
+            index=models.Index(fields=['date_taken'], name='diagnostic_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='equipment',
+            index=models.Index(fields=['available', 'hospital'], name='equipment_avail_hospital_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='equipment',
+            index=models.Index(fields=['equipment_name', 'available'], name='equipment_name_avail_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalhistory',
+            index=models.Index(fields=['start_date'], name='medhistory_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalhistory',
+            index=models.Index(fields=['end_date'], name='medhistory_end_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['status', 'referral_date'], name='referral_status_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['referral_date', 'id'], name='referral_date_idx'),
+        ),
+    ]
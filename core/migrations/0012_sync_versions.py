@@ -0,0 +1,76 @@
+# Generated by Django 5.1.2 on 2026-10-17 02:20
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+VERSIONED_MODELS = ['Hospital', 'Patient', 'MedicalHistory', 'Diagnostic', 'Equipment', 'Referral']
+
+
+def number_existing_rows(apps, schema_editor):
+    # give every existing row its own version: table after table, version = id + the ids used before,
+    # and start the counter after the last one, so a first sync (since=0) returns everything once
+    offset = 0
+    for name in VERSIONED_MODELS:
+        model = apps.get_model('core', name)
+        model.objects.update(version=F('id') + offset)
+        offset += model.objects.aggregate(last=Max('id'))['last'] or 0
+    apps.get_model('core', 'SyncCounter').objects.create(pk=1, value=offset)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+                ('pruned_through', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.BigIntegerField()),
+                ('version', models.BigIntegerField(db_index=True)),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='diagnostic',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='equipment',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='hospital',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='medicalhistory',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='referral',
+            name='version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(number_existing_rows, migrations.RunPython.noop),
+    ]
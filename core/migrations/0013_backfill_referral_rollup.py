@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    # ReferralDailyStat was created empty by 0007, fill it from the referrals already there
+    from core import rollups
+    rollups.rebuild(apps.get_model('core', 'Referral'), apps.get_model('core', 'ReferralDailyStat'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_sync_versions'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
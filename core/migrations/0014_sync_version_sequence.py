@@ -0,0 +1,33 @@
+from django.db import migrations
+
+# postgres: versions come from a sequence instead of the SyncCounter row (see SyncCounter in
+# core/models.py), starting after the last version the row handed out. Other databases keep the row.
+
+
+def create_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    counter = apps.get_model('core', 'SyncCounter').objects.filter(pk=1).first()
+    schema_editor.execute('CREATE SEQUENCE core_sync_version AS bigint MINVALUE 0 START 0 CACHE 1', params=None)
+    schema_editor.execute("SELECT setval('core_sync_version', %s)", params=[counter.value if counter else 0])
+
+
+def drop_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('SELECT last_value FROM core_sync_version')
+        last, = cursor.fetchone()
+    apps.get_model('core', 'SyncCounter').objects.update_or_create(pk=1, defaults={'value': last})
+    schema_editor.execute('DROP SEQUENCE core_sync_version', params=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_backfill_referral_rollup'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_sequence, drop_sequence),
+    ]
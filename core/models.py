@@ -1,8 +1,106 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import AbstractUser
+from django.db.models import sql
+from django.db.models.functions import Lower, Trim
+from django.db.models.sql.constants import SINGLE
+from django.utils import timezone
+
+# Sync Counter Model
+# Where the version numbers of VersionedModel writes come from (see core/sync.py). Versions must become
+# visible to readers in a known order: a client that synced up to version N may never miss a change
+# numbered below N that was still being committed.
+#   postgresql  the core_sync_version sequence: nextval() takes no lock, so writers don't wait for each
+#               other. Before drawing, a writer registers as in flight with a shared advisory lock keyed
+#               by (a number below) the sequence's current value, released when its transaction ends;
+#               settled() caps the change feed below the lowest registered key.
+#   others      the `value` column of the single row, bumped inside the writing transaction, which keeps
+#               the row locked until commit (sqlite lets one transaction write at a time anyway).
+# The row also remembers up to where tombstones have been pruned.
+class SyncCounter(models.Model):
+    value = models.BigIntegerField(default=0)
+    pruned_through = models.BigIntegerField(default=0)  # tombstones up to this version have been deleted
+
+    COUNTER_ID = 1
+    SEQUENCE = 'core_sync_version'  # created by migration 0014, must keep the default CACHE 1
+    IN_FLIGHT_BUCKET = 1024  # in-flight keys are rounded down to this, so a long transaction holds few locks
+
+    @classmethod
+    def allocate(cls, count=1):
+        """Reserve `count` versions, returns them in increasing order. Must run inside transaction.atomic()."""
+        connection = transaction.get_connection()
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                # in flight first: everything drawn afterwards is above the key (see settled())
+                cursor.execute(f'SELECT pg_advisory_xact_lock_shared(last_value - last_value %% %s) FROM {cls.SEQUENCE}',
+                               [cls.IN_FLIGHT_BUCKET])
+                cursor.execute(f"SELECT nextval('{cls.SEQUENCE}') FROM generate_series(1, %s)", [count])
+                return sorted(version for version, in cursor.fetchall())
+
+        counter = cls.objects.filter(pk=cls.COUNTER_ID)
+        if not counter.update(value=models.F('value') + count):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(pk=cls.COUNTER_ID, value=count)
+            except IntegrityError:
+                # created by another writer in the meantime
+                counter.update(value=models.F('value') + count)
+        last = counter.values_list('value', flat=True).get()
+        return list(range(last - count + 1, last + 1))
+
+    @classmethod
+    def settled(cls, connection):
+        """_summary_
+        The highest version below which every transaction has ended, which is as far as the change feed
+        may go: None (no limit) where versions come from the locked row.
+        On postgres, read before the rows: whoever drew a version at or below it had registered as in flight
+        before this query (their key would cap it) and has committed or rolled back since.
+        """
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            # single bigint advisory keys show up as classid (high half) and objid (low half) with objsubid 1,
+            # the upsert locks in api/bulk.py use the two int keys form so they don't count here
+            cursor.execute(f"""
+                SELECT CASE WHEN is_called THEN last_value ELSE 0 END,
+                       (SELECT min((classid::bigint << 32) | objid::bigint) FROM pg_locks
+                        WHERE locktype = 'advisory' AND objsubid = 1
+                          AND database = (SELECT oid FROM pg_database WHERE datname = current_database()))
+                FROM {cls.SEQUENCE}""")
+            drawn, in_flight = cursor.fetchone()
+        return drawn if in_flight is None else min(drawn, in_flight - 1)
+
+
+# Versioned Model
+# Base class of the models served by the /api/sync/ change feed: `version` is taken from SyncCounter on
+# every save, so "everything that changed since version N" is an indexed range query. Bulk writes stamp
+# versions with core.sync.stamp() and deletes leave a Tombstone (core/sync.py).
+class VersionedModel(models.Model):
+    version = models.BigIntegerField(default=0, editable=False, db_index=True)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            self.version, = SyncCounter.allocate()
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+            super().save(*args, **kwargs)
+
+
+# Tombstone Model
+# Left behind by deleted VersionedModel rows so clients of /api/sync/ learn about deletes
+class Tombstone(models.Model):
+    model = models.CharField(max_length=100)  # model label, e.g. core.patient
+    object_id = models.BigIntegerField()
+    version = models.BigIntegerField(db_index=True)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.model} {self.object_id} deleted at version {self.version}'
 
 # Hospital Model
-class Hospital(models.Model):
+class Hospital(VersionedModel):
     HOSPITAL_TYPE_CHOICES = [
         ('Public', 'Public'),
         ('Private', 'Private'),
@@ -16,6 +114,12 @@ class Hospital(models.Model):
     def __str__(self):
         return self.name
 
+    class Meta:
+        indexes = [
+            # natural key used by /api/hospitals/upsert/
+            models.Index(fields=['name'], name='hospital_name_idx'),
+        ]
+
 # User Model (Custom User)
 # Inheriting from Django's built in abstract user model to speed up development
 class User(AbstractUser):
@@ -31,7 +135,7 @@ class User(AbstractUser):
         return f'{self.username}'
 
 # Patient Model
-class Patient(models.Model):
+class Patient(VersionedModel):
     GENDER_CHOICES = [
         ('Male', 'Male'),
         ('Female', 'Female'),
@@ -47,8 +151,14 @@ class Patient(models.Model):
     def __str__(self):
         return f'{self.first_name} {self.last_name}'
 
+    class Meta:
+        indexes = [
+            # natural key used by /api/patients/upsert/
+            models.Index(fields=['last_name', 'first_name', 'dob'], name='patient_natural_key_idx'),
+        ]
+
 # Medical History Model
-class MedicalHistory(models.Model):
+class MedicalHistory(VersionedModel):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="medical_history")
     condition = models.CharField(max_length=255)
     treatment = models.CharField(max_length=255)
@@ -62,9 +172,19 @@ class MedicalHistory(models.Model):
     class Meta:
         verbose_name = "Medical History"
         verbose_name_plural = "Medical Histories"
+        indexes = [
+            # ?patient=X ordered by start date
+            models.Index(fields=['patient', 'start_date'], name='medhistory_patient_start_idx'),
+            # ongoing treatments only (end_date IS NULL), a small slice of the table
+            models.Index(fields=['patient'], condition=models.Q(end_date__isnull=True), name='medhistory_ongoing_idx'),
+            # ?start_date__gte=...&start_date__lte=... across all patients
+            models.Index(fields=['start_date'], name='medhistory_start_idx'),
+            # finished treatments, ?end_date__gte=...&end_date__lte=...
+            models.Index(fields=['end_date'], name='medhistory_end_idx'),
+        ]
 
 # Diagnostic Model
-class Diagnostic(models.Model):
+class Diagnostic(VersionedModel):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='diagnostics')
     diagnostic_type = models.CharField(max_length=255)  # e.g., 'X-ray', 'Blood Test'
     result = models.TextField()  # Diagnostic results
@@ -74,28 +194,134 @@ class Diagnostic(models.Model):
     def __str__(self):
         return f'{self.diagnostic_type} for {self.patient.first_name} {self.patient.last_name} on {self.date_taken}'
 
+    class Meta:
+        indexes = [
+            # ?patient=X sorted by date_taken
+            models.Index(fields=['patient', 'date_taken'], name='diagnostic_patient_date_idx'),
+            # ?date_taken__gte=...&date_taken__lte=... across all patients
+            models.Index(fields=['date_taken'], name='diagnostic_date_idx'),
+        ]
+
 # Equipment Model
-class Equipment(models.Model):
+class Equipment(VersionedModel):
     hospital = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name='equipment')
     equipment_name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)  # Description of the equipment
     available = models.BooleanField(default=True)  # Whether the equipment is available
+    # equipment_name as searched by /api/hospitals/candidates/ ("  MRI machine " -> "mri machine"),
+    # computed and stored by the database so every write path (bulk_create, update(), raw SQL) keeps it right
+    normalized_name = models.GeneratedField(expression=Lower(Trim('equipment_name')),
+                                            output_field=models.CharField(max_length=255), db_persist=True)
 
     def __str__(self):
         return f'{self.equipment_name} at {self.hospital.name}'
 
+    @staticmethod
+    def normalize_names(names, using='default'):
+        # names coming from the client, normalized by the database with the normalized_name expression itself:
+        # str.lower() would not agree with it (SQLite's LOWER() only folds ASCII letters, "Échographe" stays as is)
+        names = list(names)
+        if not names:
+            return []
+        query = sql.Query(None)
+        for i, name in enumerate(names):
+            query.add_annotation(Lower(Trim(models.Value(name, output_field=models.CharField()))), f'name_{i}')
+        return list(query.get_compiler(using).execute_sql(SINGLE))
+
+    class Meta:
+        indexes = [
+            # ?available=true and ?available=true&hospital=X (?hospital=X alone uses the foreign key index)
+            models.Index(fields=['available', 'hospital'], name='equipment_avail_hospital_idx'),
+            # ?equipment_name=X and ?equipment_name=X&available=true
+            models.Index(fields=['equipment_name', 'available'], name='equipment_name_avail_idx'),
+            # hospital candidate search: available units per (normalized name, hospital), answered from the index alone
+            models.Index(fields=['normalized_name', 'hospital'], condition=models.Q(available=True), name='equipment_available_norm_idx'),
+        ]
+
 # Referral Model
-class Referral(models.Model):
+class Referral(VersionedModel):
+    STATUS_CHOICES = [
+        ('Pending', 'Pending'),
+        ('Accepted', 'Accepted'),
+        ('Rejected', 'Rejected'),
+    ]
+    # the status changes a receiving hospital may make, anything else is refused by the bulk update
+    STATUS_TRANSITIONS = {
+        'Pending': ['Accepted', 'Rejected'],
+    }
+
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="referrals")
     referred_from = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name="referrals_made")
     referred_to = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name="referrals_received")
     referral_reason = models.TextField()  # Why the patient is being referred
     referral_date = models.DateField()
-    status = models.CharField(max_length=20, choices=[
-        ('Pending', 'Pending'),
-        ('Accepted', 'Accepted'),
-        ('Rejected', 'Rejected'),
-    ], default='Pending')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='Pending')
+    decision_date = models.DateField(blank=True, null=True, editable=False)  # set when the referral stops being Pending
 
     def __str__(self):
         return f'Referral of {self.patient.first_name} {self.patient.last_name} from {self.referred_from.name} to {self.referred_to.name}'
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')  # to notice status changes on save
+        return instance
+
+    def save(self, *args, **kwargs):
+        if self.stamp_decision_date() and kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'decision_date'}
+        super().save(*args, **kwargs)
+        self._loaded_status = self.status
+
+    def stamp_decision_date(self):
+        """Record the day a Pending referral got accepted/rejected, returns True if decision_date changed."""
+        loaded_status = getattr(self, '_loaded_status', None)
+        if self.status == loaded_status:
+            return False
+        if self.status == 'Pending':
+            changed = self.decision_date is not None
+            self.decision_date = None
+            return changed
+        if loaded_status == 'Pending':
+            self.decision_date = timezone.localdate()
+            return True
+        return False
+
+    def pre_bulk_save(self):
+        # called by the bulk write paths (api/bulk.py) which skip save(), returns the fields it touched
+        return ['decision_date'] if self.stamp_decision_date() else []
+
+    class Meta:
+        indexes = [
+            # ?referred_to=X&status=Y and ?referred_from=X&status=Y, newest first
+            models.Index(fields=['referred_to', 'status', 'referral_date'], name='referral_to_status_idx'),
+            models.Index(fields=['referred_from', 'status', 'referral_date'], name='referral_from_status_idx'),
+            # the receiving hospital's triage queue: pending referrals only
+            models.Index(fields=['referred_to', 'referral_date'], condition=models.Q(status='Pending'), name='referral_pending_to_idx'),
+            # ?patient=X ordered by referral date
+            models.Index(fields=['patient', 'referral_date'], name='referral_patient_date_idx'),
+            # ?status=X / ?status__in=X,Y across all hospitals
+            models.Index(fields=['status', 'referral_date'], name='referral_status_date_idx'),
+            # ?referral_date__gte=...&referral_date__lte=..., and the keyset pagination order (referral_date, id)
+            models.Index(fields=['referral_date', 'id'], name='referral_date_idx'),
+        ]
+
+# Referral Daily Statistics Model
+# Referral counts per day, sending hospital, receiving hospital and status, kept up to date
+# incrementally (see core/rollups.py) so dashboards don't have to scan the whole referrals table
+class ReferralDailyStat(models.Model):
+    day = models.DateField()  # the referral_date of the counted referrals
+    referred_from = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name='+')
+    referred_to = models.ForeignKey(Hospital, on_delete=models.CASCADE, related_name='+')
+    status = models.CharField(max_length=20, choices=Referral.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+    decided_count = models.IntegerField(default=0)  # referrals with a decision_date
+    decision_days_total = models.BigIntegerField(default=0)  # sum of (decision_date - referral_date) in days
+
+    def __str__(self):
+        return f'{self.count} {self.status} referrals on {self.day}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'referred_from', 'referred_to', 'status'], name='referral_daily_stat_unique'),
+        ]
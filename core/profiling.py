@@ -0,0 +1,161 @@
+import functools
+import os
+import random
+import re
+import sys
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+# Sampled query profiler, safe to leave on in production (settings.QUERY_PROFILER_SAMPLE_RATE).
+#
+# For a sampled request the query recorder of core/metrics.py hands every SQL statement to a Profile,
+# which groups them by fingerprint: the SQL with its literals and IN lists normalized, so
+# "WHERE patient_id = %s" run once per row of a page shows up as one fingerprint run 100 times.
+# When the request is done it reports:
+#   repeated  a fingerprint run at least QUERY_PROFILER_REPEAT_THRESHOLD times, the N+1 pattern
+#   slow      a single query slower than QUERY_PROFILER_SLOW_MS. With QUERY_PROFILER_EXPLAIN the parameters of
+#             the slow SELECTs are kept too, and `dump_query_profiles` runs their EXPLAIN: never in the request
+# Each finding names the line of our code that ran the query. Requests with findings are pushed to a
+# ring buffer of the last QUERY_PROFILER_BUFFER_SIZE entries in the `query_profiler` cache (redis, or
+# files shared by the workers of one machine), dumped with `manage.py dump_query_profiles`.
+# Requests that aren't sampled pay for one random() call.
+
+CACHE_KEY_PREFIX = 'qprof'
+MAX_REPLAY_PARAMS = 1000  # a slow query with more parameters (a huge IN list) is reported without its EXPLAIN
+
+# normalization of SQL into fingerprints, applied in order
+FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),  # string literals
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),  # numbers
+    (re.compile(r'%s|\?'), '?'),  # placeholders of every backend
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),  # IN lists of any length
+    (re.compile(r'\s+'), ' '),
+]
+
+# frames of these files never count as the origin of a query
+LIBRARY_PATHS = (os.path.dirname(os.__file__), os.sep + 'site-packages' + os.sep, os.sep + 'dist-packages' + os.sep,
+                 __file__, os.path.join('core', 'metrics.py'))
+
+
+@functools.lru_cache(maxsize=1024)  # the ORM sends the same few SQL strings over and over
+def fingerprint(sql):
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def origin():
+    """file:line in function of the innermost frame in our own code, where the query came from."""
+    frame = sys._getframe(2)
+    base = str(settings.BASE_DIR) + os.sep
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(base) and not any(path in filename for path in LIBRARY_PATHS):
+            return f'{filename[len(base):]}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class Profile:
+    """The queries of one sampled request, grouped by fingerprint."""
+
+    def __init__(self):
+        self.groups = {}  # fingerprint -> {'count', 'total_ms', 'sql', 'origin'}
+        self.slow = []  # (ms, sql, params, alias, origin) of each slow query
+        self.slow_ms = settings.QUERY_PROFILER_SLOW_MS
+
+    def record(self, sql, params, duration, alias):
+        ms = duration * 1000
+        key = fingerprint(sql)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {'count': 0, 'total_ms': 0.0, 'sql': sql, 'origin': origin()}
+        group['count'] += 1
+        group['total_ms'] += ms
+        if ms >= self.slow_ms:
+            self.slow.append((ms, sql, params, alias, group['origin'] if group['count'] == 1 else origin()))
+
+    def findings(self):
+        """The repeated and slow queries. Slow SELECTs keep what explain() needs to replay them when
+        QUERY_PROFILER_EXPLAIN is set, nothing here touches the database."""
+        threshold = settings.QUERY_PROFILER_REPEAT_THRESHOLD
+        results = [{'kind': 'repeated', 'fingerprint': key, 'count': group['count'],
+                    'total_ms': round(group['total_ms'], 3), 'sql': group['sql'], 'origin': group['origin']}
+                   for key, group in self.groups.items() if group['count'] >= threshold]
+        for ms, sql, params, alias, query_origin in self.slow:
+            finding = {'kind': 'slow', 'fingerprint': fingerprint(sql), 'ms': round(ms, 3), 'sql': sql,
+                       'params': repr(params)[:500], 'origin': query_origin}
+            if settings.QUERY_PROFILER_EXPLAIN and is_select(sql) and len(params or ()) <= MAX_REPLAY_PARAMS:
+                finding['replay'] = {'alias': alias, 'params': params}
+            results.append(finding)
+        return results
+
+
+def start():
+    """A Profile if this request is sampled, None otherwise."""
+    rate = settings.QUERY_PROFILER_SAMPLE_RATE
+    if rate > 0 and random.random() < rate:
+        return Profile()
+    return None
+
+
+def is_select(sql):
+    return sql.lstrip()[:6].upper() == 'SELECT'  # never run a write a second time
+
+
+def explain(finding):
+    """EXPLAIN of a slow finding kept with its parameters, run now against the current data
+    (by dump_query_profiles, not by the request). None when there is nothing to replay."""
+    replay = finding.get('replay')
+    if replay is None or replay['alias'] not in connections:
+        return None
+    return explain_query(replay['alias'], finding['sql'], replay['params'])
+
+
+def explain_query(alias, sql, params):
+    if not is_select(sql):
+        return None
+    connection = connections[alias]
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+    except Exception as error:  # e.g. a table dropped since
+        return f'EXPLAIN failed: {error}'
+
+
+# Ring buffer of the requests with findings, shared by the workers through the query_profiler cache
+
+def get_cache():
+    return caches[settings.QUERY_PROFILER_CACHE_ALIAS]
+
+
+def slot_key(number):
+    return f'{CACHE_KEY_PREFIX}:slot:{number % settings.QUERY_PROFILER_BUFFER_SIZE}'
+
+
+def push(entry):
+    """Add an entry, overwriting the oldest one once the buffer is full."""
+    cache = get_cache()
+    counter = f'{CACHE_KEY_PREFIX}:count'
+    cache.add(counter, 0, timeout=None)
+    number = cache.incr(counter)
+    cache.set(slot_key(number), {**entry, 'number': number, 'time': time.time()}, timeout=None)
+
+
+def entries():
+    """Everything in the buffer, oldest first."""
+    cache = get_cache()
+    count = cache.get(f'{CACHE_KEY_PREFIX}:count') or 0
+    numbers = range(max(count - settings.QUERY_PROFILER_BUFFER_SIZE, 0) + 1, count + 1)
+    found = cache.get_many([slot_key(number) for number in numbers])
+    # a slot may hold an older entry if a worker wrote it late, keep each entry once
+    return sorted({entry['number']: entry for entry in found.values()}.values(), key=lambda entry: entry['number'])
+
+
+def clear():
+    cache = get_cache()
+    cache.delete_many([f'{CACHE_KEY_PREFIX}:count'] + [slot_key(number) for number in range(settings.QUERY_PROFILER_BUFFER_SIZE)])
@@ -0,0 +1,144 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Referral, ReferralDailyStat
+from .signals import bulk_created, bulk_updated
+
+# Keeps ReferralDailyStat in step with the referrals table.
+# Every write to a referral becomes a delta: -1 on the (day, from, to, status) bucket it was in
+# before and +1 on the bucket it is in now, plus the matching change to the decision totals.
+# The deltas of a write (a whole batch for the bulk paths) are applied by one
+# INSERT ... ON CONFLICT DO UPDATE SET count = count + excluded.count, inside the transaction that
+# writes the referrals: concurrent writers don't lose counts, and a failure rolls both back.
+# The table is filled by migration 0013, `python manage.py rebuild_referral_rollup` recomputes it
+# from scratch (after the receivers were turned off with REFERRAL_ROLLUP_ENABLED, for instance).
+
+DATE_FIELD = Referral._meta.get_field('referral_date')
+
+
+def bucket(referral):
+    """(bucket key, decision days or None) of a referral as it is in memory."""
+    # values assigned by hand (Referral.objects.create(referral_date='2024-05-01')) may still be strings
+    referral_date = DATE_FIELD.to_python(referral.referral_date)
+    decision_date = DATE_FIELD.to_python(referral.decision_date)
+    key = (referral_date, referral.referred_from_id, referral.referred_to_id, referral.status)
+    days = None
+    if decision_date is not None:
+        days = max((decision_date - referral_date).days, 0)
+    return key, days
+
+
+def apply_changes(removed=(), added=()):
+    """Move the given referrals (model instances) out of / into their buckets."""
+    counts, decided, days_total = Counter(), Counter(), Counter()
+    for sign, referrals in ((-1, removed), (1, added)):
+        for referral in referrals:
+            key, days = bucket(referral)
+            counts[key] += sign
+            if days is not None:
+                decided[key] += sign
+                days_total[key] += sign * days
+
+    # sorted, so that two batches touching the same buckets lock them in the same order
+    deltas = [(key, counts[key], decided[key], days_total[key]) for key in sorted(set(counts) | set(decided))
+              if counts[key] or decided[key] or days_total[key]]
+    for start in range(0, len(deltas), UPSERT_BATCH_SIZE):
+        apply_deltas(deltas[start:start + UPSERT_BATCH_SIZE])
+
+
+UPSERT_BATCH_SIZE = 100  # buckets per statement, 7 parameters each
+KEY_FIELDS = ('day', 'referred_from', 'referred_to', 'status')
+TOTAL_FIELDS = ('count', 'decided_count', 'decision_days_total')
+
+
+def apply_deltas(deltas):
+    """_summary_
+    Add (bucket key, count, decided, days) deltas to their buckets, creating the missing ones, with
+    one statement. bulk_create(update_conflicts=True) can only overwrite the stored totals with new
+    ones, which loses the counts of a concurrent writer, so the upsert is written out here: the
+    syntax is the same on postgres and sqlite.
+    """
+    meta = ReferralDailyStat._meta
+    connection = connections[router.db_for_write(ReferralDailyStat)]
+    quote = connection.ops.quote_name
+    table = quote(meta.db_table)
+    keys = [quote(meta.get_field(name).column) for name in KEY_FIELDS]
+    totals = [quote(meta.get_field(name).column) for name in TOTAL_FIELDS]
+    day_field = meta.get_field('day')
+
+    params = []
+    for (day, referred_from, referred_to, status), count, decided, days in deltas:
+        params += [day_field.get_db_prep_value(day, connection), referred_from, referred_to, status, count, decided, days]
+    row = f"({', '.join(['%s'] * (len(keys) + len(totals)))})"
+    sql = (f"INSERT INTO {table} ({', '.join(keys + totals)}) VALUES {', '.join([row] * len(deltas))} "
+           f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+           + ', '.join(f'{column} = {table}.{column} + EXCLUDED.{column}' for column in totals))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def rebuild(referral_model=Referral, stat_model=ReferralDailyStat):
+    """Recompute every bucket from the referrals table with one GROUP BY.
+    Migrations pass their historical models."""
+    rows = (referral_model.objects
+            .values('referral_date', 'referred_from', 'referred_to', 'status')
+            .annotate(total=Count('id'),
+                      decided=Count('id', filter=Q(decision_date__isnull=False)),
+                      decided_days=Sum(F('decision_date') - F('referral_date'), filter=Q(decision_date__isnull=False)))
+            .order_by())
+    stats = [stat_model(day=row['referral_date'], referred_from_id=row['referred_from'],
+                        referred_to_id=row['referred_to'], status=row['status'], count=row['total'],
+                        decided_count=row['decided'],
+                        decision_days_total=row['decided_days'].days if row['decided_days'] else 0)
+             for row in rows.iterator()]
+    with transaction.atomic():
+        stat_model.objects.all().delete()
+        stat_model.objects.bulk_create(stats, batch_size=1000)
+    return len(stats)
+
+
+# Signal receivers, connected in CoreConfig.ready()
+
+def enabled():
+    return settings.REFERRAL_ROLLUP_ENABLED
+
+
+@receiver(pre_save, sender=Referral)
+def remember_previous_bucket(sender, instance, raw=False, **kwargs):
+    if not enabled() or raw or instance._state.adding or instance.pk is None:
+        return
+    # locked until the save commits: two concurrent status changes would otherwise both move the referral
+    # out of the bucket they read. Runs inside VersionedModel.save()'s transaction
+    instance._rollup_previous = Referral.objects.select_for_update().filter(pk=instance.pk).first()
+
+
+@receiver(post_save, sender=Referral)
+def referral_saved(sender, instance, raw=False, **kwargs):
+    if not enabled() or raw:
+        return
+    previous = getattr(instance, '_rollup_previous', None)
+    instance._rollup_previous = None
+    apply_changes(removed=[previous] if previous else [], added=[instance])
+
+
+@receiver(post_delete, sender=Referral)
+def referral_deleted(sender, instance, **kwargs):
+    if enabled():
+        apply_changes(removed=[instance])
+
+
+@receiver(bulk_created, sender=Referral)
+def referrals_bulk_created(sender, instances, **kwargs):
+    if enabled():
+        apply_changes(added=instances)
+
+
+@receiver(bulk_updated, sender=Referral)
+def referrals_bulk_updated(sender, instances, previous=(), **kwargs):
+    if enabled():
+        apply_changes(removed=previous, added=instances)
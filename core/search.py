@@ -0,0 +1,356 @@
+import datetime
+import re
+
+from django.db import connection, connections, transaction
+
+# Ranked patient search for /api/patients/search/, using the index created by
+# migration 0009_patient_search_index:
+#   postgresql  pg_trgm: word_similarity() finds misspelled names, the GIN trigram index answers it
+#   sqlite      FTS5 trigram table: every trigram of the query is an OR-ed term, so misspelled
+#               names still share most of their trigrams with the query; the few hundred best
+#               bm25 candidates are then scored in Python with the same trigram similarity
+# Either way a patient whose first or last name starts with the query ranks above fuzzy matches.
+
+PATIENT_DOCUMENT = "lower(first_name || ' ' || last_name || ' ' || coalesce(contact_info, ''))"
+PREFIX_BONUS = 1.0
+MIN_SIMILARITY = 0.3  # fuzzy matches below this are noise
+CANDIDATES_PER_RESULT = 10  # sqlite: bm25 candidates fetched per requested result
+
+
+def normalize(text):
+    return ' '.join(re.findall(r'\w+', (text or '').lower()))
+
+
+def trigrams(text):
+    """pg_trgm style trigrams: every word padded with two spaces in front and one behind"""
+    found = set()
+    for word in normalize(text).split():
+        padded = f'  {word} '
+        found.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return found
+
+
+def word_similarity(query, document):
+    """Share of the query's trigrams found in the document, like pg_trgm's word_similarity()"""
+    wanted = trigrams(query)
+    if not wanted:
+        return 0.0
+    return len(wanted & trigrams(document)) / len(wanted)
+
+
+def is_prefix(query, *names):
+    return any(normalize(name).startswith(query) for name in names if name)
+
+
+def search_patients(query, limit=20):
+    """Returns [(patient id, score)] best first, score is PREFIX_BONUS + similarity for prefix matches."""
+    query = normalize(query)
+    if not query:
+        return []
+    if connection.vendor == 'postgresql':
+        return search_patients_postgres(query, limit)
+    if connection.vendor == 'sqlite' and len(query) >= 3:
+        return search_patients_sqlite(query, limit)
+    return search_patients_like(query, limit)
+
+
+def search_patients_postgres(query, limit):
+    # word_similarity(q, doc) >= threshold is written as q <% doc so the trigram index can be used
+    sql = f"""
+        SELECT id, score FROM (
+            SELECT id,
+                   word_similarity(%s, {PATIENT_DOCUMENT})
+                   + CASE WHEN lower(first_name) LIKE %s OR lower(last_name) LIKE %s
+                               OR lower(first_name || ' ' || last_name) LIKE %s THEN %s ELSE 0 END AS score
+            FROM core_patient
+            WHERE %s <%% {PATIENT_DOCUMENT} OR {PATIENT_DOCUMENT} LIKE %s
+        ) AS matches
+        WHERE score >= %s
+        ORDER BY score DESC, id
+        LIMIT %s
+    """
+    prefix = escape_like(query) + '%'
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SET LOCAL pg_trgm.word_similarity_threshold = %s', [MIN_SIMILARITY])
+        cursor.execute(sql, [query, prefix, prefix, prefix, PREFIX_BONUS,
+                             query, '%' + escape_like(query) + '%', MIN_SIMILARITY, limit])
+        return [(patient, round(float(score), 4)) for patient, score in cursor.fetchall()]
+
+
+def search_patients_sqlite(query, limit):
+    terms = ' OR '.join('"{}"'.format(trigram.strip()) for trigram in sorted(trigrams(query))
+                        if len(trigram.strip()) == 3)
+    if not terms:
+        return search_patients_like(query, limit)
+    sql = """
+        SELECT p.id, p.first_name, p.last_name, p.contact_info
+        FROM core_patient_search s JOIN core_patient p ON p.id = s.rowid
+        WHERE core_patient_search MATCH %s
+        ORDER BY bm25(core_patient_search)
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [terms, limit * CANDIDATES_PER_RESULT])
+        return rank(query, cursor.fetchall(), limit)
+
+
+def search_patients_like(query, limit):
+    # no search index on this database (or a query too short for trigrams): plain substring match
+    pattern = '%' + escape_like(query) + '%'
+    sql = f"""
+        SELECT id, first_name, last_name, contact_info FROM core_patient
+        WHERE {PATIENT_DOCUMENT} LIKE %s ESCAPE '\\'
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [pattern, limit * CANDIDATES_PER_RESULT])
+        return rank(query, cursor.fetchall(), limit)
+
+
+def rank(query, rows, limit):
+    scored = []
+    for patient, first_name, last_name, contact_info in rows:
+        score = word_similarity(query, f'{first_name} {last_name} {contact_info or ""}')
+        if is_prefix(query, first_name, last_name, f'{first_name} {last_name}'):
+            score += PREFIX_BONUS
+        if score >= MIN_SIMILARITY:
+            scored.append((patient, round(score, 4)))
+    scored.sort(key=lambda match: (-match[1], match[0]))
+    return scored[:limit]
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Clinical full-text search for /api/search/ over diagnostic results and notes, medical history
+# notes and referral reasons, using the index created by migration 0010_clinical_search_index:
+#   postgresql  tsvector expression indexes, websearch_to_tsquery() and ts_headline() snippets
+#   sqlite      one FTS5 table (porter stemming) with snippet()
+# `document` must stay identical to the expressions indexed by that migration.
+
+CLINICAL_SOURCES = {
+    'diagnostic': {
+        'table': 'core_diagnostic', 'day': 'date_taken', 'title': 'diagnostic_type',
+        'body': "result || ' ' || coalesce(notes, '')",
+        'document': "diagnostic_type || ' ' || result || ' ' || coalesce(notes, '')",
+    },
+    'medical_history': {
+        'table': 'core_medicalhistory', 'day': 'start_date', 'title': 'condition',
+        'body': "treatment || ' ' || coalesce(notes, '')",
+        'document': "condition || ' ' || treatment || ' ' || coalesce(notes, '')",
+    },
+    'referral': {
+        'table': 'core_referral', 'day': 'referral_date', 'title': "''",
+        'body': 'referral_reason',
+        'document': 'referral_reason',
+    },
+}
+HIGHLIGHT = ('<mark>', '</mark>')
+SNIPPET_WORDS = 16
+
+# for the hospital filter: referrals from or to the hospital, and everything about the patients of those referrals
+HOSPITAL_REFERRALS = "SELECT {column} FROM core_referral WHERE referred_from_id = %s OR referred_to_id = %s"
+
+
+def search_clinical(query, kinds=None, patient=None, hospital=None, date_from=None, date_to=None, limit=20):
+    """_summary_
+    Returns up to `limit` matches best first, as dicts with kind, id, patient, day, title, snippet
+    and score. Every word of `query` has to match (stemmed, so "fractures" finds "fracture").
+    """
+    words = re.findall(r'\w+', (query or '').lower())
+    if not words:
+        return []
+    kinds = list(kinds or CLINICAL_SOURCES)
+    if connection.vendor == 'postgresql':
+        return search_clinical_postgres(' '.join(words), kinds, patient, hospital, date_from, date_to, limit)
+    if connection.vendor == 'sqlite':
+        return search_clinical_sqlite(words, kinds, patient, hospital, date_from, date_to, limit)
+    return search_clinical_like(words, kinds, patient, hospital, date_from, date_to, limit)
+
+
+def clinical_filters(kind, patient, hospital, date_from, date_to, patient_column='patient_id', day_column=None,
+                     id_column='id'):
+    """SQL conditions (ANDed) and their params for the optional filters of one source"""
+    day_column = day_column or CLINICAL_SOURCES[kind]['day']
+    conditions, params = [], []
+    if patient is not None:
+        conditions.append(f'{patient_column} = %s')
+        params.append(patient)
+    if date_from is not None:
+        conditions.append(f'{day_column} >= %s')
+        params.append(date_from.isoformat())
+    if date_to is not None:
+        conditions.append(f'{day_column} <= %s')
+        params.append(date_to.isoformat())
+    if hospital is not None:
+        if kind == 'referral':
+            conditions.append(f"{id_column} IN ({HOSPITAL_REFERRALS.format(column='id')})")
+        else:
+            conditions.append(f"{patient_column} IN ({HOSPITAL_REFERRALS.format(column='patient_id')})")
+        params += [hospital, hospital]
+    return conditions, params
+
+
+def search_clinical_postgres(query, kinds, patient, hospital, date_from, date_to, limit):
+    selects, params = [], []
+    for kind in kinds:
+        source = CLINICAL_SOURCES[kind]
+        document = f"to_tsvector('english', {source['document']})"
+        conditions, filter_params = clinical_filters(kind, patient, hospital, date_from, date_to)
+        where = ' AND '.join([f"{document} @@ websearch_to_tsquery('english', %s)"] + conditions)
+        selects.append(f"""
+            SELECT '{kind}' AS kind, id, patient_id, {source['day']} AS day, {source['title']} AS title,
+                   {source['body']} AS body, ts_rank({document}, websearch_to_tsquery('english', %s)) AS score
+            FROM {source['table']} WHERE {where}
+        """)
+        params += [query, query] + filter_params
+    start, stop = HIGHLIGHT
+    options = f'StartSel={start}, StopSel={stop}, MaxWords={SNIPPET_WORDS}, MinWords=5, MaxFragments=2'
+    # snippets are only built for the rows that made it through the LIMIT
+    sql = f"""
+        SELECT kind, id, patient_id, day, title,
+               ts_headline('english', body, websearch_to_tsquery('english', %s), %s), score
+        FROM ({' UNION ALL '.join(selects)} ORDER BY score DESC, id LIMIT %s) AS hits
+        ORDER BY score DESC, id
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [query, options] + params + [limit])
+        return [clinical_hit(*row) for row in cursor.fetchall()]
+
+
+def search_clinical_sqlite(words, kinds, patient, hospital, date_from, date_to, limit):
+    start, stop = HIGHLIGHT
+    conditions = ['core_clinical_search MATCH %s', f"kind IN ({', '.join(['%s'] * len(kinds))})"]
+    params = [' '.join(f'"{word}"' for word in words)] + kinds
+    # the filters are the same for every kind, except how the hospital is matched
+    for kind in kinds:
+        kind_conditions, kind_params = clinical_filters(kind, patient, hospital, date_from, date_to,
+                                                        day_column='day', id_column='object_id')
+        if kind_conditions:
+            conditions.append(f"(kind <> %s OR ({' AND '.join(kind_conditions)}))")
+            params += [kind] + kind_params
+    sql = f"""
+        SELECT kind, object_id, patient_id, day, title,
+               snippet(core_clinical_search, 5, %s, %s, '…', {SNIPPET_WORDS}), -bm25(core_clinical_search)
+        FROM core_clinical_search
+        WHERE {' AND '.join(conditions)}
+        ORDER BY bm25(core_clinical_search), rowid
+        LIMIT %s
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [start, stop] + params + [limit])
+        return [clinical_hit(*row) for row in cursor.fetchall()]
+
+
+def search_clinical_like(words, kinds, patient, hospital, date_from, date_to, limit):
+    # no full-text index on this database: every word as a substring, unranked
+    hits = []
+    for kind in kinds:
+        source = CLINICAL_SOURCES[kind]
+        conditions, params = clinical_filters(kind, patient, hospital, date_from, date_to)
+        conditions = [f"lower({source['document']}) LIKE %s" for word in words] + conditions
+        params = ['%' + escape_like(word) + '%' for word in words] + params
+        sql = f"""
+            SELECT '{kind}', id, patient_id, {source['day']}, {source['title']}, {source['body']}, 0
+            FROM {source['table']} WHERE {' AND '.join(conditions)} ORDER BY id LIMIT %s
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params + [limit])
+            hits += [clinical_hit(*row) for row in cursor.fetchall()]
+    return hits[:limit]
+
+
+def clinical_hit(kind, object_id, patient, day, title, snippet, score):
+    if isinstance(day, str):
+        day = datetime.date.fromisoformat(day)
+    return {'kind': kind, 'id': object_id, 'patient': patient, 'day': day, 'title': title or None,
+            'snippet': snippet, 'score': round(float(score), 4)}
+
+
+# SQLite only: rebuilding a table (what a sqlite migration does for most column changes, e.g. adding
+# a NOT NULL column) drops the table's triggers, and with them the upkeep of the FTS tables above.
+# After every migrate, put back any trigger that went missing and re-index from the source tables.
+# Migrations 0009 and 0010 create the tables and triggers from these same definitions.
+
+SQLITE_SEARCH_TABLES = {
+    'core_patient_search': "CREATE VIRTUAL TABLE core_patient_search USING fts5("
+                           "first_name, last_name, contact_info, content='core_patient', content_rowid='id', "
+                           "tokenize='trigram')",
+    # rowid = object id * 4 + kind (1 diagnostic, 2 medical history, 3 referral) so a trigger can find a row's entry
+    'core_clinical_search': "CREATE VIRTUAL TABLE core_clinical_search USING fts5("
+                            "kind UNINDEXED, object_id UNINDEXED, patient_id UNINDEXED, day UNINDEXED, title, body, "
+                            "tokenize='porter unicode61')",
+}
+
+def sqlite_clinical_row(kind, prefix):
+    source = CLINICAL_SOURCES[kind]
+    offset = list(CLINICAL_SOURCES).index(kind) + 1
+
+    def columns(expression):
+        return re.sub(r'\b(diagnostic_type|condition|treatment|result|notes|referral_reason)\b', prefix + r'\1', expression)
+    return (f"{prefix}id * 4 + {offset}, '{kind}', {prefix}id, {prefix}patient_id, {prefix}{source['day']}, "
+            f"{columns(source['title'])}, {columns(source['body'])}")
+
+
+def sqlite_search_indexes():
+    """{fts table: (trigger name -> CREATE TRIGGER statement, statements that re-index everything)}"""
+    patient_row = "{0}.id, {0}.first_name, {0}.last_name, {0}.contact_info"
+    patient_insert = "INSERT INTO core_patient_search(rowid, first_name, last_name, contact_info)"
+    patient_delete = "INSERT INTO core_patient_search(core_patient_search, rowid, first_name, last_name, contact_info)"
+    indexes = {
+        'core_patient_search': ({
+            'core_patient_search_insert': f"AFTER INSERT ON core_patient BEGIN {patient_insert} VALUES ({patient_row.format('new')}); END",
+            'core_patient_search_delete': f"AFTER DELETE ON core_patient BEGIN {patient_delete} VALUES ('delete', {patient_row.format('old')}); END",
+            'core_patient_search_update': f"AFTER UPDATE ON core_patient BEGIN {patient_delete} VALUES ('delete', {patient_row.format('old')}); "
+                                          f"{patient_insert} VALUES ({patient_row.format('new')}); END",
+        }, ["INSERT INTO core_patient_search(core_patient_search) VALUES ('rebuild')"]),
+    }
+
+    triggers, rebuild = {}, ['DELETE FROM core_clinical_search']
+    insert = "INSERT INTO core_clinical_search(rowid, kind, object_id, patient_id, day, title, body)"
+    for offset, (kind, source) in enumerate(CLINICAL_SOURCES.items(), start=1):
+        table = source['table']
+        delete = f"DELETE FROM core_clinical_search WHERE rowid = old.id * 4 + {offset};"
+        text = re.findall(r'\b(diagnostic_type|condition|treatment|result|notes|referral_reason)\b',
+                          source['title'] + ' ' + source['body'])
+        watched = ', '.join(['patient_id', source['day']] + text)
+        triggers[f'{table}_search_insert'] = f"AFTER INSERT ON {table} BEGIN {insert} VALUES ({sqlite_clinical_row(kind, 'new.')}); END"
+        triggers[f'{table}_search_delete'] = f"AFTER DELETE ON {table} BEGIN {delete} END"
+        triggers[f'{table}_search_update'] = (f"AFTER UPDATE OF {watched} ON {table} BEGIN {delete} "
+                                              f"{insert} VALUES ({sqlite_clinical_row(kind, 'new.')}); END")
+        rebuild.append(f"{insert} SELECT {sqlite_clinical_row(kind, '')} FROM {table}")
+    indexes['core_clinical_search'] = (triggers, rebuild)
+    return indexes
+
+
+def sqlite_create_statements(table):
+    """The FTS table, its triggers and the indexing of the rows that already exist, for a migration"""
+    triggers, rebuild = sqlite_search_indexes()[table]
+    return [SQLITE_SEARCH_TABLES[table], *(f'CREATE TRIGGER {name} {body}' for name, body in triggers.items()), *rebuild]
+
+
+def sqlite_drop_statements(table):
+    triggers, _ = sqlite_search_indexes()[table]
+    return [*(f'DROP TRIGGER IF EXISTS {name}' for name in triggers), f'DROP TABLE IF EXISTS {table}']
+
+
+def restore_sqlite_triggers(using='default', **kwargs):
+    """post_migrate receiver, see above"""
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        existing = {(kind, name) for kind, name in cursor.fetchall()}
+        for table, (triggers, rebuild) in sqlite_search_indexes().items():
+            if ('table', table) not in existing:
+                continue  # its migration isn't applied
+            missing = [name for name in triggers if ('trigger', name) not in existing]
+            if not missing:
+                continue
+            with transaction.atomic(using=using):
+                for name in missing:
+                    cursor.execute(f'CREATE TRIGGER {name} {triggers[name]}')
+                for statement in rebuild:
+                    cursor.execute(statement)
@@ -0,0 +1,338 @@
+import datetime
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction
+from django.db.models import Max
+
+from . import rollups, search, sync
+from .models import Diagnostic, Equipment, Hospital, MedicalHistory, Patient, Referral, User
+
+# Generates realistic looking synthetic data straight into the database, with COPY on postgres and
+# chunked bulk_create elsewhere, optionally in several processes (manage.py seed_data).
+# Used by the benchmark commands so that performance problems can be reproduced locally.
+# Every model gets explicit primary keys (continuing after the current max id) so that the rows
+# of the next model can point at them without reading anything back from the database.
+
+FIRST_NAMES = ['Grace', 'Chikondi', 'Thoko', 'Mphatso', 'Kondwani', 'Tiwonge', 'Chisomo', 'Limbani',
+               'Yamikani', 'Dalitso', 'Madalitso', 'Takondwa', 'Blessings', 'Mercy', 'Precious', 'Victor']
+LAST_NAMES = ['Chiwaya', 'Banda', 'Phiri', 'Mwale', 'Tembo', 'Kumwenda', 'Nkhoma', 'Gondwe',
+              'Chirwa', 'Mbewe', 'Kachale', 'Msiska', 'Nyirenda', 'Jere', 'Zulu', 'Moyo']
+TOWNS = ['Blantyre', 'Lilongwe', 'Zomba', 'Mzuzu', 'Kasungu', 'Mangochi', 'Karonga', 'Salima']
+CONDITIONS = [('Hypertension', 'Medication'), ('Diabetes', 'Insulin'), ('Malaria', 'Artemisinin'),
+              ('Tuberculosis', 'DOTS regimen'), ('HIV', 'ART'), ('Asthma', 'Inhaler'),
+              ('Pneumonia', 'Antibiotics'), ('Fracture', 'Cast')]
+DIAGNOSTICS = [('Chest X-ray', 'Suspected TB, opacity in upper right lobe'), ('Chest X-ray', 'Clear lung fields'),
+               ('Blood Test', 'Normal'), ('Blood Test', 'Low haemoglobin'), ('Malaria RDT', 'Positive'),
+               ('Malaria RDT', 'Negative'), ('Ultrasound', 'No abnormality detected'), ('CT Scan', 'Mass detected')]
+EQUIPMENT = ['MRI Machine', 'CT Scanner', 'X-ray Machine', 'Dialysis Machine', 'Ventilator', 'Ultrasound',
+             'Incubator', 'ECG Machine', 'Oxygen Concentrator', 'Defibrillator', 'Anaesthesia Machine']
+REFERRAL_REASONS = ['Specialized surgery required', 'Needs dialysis', 'CT scan not available locally',
+                    'Suspected TB, needs specialist review', 'Complicated delivery', 'Oncology consultation']
+# every seeded user (username seed<id>) logs in with this password
+SEED_USERNAME_PREFIX = 'seed'
+SEED_PASSWORD = 'seed-password'
+
+# rows generated per patient / per hospital
+RATIOS = {
+    'patients_per_hospital': 500,
+    'equipment_per_hospital': 20,
+    'users_per_hospital': 10,
+    'histories_per_patient': 2,
+    'diagnostics_per_patient': 3,
+    'referrals_per_patient': 1.5,
+}
+
+
+def counts_for_total(total_rows):
+    """Split a target total number of rows across the models using RATIOS."""
+    per_patient = (1 + RATIOS['histories_per_patient'] + RATIOS['diagnostics_per_patient']
+                   + RATIOS['referrals_per_patient']
+                   + RATIOS['equipment_per_hospital'] / RATIOS['patients_per_hospital']
+                   + 1 / RATIOS['patients_per_hospital'])
+    patients = max(int(total_rows / per_patient), 1)
+    hospitals = max(patients // RATIOS['patients_per_hospital'], 2)
+    return {
+        'hospitals': hospitals,
+        'patients': patients,
+        'equipment': hospitals * RATIOS['equipment_per_hospital'],
+        'histories': int(patients * RATIOS['histories_per_patient']),
+        'diagnostics': int(patients * RATIOS['diagnostics_per_patient']),
+        'referrals': int(patients * RATIOS['referrals_per_patient']),
+        # on top of the total (0.25% of it), so the other tables keep the sizes they had before users were seeded
+        'users': hospitals * RATIOS['users_per_hospital'],
+    }
+
+
+def _next_id(model):
+    return (model.objects.aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+
+
+def _random_date(rng, start, days):
+    return start + datetime.timedelta(days=rng.randrange(days))
+
+
+def generate_hospitals(rng, first_id, count):
+    for offset in range(count):
+        yield Hospital(
+            id=first_id + offset,
+            name=f'{rng.choice(TOWNS)} {rng.choice(["District", "Central", "Community", "Mission"])} Hospital {first_id + offset}',
+            type=rng.choice(['Public', 'Public', 'Private']),
+            address=rng.choice(TOWNS),
+            contact_info=f'+265{rng.randrange(10**8, 10**9)}',
+        )
+
+
+def generate_users(rng, first_id, count, hospital_ids, password_hash):
+    # password_hash: make_password(SEED_PASSWORD) computed once, hashing it per row would take hours
+    for offset in range(count):
+        yield User(
+            id=first_id + offset,
+            username=f'{SEED_USERNAME_PREFIX}{first_id + offset}',
+            password=password_hash,
+            first_name=rng.choice(FIRST_NAMES),
+            last_name=rng.choice(LAST_NAMES),
+            hospital_id=rng.randrange(*hospital_ids),
+            role=rng.choice(['Doctor', 'Doctor', 'Doctor', 'Admin']),
+            date_joined=datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+            + datetime.timedelta(minutes=rng.randrange(60 * 24 * 365 * 6)),
+        )
+
+
+def generate_patients(rng, first_id, count):
+    for offset in range(count):
+        yield Patient(
+            id=first_id + offset,
+            first_name=rng.choice(FIRST_NAMES),
+            last_name=rng.choice(LAST_NAMES),
+            dob=_random_date(rng, datetime.date(1940, 1, 1), 365 * 80),
+            gender=rng.choice(['Male', 'Female', 'Other']),
+            contact_info=f'+265{rng.randrange(10**8, 10**9)}',
+        )
+
+
+def generate_equipment(rng, first_id, count, hospital_ids):
+    for offset in range(count):
+        name = rng.choice(EQUIPMENT)
+        yield Equipment(
+            id=first_id + offset,
+            hospital_id=rng.randrange(*hospital_ids),
+            equipment_name=name,
+            description=name,
+            available=rng.random() < 0.7,
+        )
+
+
+def generate_histories(rng, first_id, count, patient_ids):
+    for offset in range(count):
+        condition, treatment = rng.choice(CONDITIONS)
+        start = _random_date(rng, datetime.date(2015, 1, 1), 365 * 9)
+        ongoing = rng.random() < 0.2
+        yield MedicalHistory(
+            id=first_id + offset,
+            patient_id=rng.randrange(*patient_ids),
+            condition=condition,
+            treatment=treatment,
+            start_date=start,
+            end_date=None if ongoing else start + datetime.timedelta(days=rng.randrange(7, 400)),
+            notes=f'{condition} managed with {treatment.lower()}',
+        )
+
+
+def generate_diagnostics(rng, first_id, count, patient_ids):
+    for offset in range(count):
+        diagnostic_type, result = rng.choice(DIAGNOSTICS)
+        yield Diagnostic(
+            id=first_id + offset,
+            patient_id=rng.randrange(*patient_ids),
+            diagnostic_type=diagnostic_type,
+            result=result,
+            date_taken=_random_date(rng, datetime.date(2015, 1, 1), 365 * 9),
+            notes=rng.choice([None, 'Repeat in 3 months', 'Reviewed by clinician']),
+        )
+
+
+def generate_referrals(rng, first_id, count, patient_ids, hospital_ids):
+    for offset in range(count):
+        referred_from = rng.randrange(*hospital_ids)
+        referred_to = rng.randrange(*hospital_ids)
+        if referred_to == referred_from:
+            referred_to = hospital_ids[0] if referred_from != hospital_ids[0] else hospital_ids[0] + 1
+        referral_date = _random_date(rng, datetime.date(2018, 1, 1), 365 * 6)
+        status = rng.choice(['Pending', 'Accepted', 'Accepted', 'Rejected'])
+        yield Referral(
+            id=first_id + offset,
+            patient_id=rng.randrange(*patient_ids),
+            referred_from_id=referred_from,
+            referred_to_id=referred_to,
+            referral_reason=rng.choice(REFERRAL_REASONS),
+            referral_date=referral_date,
+            status=status,
+            # what Referral.save() would have stamped on the day of the decision, within a month
+            decision_date=referral_date + datetime.timedelta(days=rng.randrange(31)) if status != 'Pending' else None,
+        )
+
+
+# models in load order, grouped in stages: a stage only points at the rows of the stages before it,
+# so the models of one stage are loaded in parallel
+STAGES = [
+    ['hospitals', 'patients'],
+    ['equipment', 'histories', 'diagnostics', 'referrals', 'users'],
+]
+MODELS = {'hospitals': Hospital, 'patients': Patient, 'equipment': Equipment, 'histories': MedicalHistory,
+          'diagnostics': Diagnostic, 'referrals': Referral, 'users': User}
+GENERATORS = {
+    'hospitals': lambda rng, first, count, plan: generate_hospitals(rng, first, count),
+    'patients': lambda rng, first, count, plan: generate_patients(rng, first, count),
+    'equipment': lambda rng, first, count, plan: generate_equipment(rng, first, count, plan['hospital_ids']),
+    'histories': lambda rng, first, count, plan: generate_histories(rng, first, count, plan['patient_ids']),
+    'diagnostics': lambda rng, first, count, plan: generate_diagnostics(rng, first, count, plan['patient_ids']),
+    'referrals': lambda rng, first, count, plan: generate_referrals(rng, first, count, plan['patient_ids'], plan['hospital_ids']),
+    'users': lambda rng, first, count, plan: generate_users(rng, first, count, plan['hospital_ids'], plan['password_hash']),
+}
+
+# rows made with one random generator, seeded from (seed, model, block number): the unit of work of
+# the worker processes, and the reason the rows don't depend on how many workers made them
+BLOCK_ROWS = 10_000
+
+
+def insert_block(key, block, first_id, count, plan):
+    """Generate and insert one block of rows in its own transaction, in this process or a worker."""
+    rng = random.Random(f"{plan['seed']}:{key}:{block}")
+    model = MODELS[key]
+    rows = list(GENERATORS[key](rng, first_id, count, plan))
+    with transaction.atomic():
+        # seeded rows show up in /api/sync/ like any other, numbered inside the transaction that writes
+        # them so a client syncing during the load can't skip past a block that isn't committed yet
+        sync.stamp(rows)
+        for start in range(0, len(rows), plan['batch_size']):
+            write_rows(model, rows[start:start + plan['batch_size']], plan['method'])
+    return key, len(rows)
+
+
+def write_rows(model, instances, method):
+    if method == 'copy':
+        copy_rows(model, instances)
+    else:
+        model.objects.bulk_create(instances, batch_size=len(instances))
+
+
+def copy_rows(model, instances):
+    """COPY ... FROM STDIN (postgres with psycopg 3): no SQL to build or parse per row."""
+    fields = [field for field in model._meta.concrete_fields if not field.generated]
+    quote = connection.ops.quote_name
+    sql = f"COPY {quote(model._meta.db_table)} ({', '.join(quote(field.column) for field in fields)}) FROM STDIN"
+    with connection.cursor() as cursor, cursor.copy(sql) as copy:
+        for instance in instances:
+            copy.write_row([field.get_db_prep_save(field.pre_save(instance, True), connection) for field in fields])
+
+
+def load_method(method='auto'):
+    """'copy' on postgres with psycopg 3, 'bulk' (bulk_create) everywhere else."""
+    if method != 'auto':
+        return method
+    if connection.vendor == 'postgresql':
+        from django.db.backends.postgresql.psycopg_any import is_psycopg3
+        if is_psycopg3:
+            return 'copy'
+    return 'bulk'
+
+
+def setup_worker():
+    if connection.vendor == 'sqlite':
+        # the workers take turns writing to a sqlite file, wait for the lock instead of failing after 5s
+        connection.settings_dict['OPTIONS'].setdefault('timeout', 600)
+
+
+def run_blocks(tasks, plan, workers):
+    """insert_block() every task, in `workers` forked processes; yields (key, rows inserted) as blocks finish."""
+    if workers <= 1:
+        for task in tasks:
+            yield insert_block(*task, plan)
+        return
+    # a forked process must not reuse the parent's connections, it opens its own
+    connections.close_all()
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'), initializer=setup_worker) as pool:
+        futures = [pool.submit(insert_block, *task, plan) for task in tasks]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            raise
+
+
+def seed(counts, seed=0, batch_size=5000, log=None, workers=1, method='auto'):
+    """_summary_
+    Insert counts['hospitals'], counts['patients'], ... rows (see counts_for_total).
+    The same counts and seed always produce the same rows on an empty database, whatever `workers`
+    and `batch_size` are. `workers` > 1 loads the models of a stage (and the blocks of a model) in
+    that many processes, which pays off on postgres; sqlite takes one writer at a time.
+    `method`: 'copy' (postgres only), 'bulk' (bulk_create) or 'auto' for the fastest available.
+    Returns a dict with the inserted count per model.
+    """
+    log = log or (lambda message: None)
+    if workers > 1 and ('fork' not in multiprocessing.get_all_start_methods()
+                        or connection.settings_dict['NAME'] == ':memory:' or connection.in_atomic_block):
+        workers = 1  # the workers need fork() and a database (and committed rows) they can share
+    first_hospital = _next_id(Hospital)
+    first_patient = _next_id(Patient)
+    plan = {
+        'seed': seed,
+        'batch_size': batch_size,
+        'method': load_method(method),
+        'hospital_ids': (first_hospital, first_hospital + counts['hospitals']),
+        'patient_ids': (first_patient, first_patient + counts['patients']),
+        # a salt made from the seed: same rows every time, and long enough that a login doesn't rehash it
+        'password_hash': make_password(SEED_PASSWORD, salt=f'{SEED_USERNAME_PREFIX}{seed}'.ljust(22, '0')),
+    }
+    inserted = dict.fromkeys(MODELS, 0)
+
+    triggers_dropped = drop_sqlite_search_triggers()
+    try:
+        for stage in STAGES:
+            tasks = []
+            for key in stage:
+                model, count = MODELS[key], counts.get(key, 0)
+                first_id = _next_id(model)
+                tasks += [(key, block, first_id + start, min(BLOCK_ROWS, count - start))
+                          for block, start in enumerate(range(0, count, BLOCK_ROWS))]
+            remaining = {key: sum(1 for task in tasks if task[0] == key) for key in stage}
+            for key, rows in run_blocks(tasks, plan, workers):
+                inserted[key] += rows
+                remaining[key] -= 1
+                if not remaining[key]:
+                    log(f'{key}: {inserted[key]} rows')
+    finally:
+        if triggers_dropped:
+            search.restore_sqlite_triggers(connection.alias)
+
+    reset_sequences(list(MODELS.values()))
+    if rollups.enabled():
+        rollups.rebuild()  # bulk inserts skip the receivers that keep it up to date
+    return inserted
+
+
+def drop_sqlite_search_triggers():
+    # on sqlite every inserted row also goes through the triggers that fill the search indexes
+    # (core/search.py); loading without them and re-indexing once at the end is faster.
+    # restore_sqlite_triggers() puts them back and rebuilds the indexes.
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        for triggers, _ in search.sqlite_search_indexes().values():
+            for name in triggers:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+    return True
+
+
+def reset_sequences(models):
+    # explicit ids don't advance postgres sequences, move them past the rows we just inserted
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
@@ -1,46 +1,266 @@
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models
+from django.utils.functional import cached_property
 from rest_framework import serializers
+from . import metrics
 from .models import Hospital, User, Patient, MedicalHistory, Diagnostic, Equipment, Referral
 
 # This module converts the resources into JSON objects for transfer over HTTP
 
+
+class TimedDataMixin:
+    """Counts the time spent building .data as the request's serialize time (see core/metrics.py)."""
+
+    @property
+    def data(self):
+        with metrics.timer('serialize'):
+            return super().data
+
+
+# Batch validation
+# With many=True DRF validates every row on its own: each foreign key is a SELECT per row, so a
+# batch of 10,000 referrals costs 30,000 queries before anything is inserted. BulkListSerializer
+# looks at the whole batch first: it fetches every referenced patient/hospital with one IN query
+# per model and validates each distinct choice/date value once, then the per-row validation just
+# reads those results. Unknown ids are still reported per row, like with the normal validation.
+
+class ColumnCachedFieldMixin:
+    """Reuses the result BulkListSerializer computed for this raw value, if there is one."""
+
+    def to_internal_value(self, data):
+        column = getattr(self.root, 'column_cache', {}).get(self.field_name)
+        try:
+            result = column[data] if column is not None else None
+        except (KeyError, TypeError):  # value not seen in the batch, or unhashable
+            result = None
+        if result is None:
+            return super().to_internal_value(data)
+        valid, value = result
+        if valid:
+            return value
+        raise serializers.ValidationError(value)
+
+class BulkChoiceField(ColumnCachedFieldMixin, serializers.ChoiceField):
+    pass
+
+class BulkDateField(ColumnCachedFieldMixin, serializers.DateField):
+    pass
+
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Looks the id up in the objects BulkListSerializer fetched for the batch instead of querying."""
+
+    def to_internal_value(self, data):
+        model = self.get_queryset().model
+        resolved = getattr(self.root, 'resolved_related', {}).get(model)
+        if resolved is None or self.pk_field is not None:
+            return super().to_internal_value(data)
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = model._meta.pk.to_python(data)
+        except DjangoValidationError:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return resolved[pk]
+        except (KeyError, TypeError):
+            self.fail('does_not_exist', pk_value=data)
+
+class BulkListSerializer(TimedDataMixin, serializers.ListSerializer):
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            self.prepare_batch(data)
+        return super().to_internal_value(data)
+
+    def prepare_batch(self, rows):
+        rows = [row for row in rows if isinstance(row, dict)]
+        ids_by_model = defaultdict(set)
+        querysets = {}
+        self.column_cache = {}
+
+        for name, field in self.child.fields.items():
+            if field.read_only:
+                continue
+            relation = field.child_relation if isinstance(field, serializers.ManyRelatedField) else field
+            if isinstance(relation, PrefetchedPrimaryKeyRelatedField):
+                model = relation.get_queryset().model
+                querysets.setdefault(model, relation.get_queryset())
+                for row in rows:
+                    values = row.get(name)
+                    for value in (values if isinstance(values, list) else [values]):
+                        try:
+                            ids_by_model[model].add(model._meta.pk.to_python(value))
+                        except (DjangoValidationError, TypeError):
+                            pass  # reported by the field during the row validation
+            elif isinstance(field, ColumnCachedFieldMixin):
+                self.column_cache[name] = self.validate_column(field, rows)
+
+        # one query per related model, e.g. referred_from and referred_to share a single Hospital query
+        self.resolved_related = {model: querysets[model].in_bulk(ids - {None})
+                                 for model, ids in ids_by_model.items()}
+
+    def validate_column(self, field, rows):
+        results = {}
+        for row in rows:
+            value = row.get(field.field_name)
+            try:
+                if value is None or value in results:
+                    continue
+            except TypeError:
+                continue
+            try:
+                results[value] = (True, super(ColumnCachedFieldMixin, field).to_internal_value(value))
+            except serializers.ValidationError as error:
+                results[value] = (False, error.detail)
+        return results
+
+    def validate_rows(self, rows):
+        """_summary_
+        Validate each row separately (using the batch lookups) and return a list of
+        (validated_data, None) or (None, errors) pairs, so callers can keep the good rows.
+        """
+        self.prepare_batch(rows)
+        results = []
+        for row in rows:
+            try:
+                results.append((self.child.run_validation(row), None))
+            except serializers.ValidationError as error:
+                results.append((None, serializers.as_serializer_error(error)))
+        return results
+
+class BulkModelSerializer(TimedDataMixin, serializers.ModelSerializer):
+    """Base for the serializers below, wires in the batch aware fields (see BulkListSerializer)."""
+    serializer_related_field = PrefetchedPrimaryKeyRelatedField
+    serializer_choice_field = BulkChoiceField
+    serializer_field_mapping = {
+        **serializers.ModelSerializer.serializer_field_mapping,
+        models.DateField: BulkDateField,
+    }
+
+
+class ExpandableFieldsMixin:
+    """_summary_
+    Foreign keys are returned as bare ids by default. Listing a field in `expandable_fields`
+    lets clients ask for the full nested object instead, e.g. /api/referrals/?expand=patient,referred_to
+    The viewsets select_related() the expanded fields (see api/mixins.py) so the nested objects
+    come out of the same query as the rows themselves.
+    """
+    expand_query_param = 'expand'
+    expandable_fields = {}  # field name -> serializer used for the nested object
+
+    @classmethod
+    def get_expanded_field_names(cls, request):
+        if request is None:
+            return []
+        requested = request.query_params.get(cls.expand_query_param, '')
+        return [name for name in dict.fromkeys(requested.split(',')) if name in cls.expandable_fields]
+
+    @cached_property
+    def expanded_serializers(self):
+        return {name: self.expandable_fields[name](context=self.context)
+                for name in self.get_expanded_field_names(self.context.get('request'))}
+
+    def to_representation(self, instance):
+        # the id field stays in place for writes (POST ...?expand=patient still takes a patient id),
+        # only the output gets the nested object
+        data = super().to_representation(instance)
+        for name, serializer in self.expanded_serializers.items():
+            related = getattr(instance, name)
+            data[name] = serializer.to_representation(related) if related is not None else None
+        return data
+
 # Hospital Serializer
-class HospitalSerializer(serializers.ModelSerializer):
+class HospitalSerializer(BulkModelSerializer):
     class Meta:
         model = Hospital
         fields = '__all__'
+        list_serializer_class = BulkListSerializer
 
 # Custom User Serializer
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ExpandableFieldsMixin, BulkModelSerializer):
+    expandable_fields = {'hospital': HospitalSerializer}
+
     class Meta:
         model = User
         fields = '__all__'
+        list_serializer_class = BulkListSerializer
 
 # Patient Serializer
-class PatientSerializer(serializers.ModelSerializer):
+class PatientSerializer(BulkModelSerializer):
     class Meta:
         model = Patient
         fields = '__all__'
+        list_serializer_class = BulkListSerializer
 
 # Medical History Serializer
-class MedicalHistorySerializer(serializers.ModelSerializer):
+class MedicalHistorySerializer(ExpandableFieldsMixin, BulkModelSerializer):
+    expandable_fields = {'patient': PatientSerializer}
+
     class Meta:
         model = MedicalHistory
         fields = '__all__'
+        list_serializer_class = BulkListSerializer
 
 # Diagnostic Serializer
-class DiagnosticSerializer(serializers.ModelSerializer):
+class DiagnosticSerializer(ExpandableFieldsMixin, BulkModelSerializer):
+    expandable_fields = {'patient': PatientSerializer}
+
     class Meta:
         model = Diagnostic
         fields = '__all__'
+        list_serializer_class = BulkListSerializer
 
 # Equipment Serializer
-class EquipmentSerializer(serializers.ModelSerializer):
+class EquipmentSerializer(ExpandableFieldsMixin, BulkModelSerializer):
+    expandable_fields = {'hospital': HospitalSerializer}
+
     class Meta:
         model = Equipment
         fields = '__all__'
+        list_serializer_class = BulkListSerializer
 
 # Referral Serializer
-class ReferralSerializer(serializers.ModelSerializer):
+class ReferralSerializer(ExpandableFieldsMixin, BulkModelSerializer):
+    expandable_fields = {
+        'patient': PatientSerializer,
+        'referred_from': HospitalSerializer,
+        'referred_to': HospitalSerializer,
+    }
+
     class Meta:
         model = Referral
         fields = '__all__'
+        list_serializer_class = BulkListSerializer
+
+# Patient Dossier Serializers
+# Read-only view of a whole case: the patient with their medical history, diagnostics and
+# referrals (with both hospitals). The viewset prefetches every relation, see PatientViewSet.dossier
+class DossierReferralSerializer(serializers.ModelSerializer):
+    referred_from = HospitalSerializer(read_only=True)
+    referred_to = HospitalSerializer(read_only=True)
+
+    class Meta:
+        model = Referral
+        exclude = ['patient']
+
+class DossierMedicalHistorySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MedicalHistory
+        exclude = ['patient']
+
+class DossierDiagnosticSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Diagnostic
+        exclude = ['patient']
+
+class PatientDossierSerializer(TimedDataMixin, serializers.ModelSerializer):
+    medical_history = DossierMedicalHistorySerializer(many=True, read_only=True)
+    diagnostics = DossierDiagnosticSerializer(many=True, read_only=True)
+    referrals = DossierReferralSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Patient
+        fields = ['id', 'first_name', 'last_name', 'dob', 'gender', 'contact_info',
+                  'medical_history', 'diagnostics', 'referrals']
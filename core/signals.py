@@ -0,0 +1,15 @@
+from django.dispatch import Signal
+
+# bulk_create, bulk_update and QuerySet.update() don't send post_save, so every bulk write path
+# in the api sends one of these instead. Anything that has to react to changed rows (cache
+# invalidation etc.) should listen to these as well as to post_save/post_delete.
+# Like post_save they are sent inside the transaction that wrote the rows: database work done by a
+# receiver (the referral rollup) commits or rolls back with them, anything else has to wait for
+# transaction.on_commit().
+
+# sent with sender=<model class>, instances=<list of created objects>
+bulk_created = Signal()
+
+# sent with sender=<model class>, instances=<list of updated objects>, fields=<list of field names>,
+# previous=<copies of the same objects as they were before the update>
+bulk_updated = Signal()
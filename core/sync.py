@@ -0,0 +1,98 @@
+import datetime
+import heapq
+
+from django.db import connections, router, transaction
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import SyncCounter, Tombstone, VersionedModel
+
+# Change feed behind /api/sync/. Every write to a VersionedModel gets the next number from
+# SyncCounter (Model.save() in VersionedModel, bulk writes through stamp()), every delete leaves a
+# Tombstone numbered the same way. A client remembers the highest version it has seen and asks
+# for everything above it, which is an index range scan on each table, sized by the delta.
+# Versions are taken as late as possible, right before the rows are written: on postgres an
+# unfinished transaction holds the feed back below its versions (SyncCounter.settled()).
+#
+# Lock order matters where versions come from the SyncCounter row (not postgres): a versioned write
+# takes that lock *before* deleting rows, otherwise two writers could each hold what the other waits for.
+
+
+def stamp(instances):
+    """_summary_
+    Give instances about to be written with bulk_create/bulk_update increasing versions.
+    Must be called inside the transaction.atomic() block that writes them.
+    Returns the fields it set (['version']) to add to bulk_update's field list, or [] for other models.
+    """
+    instances = list(instances)
+    if not instances or not isinstance(instances[0], VersionedModel):
+        return []
+    for instance, version in zip(instances, SyncCounter.allocate(len(instances))):
+        instance.version = version
+    return ['version']
+
+
+@receiver(pre_delete)
+def reserve_tombstone_version(sender, instance, **kwargs):
+    # runs inside the delete's transaction before any row is deleted, see the lock order note above
+    if isinstance(instance, VersionedModel):
+        instance._tombstone_version, = SyncCounter.allocate()
+
+
+@receiver(post_delete)
+def leave_tombstone(sender, instance, **kwargs):
+    version = getattr(instance, '_tombstone_version', None)
+    if version is not None:
+        Tombstone.objects.create(model=sender._meta.label_lower, object_id=instance.pk, version=version)
+
+
+class SyncTokenExpired(Exception):
+    """The client's version is older than the oldest tombstone kept, it has to start again from 0."""
+
+
+def changes(models, since=0, limit=500):
+    """_summary_
+    Changes to `models` with a version above `since`, oldest first, at most `limit` of them:
+    (version, model, instance or None, object id) tuples, instance is None for deletes.
+    Returns (changes, has_more). since=0 means a full download (tombstones aren't needed then).
+    Changes that transactions still being committed could land below are left for the next call.
+    """
+    settled = SyncCounter.settled(connections[router.db_for_read(Tombstone)])
+    pruned_through = (SyncCounter.objects.filter(pk=SyncCounter.COUNTER_ID)
+                      .values_list('pruned_through', flat=True).first()) or 0
+    if since and since < pruned_through:
+        raise SyncTokenExpired()
+
+    streams = []
+    for model in models:
+        rows = model.objects.filter(version__gt=since)
+        if settled is not None:
+            rows = rows.filter(version__lte=settled)
+        rows = rows.order_by('version')[:limit + 1]
+        streams.append([(row.version, model, row, row.pk) for row in rows])
+    if since:
+        labels = {model._meta.label_lower: model for model in models}
+        tombstones = Tombstone.objects.filter(version__gt=since, model__in=labels)
+        if settled is not None:
+            tombstones = tombstones.filter(version__lte=settled)
+        tombstones = tombstones.order_by('version')[:limit + 1]
+        streams.append([(tombstone.version, labels[tombstone.model], None, tombstone.object_id)
+                        for tombstone in tombstones])
+
+    merged = list(heapq.merge(*streams, key=lambda change: change[0]))
+    return merged[:limit], len(merged) > limit
+
+
+def prune_tombstones(older_than_days):
+    """Delete tombstones older than the given number of days, returns how many were deleted.
+    Clients whose last sync is older than that get SyncTokenExpired and have to download everything again."""
+    cutoff = timezone.now() - datetime.timedelta(days=older_than_days)
+    with transaction.atomic():
+        expired = Tombstone.objects.filter(deleted_at__lt=cutoff)
+        newest = expired.order_by('-version').values_list('version', flat=True).first()
+        if newest is None:
+            return 0
+        SyncCounter.objects.filter(pk=SyncCounter.COUNTER_ID, pruned_through__lt=newest).update(pruned_through=newest)
+        deleted, _ = expired.delete()
+    return deleted
@@ -12,5 +12,11 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'referral_app.settings')
+# the static files are served by StaticFilesApplication below, not by WhiteNoiseMiddleware
+os.environ['STATIC_MIDDLEWARE'] = 'False'
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from referral_app.staticfiles import StaticFilesApplication  # noqa: E402 (reads the settings)
+
+application = StaticFilesApplication(django_application)
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 from pathlib import Path
 import dj_database_url
 import os
+import tempfile
 
 from dotenv import load_dotenv
 
@@ -22,6 +23,9 @@ from datetime import timedelta
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(days=10),
+    # tokens carry role, hospital and staff flags, and a revoked user can't refresh (api/authentication.py)
+    'TOKEN_OBTAIN_SERIALIZER': 'api.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'api.authentication.ClaimsTokenRefreshSerializer',
 }
 
 
@@ -70,20 +74,35 @@ CSRF_TRUSTED_ORIGINS = ['https://referralapp-production.up.railway.app']
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # JWTAuthentication without the SELECT on core.User per request (api/authentication.py)
+        'api.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',  # Might be needed for frontend
     ),
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    # JSON in and out with orjson when it is installed, the json module otherwise (api/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.FastJSONRenderer', # orjson, first so Accept: application/json and ?format=json pick it
+        'api.renderers.JSONRenderer', # DRF's encoder, only with ?format=drfjson
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'api.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     
-    # uncomment if clients want pagination
-    # 'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
-    # 'PAGE_SIZE': 1  # Number of items per page
+    # keyset pagination, only kicks in when a client sends ?page_size= or ?cursor= (see api/pagination.py)
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.KeysetPagination',
+    'PAGE_SIZE': 100  # Default number of items per page
 }
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     # whitenosie should always be just below security middleware
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    # times every request (queries, auth, serializers, rendering) for Server-Timing and /api/metrics/,
+    # below whitenoise so static files aren't counted
+    'api.middleware.RequestMetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -96,6 +115,11 @@ MIDDLEWARE = [
 
 
 ]
+# referral_app/asgi.py serves the static files in front of Django and sets this to False: WhiteNoiseMiddleware
+# is sync only, in the list it makes Django run every request of the chain through a thread under ASGI
+STATIC_MIDDLEWARE = os.getenv("STATIC_MIDDLEWARE", "True") == "True"
+if not STATIC_MIDDLEWARE:
+    MIDDLEWARE.remove("whitenoise.middleware.WhiteNoiseMiddleware")
 
 ROOT_URLCONF = 'referral_app.urls'
 
@@ -132,10 +156,124 @@ WSGI_APPLICATION = 'referral_app.wsgi.application'
 
 DATABASES = {
     'default': dj_database_url.config(
-        default=os.getenv("DATABASE_URL")
+        default=os.getenv("DATABASE_URL"),
+        # keep connections open between requests instead of a new postgres handshake every time,
+        # checked before reuse so a connection the server dropped is replaced instead of failing a request.
+        # Under asgi.py set DB_CONN_MAX_AGE=0 and use DB_POOL: connections there belong to one request
+        conn_max_age=int(os.getenv("DB_CONN_MAX_AGE", 60)),
+        conn_health_checks=True,
     )
 }
 
+# Connection pool (postgres with psycopg 3, Django's native pool). One pool per worker process:
+# workers x DB_POOL_MAX_SIZE must stay below the server's max_connections. A request that finds the
+# pool exhausted waits up to DB_POOL_TIMEOUT seconds for a connection. Counters: /api/db-pool-stats/
+DB_POOL = os.getenv("DB_POOL", "False") == "True"
+if DB_POOL and DATABASES['default'].get('ENGINE') == 'django.db.backends.postgresql':
+    # Django sets check=ConnectionPool.check_connection, every checkout is health checked
+    DATABASES['default']['CONN_MAX_AGE'] = 0 # the pool keeps the connections open, Django must not
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+        'min_size': int(os.getenv("DB_POOL_MIN_SIZE", 2)),
+        'max_size': int(os.getenv("DB_POOL_MAX_SIZE", 10)), # at least the threads that query at once per worker
+        'timeout': float(os.getenv("DB_POOL_TIMEOUT", 10)),
+        'max_idle': 300, # seconds before an unused connection above min_size is closed
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Local memory by default (fine for tests and a single worker). Set REDIS_URL to share the
+# cache, and so the response cache invalidations, between several workers.
+
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+# findings of the query profiler, written by the workers and read by `manage.py dump_query_profiles`:
+# redis when there is one, otherwise files the processes of this machine share
+CACHES['query_profiler'] = {**CACHES['default'], 'KEY_PREFIX': 'query_profiler'} if os.getenv("REDIS_URL") else {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.getenv("QUERY_PROFILER_DIR", os.path.join(tempfile.gettempdir(), 'referral_app_query_profiler')),
+    'OPTIONS': {'MAX_ENTRIES': 1000},
+}
+
+# the api response cache (api/cache.py) in a store of its own, so other users of the default cache can't
+# crowd its entries out, with room for many entries before the local memory backend starts culling
+CACHES['api'] = {**CACHES['default'], 'KEY_PREFIX': 'api'} if os.getenv("REDIS_URL") else {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'api',
+    'OPTIONS': {'MAX_ENTRIES': int(os.getenv("API_CACHE_MAX_ENTRIES", 10000))},
+}
+API_CACHE_ALIAS = 'api' # cache used by the api response cache (api/cache.py)
+API_CACHE_TIMEOUT = int(os.getenv("API_CACHE_TIMEOUT", 300)) # seconds a cached response lives at most
+
+
+# Authentication (api/authentication.py)
+# user snapshots and revocations in a cache of their own: a revocation crowded out by other entries would let
+# the revoked tokens back in. At most two keys per user, the local memory backend culls nothing below
+# AUTH_CACHE_MAX_ENTRIES, keep it above twice the number of users. Redis must not evict them either
+# (maxmemory-policy noeviction) and shares them between the workers
+CACHES['auth'] = {**CACHES['default'], 'KEY_PREFIX': 'auth'} if os.getenv("REDIS_URL") else {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'auth',
+    'OPTIONS': {'MAX_ENTRIES': int(os.getenv("AUTH_CACHE_MAX_ENTRIES", 1_000_000))},
+}
+AUTH_CACHE_ALIAS = 'auth' # cache holding the user snapshots and revocations
+AUTH_USER_CACHE_TIMEOUT = int(os.getenv("AUTH_USER_CACHE_TIMEOUT", 60)) # seconds a user is served from the cache
+# build the user from the token's claims, no user lookup at all. Only revocations are checked, so
+# with the local memory cache a deactivated user keeps access to the other workers until its token expires
+AUTH_STATELESS_CLAIMS = os.getenv("AUTH_STATELESS_CLAIMS", "False") == "True"
+
+
+# Bulk writes (api/mixins.py, api/bulk.py)
+BULK_CREATE_BATCH_SIZE = 1000 # rows per INSERT statement in the batch POST
+BULK_INGEST_CHUNK_SIZE = int(os.getenv("BULK_INGEST_CHUNK_SIZE", 1000)) # rows per transaction in /bulk/ uploads
+BULK_INGEST_MAX_CHUNK_SIZE = 10000 # largest ?chunk_size= a client may ask for
+
+
+# Async read path (AsyncReadMixin in api/mixins.py): list and retrieve run as coroutines with the
+# async ORM. Only turn it on when serving referral_app/asgi.py, under wsgi it just adds overhead.
+API_ASYNC_READS = os.getenv("API_ASYNC_READS", "False") == "True"
+
+
+# Request metrics (core/metrics.py, api/middleware.py)
+API_METRICS_ENABLED = os.getenv("API_METRICS_ENABLED", "True") == "True"
+API_SERVER_TIMING = os.getenv("API_SERVER_TIMING", "True") == "True" # the Server-Timing header on every response
+# Prometheus scrapes /api/metrics/ with `Authorization: Bearer <API_METRICS_TOKEN>`, admins can always read it
+API_METRICS_TOKEN = os.getenv("API_METRICS_TOKEN")
+
+# Query profiler (core/profiling.py), needs API_METRICS_ENABLED. Share of the requests whose queries are
+# checked for N+1 patterns and slow statements, e.g. 0.01. Dump what it found with `manage.py dump_query_profiles`
+QUERY_PROFILER_SAMPLE_RATE = float(os.getenv("QUERY_PROFILER_SAMPLE_RATE", 0))
+QUERY_PROFILER_SLOW_MS = float(os.getenv("QUERY_PROFILER_SLOW_MS", 100)) # a query at least this slow is reported
+QUERY_PROFILER_REPEAT_THRESHOLD = int(os.getenv("QUERY_PROFILER_REPEAT_THRESHOLD", 5)) # same query this often in one request: N+1
+QUERY_PROFILER_EXPLAIN = os.getenv("QUERY_PROFILER_EXPLAIN", "False") == "True" # keep the parameters of the slow SELECTs, dump_query_profiles EXPLAINs them
+QUERY_PROFILER_BUFFER_SIZE = 500 # requests with findings kept, the oldest are overwritten
+QUERY_PROFILER_CACHE_ALIAS = 'query_profiler'
+
+
+# Referral analytics (core/rollups.py)
+# keep the ReferralDailyStat rollup up to date on every referral write. After a time with it off,
+# run `manage.py rebuild_referral_rollup` before reading ?source=rollup again
+REFERRAL_ROLLUP_ENABLED = os.getenv("REFERRAL_ROLLUP_ENABLED", "True") == "True"
+
+
+# Referral push events (core/events.py), streamed by /api/referrals/events/ when served through asgi.py
+# The local broker only reaches clients of the same worker process, with REDIS_URL set every
+# worker publishes and listens through redis pub/sub instead.
+REFERRAL_EVENTS_REDIS_URL = os.getenv("REDIS_URL")
+REFERRAL_EVENTS_BROKER = 'core.events.RedisBroker' if REFERRAL_EVENTS_REDIS_URL else 'core.events.LocalBroker'
+REFERRAL_EVENTS_HEARTBEAT = 15 # seconds between keepalive comments on an idle stream, below proxy read timeouts
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -185,14 +323,40 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 
+# Logging (core/logs.py): JSON lines written by a background thread, so a request never waits for the disk
+LOG_FILE = os.getenv("LOG_FILE", os.path.join(BASE_DIR, 'django_error.log'))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "ERROR")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)) # the file is rotated at this size
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5)) # rotated files kept, django_error.log.1 to .5
+LOG_QUEUE_SIZE = 10000 # records waiting to be written, past that they are dropped (and counted)
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", 10)) # times the same message is written per window, 0 for no limit
+LOG_RATE_LIMIT_WINDOW = float(os.getenv("LOG_RATE_LIMIT_WINDOW", 60)) # seconds
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'core.logs.JSONFormatter',
+        },
+    },
+    'filters': {
+        'rate_limit': {
+            '()': 'core.logs.RateLimitFilter',
+            'rate': LOG_RATE_LIMIT,
+            'per': LOG_RATE_LIMIT_WINDOW,
+        },
+    },
     'handlers': {
         'file': {
-            'level': 'ERROR',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(BASE_DIR, 'django_error.log'),
+            'level': LOG_LEVEL,
+            'class': 'core.logs.QueuedRotatingFileHandler',
+            'filename': LOG_FILE,
+            'maxBytes': LOG_MAX_BYTES,
+            'backupCount': LOG_BACKUP_COUNT,
+            'queue_size': LOG_QUEUE_SIZE,
+            'formatter': 'json',
+            'filters': ['rate_limit'],
         },
     },
     'loggers': {
@@ -201,5 +365,16 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # our own modules: api.mixins, api.bulk...
+        'api': {
+            'handlers': ['file'],
+            'level': LOG_LEVEL,
+            'propagate': True,
+        },
+        'core': {
+            'handlers': ['file'],
+            'level': LOG_LEVEL,
+            'propagate': True,
+        },
     },
 }
\ No newline at end of file
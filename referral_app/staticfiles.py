@@ -0,0 +1,46 @@
+from asgiref.sync import sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StaticFilesApplication:
+    """_summary_
+    Serves STATIC_URL with WhiteNoise in front of Django and passes every other request on.
+    WhiteNoise 6 only has a sync middleware, which would make Django adapt its whole middleware chain
+    and send every API request through a thread; here only static files touch a thread (to read the file).
+    Same files and headers as the middleware: it is configured from the same settings.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.whitenoise = WhiteNoiseMiddleware()
+
+    async def __call__(self, scope, receive, send):
+        static_file = None
+        if scope['type'] == 'http':
+            path = scope['path'].removeprefix(scope.get('root_path', ''))
+            if self.whitenoise.autorefresh:  # DEBUG: looks on the disk
+                static_file = await sync_to_async(self.whitenoise.find_file, thread_sensitive=False)(path)
+            else:
+                static_file = self.whitenoise.files.get(path)
+        if static_file is None:
+            return await self.application(scope, receive, send)
+
+        # the request headers the way WhiteNoise reads them (If-None-Match, Accept-Encoding, Range...)
+        headers = {f"HTTP_{name.decode('latin1').upper().replace('-', '_')}": value.decode('latin1')
+                   for name, value in scope['headers']}
+        response = await sync_to_async(static_file.get_response, thread_sensitive=False)(scope['method'], headers)
+        await send({
+            'type': 'http.response.start',
+            'status': int(response.status),
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.headers],
+        })
+        if response.file is None:
+            return await send({'type': 'http.response.body', 'body': b''})
+        try:
+            while chunk := await sync_to_async(response.file.read, thread_sensitive=False)(CHUNK_SIZE):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            response.file.close()